@@ -0,0 +1,137 @@
+import unittest
+
+from include import address
+from include import globals
+import settings
+
+
+# BIP173 and BIP350 valid segwit addresses, with their scriptPubKey.
+VALID_SEGWIT = [
+    ('bitcoin', 'BC1QW508D6QEJXTDG4Y5R3ZARVARY0C5XW7KV8F3T4', '0014751e76e8199196d454941c45d1b3a323f1433bd6'),
+    ('bitcoin_testnet3', 'tb1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3q0sl5k7',
+     '00201863143c14c5166804bd19203356da136c985678cd4d27a1b8c6329604903262'),
+    ('bitcoin', 'bc1pw508d6qejxtdg4y5r3zarvary0c5xw7kw508d6qejxtdg4y5r3zarvary0c5xw7kt5nd6y',
+     '5128751e76e8199196d454941c45d1b3a323f1433bd6751e76e8199196d454941c45d1b3a323f1433bd6'),
+    ('bitcoin', 'BC1SW50QGDZ25J', '6002751e'),
+    ('bitcoin', 'bc1zw508d6qejxtdg4y5r3zarvaryvaxxpcs', '5210751e76e8199196d454941c45d1b3a323'),
+    ('bitcoin_testnet3', 'tb1qqqqqp399et2xygdj5xreqhjjvcmzhxw4aywxecjdzew6hylgvsesrxh6hy',
+     '0020000000c4a5cad46221b2a187905e5266362b99d5e91c6ce24d165dab93e86433'),
+    ('bitcoin_testnet3', 'tb1pqqqqp399et2xygdj5xreqhjjvcmzhxw4aywxecjdzew6hylgvsesf3hn0c',
+     '5120000000c4a5cad46221b2a187905e5266362b99d5e91c6ce24d165dab93e86433'),
+    ('bitcoin', 'bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqzk5jj0',
+     '512079be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798'),
+]
+
+# BIP173 and BIP350 invalid segwit addresses.
+INVALID_SEGWIT = [
+    # Invalid human readable part.
+    'tc1qw508d6qejxtdg4y5r3zarvary0c5xw7kg3g4ty',
+    'tc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vq5zuyut',
+    # Invalid checksum.
+    'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t5',
+    # Bech32 instead of bech32m, and bech32m instead of bech32.
+    'bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqh2y7hd',
+    'tb1z0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqglt7rf',
+    'BC1S0XLXVLHEMJA6C4DQV22UAPCTQUPFHLXM9H8Z3K2E72Q4K9HCZ7VQ54WELL',
+    'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kemeawh',
+    'tb1q0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vq24jc47',
+    # Invalid character.
+    'bc1p38j9r5y49hruaue7wxjce0updqjuyyx0kh56v8s25huc6995vvpql3jow4',
+    # Invalid witness version.
+    'BC13W508D6QEJXTDG4Y5R3ZARVARY0C5XW7KN40WF2',
+    'BC130XLXVLHEMJA6C4DQV22UAPCTQUPFHLXM9H8Z3K2E72Q4K9HCZ7VQ7ZWS8R',
+    # Invalid program length.
+    'bc1rw5uspcuh',
+    'bc10w508d6qejxtdg4y5r3zarvary0c5xw7kw508d6qejxtdg4y5r3zarvary0c5xw7kw5rljs90',
+    'bc1pw5dgrnzv',
+    'bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7v8n0nx0muaewav253zgeav',
+    # Invalid program length for witness version 0.
+    'BC1QR508D6QEJXTDG4Y5R3ZARVARYV98GJ9P',
+    # Mixed case.
+    'tb1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3q0sL5k7',
+    'tb1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vq47Zagq',
+    # More than 4 bits of zero padding.
+    'bc1zw508d6qejxtdg4y5r3zarvaryvqyzf3du',
+    'bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7v07qwwzcrf',
+    # Non-zero padding.
+    'tb1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3pjxtptv',
+    'tb1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vpggkg4j',
+    # Empty data part.
+    'bc1gmk9yu',
+]
+
+
+class AddressTestCase(unittest.TestCase):
+    def setUp(self):
+        globals.init()
+        globals.settings = settings
+
+    def validate(self, coin, encoded):
+        return address.validate_address(encoded, address.get_address_settings(coin))
+
+    def test_valid_segwit(self):
+        for coin, encoded, script_pubkey in VALID_SEGWIT:
+            with self.subTest(address=encoded):
+                validated = self.validate(coin, encoded)
+                self.assertTrue(validated['isvalid'])
+                self.assertEqual(validated['address'], encoded.lower())
+                self.assertEqual(validated['scriptPubKey'], script_pubkey)
+                self.assertTrue(validated['iswitness'])
+                self.assertEqual(address.segwit_encode(address.get_address_settings(coin)['bech32_hrp'],
+                                                       validated['witness_version'],
+                                                       bytes.fromhex(validated['witness_program'])), encoded.lower())
+
+    def test_invalid_segwit(self):
+        for encoded in INVALID_SEGWIT:
+            for coin in ('bitcoin', 'bitcoin_testnet3'):
+                with self.subTest(address=encoded, coin=coin):
+                    self.assertFalse(self.validate(coin, encoded)['isvalid'])
+
+    def test_wrong_hrp(self):
+        # Valid addresses of another network.
+        for coin, encoded in (('bitcoin', 'tb1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3q0sl5k7'),
+                              ('bitcoin_testnet3', 'BC1QW508D6QEJXTDG4Y5R3ZARVARY0C5XW7KV8F3T4'),
+                              ('litecoin', 'bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqzk5jj0')):
+            with self.subTest(address=encoded, coin=coin):
+                self.assertFalse(self.validate(coin, encoded)['isvalid'])
+
+    def test_base58(self):
+        validated = self.validate('bitcoin', '1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN2')
+        self.assertEqual(validated, {
+            'isvalid': True,
+            'address': '1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN2',
+            'scriptPubKey': '76a91477bff20c60e522dfaa3350c39b030a5d004e839a88ac',
+            'isscript': False,
+            'iswitness': False,
+        })
+        validated = self.validate('bitcoin', '3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy')
+        self.assertEqual(validated, {
+            'isvalid': True,
+            'address': '3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy',
+            'scriptPubKey': 'a914b472a266d0bd89c13706a4132ccfb16f7c3b9fcb87',
+            'isscript': True,
+            'iswitness': False,
+        })
+
+    def test_base58_invalid(self):
+        # Invalid checksum, invalid character, and a version byte of another coin.
+        self.assertEqual(self.validate('bitcoin', '1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN3'),
+                         {'isvalid': False, 'error': 'Invalid address'})
+        self.assertEqual(self.validate('bitcoin', '1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN0'),
+                         {'isvalid': False, 'error': 'Invalid address'})
+        self.assertEqual(self.validate('litecoin', '1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN2'),
+                         {'isvalid': False, 'error': 'Invalid prefix for Base58-encoded address'})
+
+    def test_script_address2(self):
+        # P2SH addresses with litecoin's older version byte are valid, and returned with the current version byte.
+        validated = self.validate('litecoin', '3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy')
+        self.assertTrue(validated['isvalid'])
+        self.assertTrue(validated['isscript'])
+        self.assertEqual(validated['scriptPubKey'], 'a914b472a266d0bd89c13706a4132ccfb16f7c3b9fcb87')
+        self.assertEqual(validated['address'][0], 'M')
+        self.assertEqual(address.base58check_decode(validated['address']),
+                         bytes([0x32]) + bytes.fromhex('b472a266d0bd89c13706a4132ccfb16f7c3b9fcb'))
+        self.assertEqual(self.validate('litecoin', validated['address']), validated)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,13 +3,18 @@ from decimal import Decimal
 import time
 import os
 
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
 from werkzeug.contrib.fixers import ProxyFix
 
 # Custom libraries:
+# The address argument of the API functions would shadow the module.
+from include import address as addresses
+from include import chaintip
 from include import dbutils
 from include import utils
+from include import rowcache
 from include import rpc
+from include import transport
 from include import globals
 import settings
 
@@ -27,12 +32,19 @@ def cleanup_globals():
         'debug_level': utils.get_debug_level(),
         'pid': os.getpid(),
     }]
+    dbutils.reset_query_stats()
+    # Rows are memoized for the duration of the request.
+    dbutils.start_row_cache()
     try:
         for coin in globals.db_connection:
             dbutils.close_database_connection(coin=coin)
     except:
         pass
 
+@app.teardown_request
+def clear_row_cache(exception):
+    dbutils.stop_row_cache()
+
 def validate_type(type):
     if not type:
         status_code = 400
@@ -67,6 +79,20 @@ def validate_type(type):
 
     return None, True
 
+def get_blockcount(type):
+    '''
+    Height of the coin's chain tip, published by the extract script and the workers polling the daemon (see
+    include/chaintip.py): requests only wait for the daemon if no tip was published yet. The tip and its age are added
+    to the debug block.
+
+    :return: the height, or None if no tip was published and the daemon didn't respond.
+    '''
+    tip = chaintip.get_tip(type)
+    utils.debug(message={'chain_tip': tip})
+    if tip is None:
+        return None
+    return tip['height']
+
 def validate_address(type, address):
     if not address:
         status_code = 400
@@ -82,27 +108,39 @@ def validate_address(type, address):
             },
         }), status_code
 
-    try:
+    validated = None
+    validation = dbutils.get_coin_setting(type, 'address_validation', 'local')
+    if validation in ('local', 'fallback'):
         timestamp = time.time()
-        validated = rpc.rpc_request(method='validateaddress', parameters=[address])
+        validated = addresses.validate_address(address, addresses.get_address_settings(type))
         utils.debug({
-            'activity': 'RPC query',
-            'rpc_method': 'validateaddress',
-            'parameters': [address],
+            'activity': 'address validation',
+            'isvalid': validated['isvalid'],
             'elapsed': utils.elapsed(timestamp, 5),
         }, level=2)
-    except:
-        status_code = 503
-        return jsonify({
-            'status': 'ERROR',
-            'code': status_code,
-            'error': 'failed to communicate with daemon',
-            'data': {
-                'coin': type,
-                'symbol': settings.coins[type]['symbol'],
-                'address': address,
-            },
-        }), status_code
+
+    if validated is None or (validation == 'fallback' and not validated['isvalid']):
+        try:
+            timestamp = time.time()
+            validated = rpc.rpc_request(method='validateaddress', parameters=[address])
+            utils.debug({
+                'activity': 'RPC query',
+                'rpc_method': 'validateaddress',
+                'parameters': [address],
+                'elapsed': utils.elapsed(timestamp, 5),
+            }, level=2)
+        except:
+            status_code = 503
+            return jsonify({
+                'status': 'ERROR',
+                'code': status_code,
+                'error': 'failed to communicate with daemon',
+                'data': {
+                    'coin': type,
+                    'symbol': settings.coins[type]['symbol'],
+                    'address': address,
+                },
+            }), status_code
 
     if not validated['isvalid']:
         status_code = 400
@@ -121,6 +159,295 @@ def validate_address(type, address):
 
     return validated, True
 
+def select_rows(type, table, keys, rows):
+    '''
+    Select the rows of the keys that weren't selected yet with dbutils.select_many(), adding them to rows.
+
+    :param rows: dictionary mapping each selected key to its row, or None if it wasn't found like dbutils.select().
+    :return: rows.
+    '''
+    missing = [key for key in set(keys) if key not in rows]
+    found = dbutils.select_many(type, table, missing)
+    for key in missing:
+        rows[key] = found[key][1] if key in found else None
+    return rows
+
+def get_unspent(type, address, view):
+    '''
+    The unspent vout of an address and its balance, reading its history one segment at a time.
+
+    :param view: the address, from dbutils.select_address_view().
+    :return: tuple of (unspent vout by txid, balance in satoshis).
+    '''
+    unspent = {}
+    balance = 0
+    for segment in range(len(view['directory']['segments'])):
+        address_json = dbutils.select_address_segment(type, address, view, segment)
+        vin_spent = dbutils.select_many(type, 'vin_spent', list(address_json[address]))
+        for txid in address_json[address]:
+            tx_vin_spent_json = vin_spent[txid][1] if txid in vin_spent else None
+            utils.debug(message={'tx_vin_spent_json': tx_vin_spent_json}, level=3)
+            # Determine which vout are spent, and which are unspent.
+            for vout in address_json[address][txid]:
+                # If this txid:vout pair exists in the vin_spent table, it has been spent
+                if not tx_vin_spent_json or vout not in tx_vin_spent_json[txid]:
+                    value = int(Decimal(address_json[address][txid][vout]['value']) * 100000000)
+                    balance += value
+                    if txid in unspent:
+                        unspent[txid][vout] = value,
+                    else:
+                        unspent[txid] = {
+                            vout: value,
+                            'height': address_json[address][txid][vout]['height'],
+                        }
+    return unspent, balance
+
+def get_unspent_outputs(outputs):
+    '''
+    The unspent vout of an address and its balance, from its outputs in the normalized tables or the UTXO set.
+
+    :param outputs: the outputs of the address, from dbutils.select_outputs() or dbutils.select_utxo().
+    :return: tuple of (unspent vout by txid, balance in satoshis), in the same format as get_unspent().
+    '''
+    unspent = {}
+    balance = 0
+    for output in outputs:
+        if output.get('spent_txid') is None:
+            balance += output['value']
+            if output['txid'] not in unspent:
+                unspent[output['txid']] = {
+                    'height': str(output['height']),
+                }
+            unspent[output['txid']][str(output['n'])] = output['value']
+    return unspent, balance
+
+def close_request(type):
+    '''
+    Close the database connection, adding the statistics of the request to the debug block.
+    '''
+    dbutils.close_database_connection(type)
+    utils.debug(message={'transport': transport.stats(type)}, level=2)
+    utils.debug(message={'queries': dbutils.query_stats()}, level=2)
+    utils.debug(message={'row_cache': rowcache.stats()}, level=2)
+    utils.debug(message={'total elapsed': utils.elapsed(globals.start, 3)})
+
+def address_error(type, details, status_code, error, message):
+    '''
+    An error response of the address endpoints.
+
+    :param details: the validated address.
+    :param message: details about the error.
+    '''
+    close_request(type)
+    return jsonify({
+        'status': 'ERROR',
+        'code': status_code,
+        'error': error,
+        'details': message,
+        'debug': utils.debug(),
+        'data': {
+            'coin': type,
+            'symbol': settings.coins[type]['symbol'],
+            'address': details,
+        },
+    }), status_code
+
+def address_transaction(address, txid, height, timestamp, outputs, inputs, coinbase, blockcount):
+    '''
+    A transaction listed by get_address(), from the rows of the normalized tables or of the other tables.
+
+    :param outputs: list of (address, value, is_spent) tuples, one per output and address.
+    :param inputs: dictionary mapping each input to a list of (address, value) tuples of the output it spends, one per
+      address (empty if the output isn't found); None if the transaction has no inputs.
+    :param coinbase: dictionary with the coinbase and value of a coinbase transaction, or None.
+    :return: tuple of (the transaction, number of vin listed, number of errors).
+    '''
+    errors = 0
+    received = sent = False
+    value_in = value_out = 0
+
+    to_details = []
+    total_vout_value = 0
+    for to_address, value, is_spent in outputs:
+        total_vout_value += value
+        if to_address == address:
+            value_in += value
+            received = True
+        to_details.append({
+            'address': to_address,
+            'value': value,
+            'is_spent': is_spent,
+        })
+
+    from_details = []
+    vin_count = 0
+    if inputs is not None:
+        total_vin_value = 0
+        for spent_outputs in inputs.values():
+            for from_address, value in spent_outputs:
+                total_vin_value += value
+                vin_count += 1
+                from_details.append({
+                    'address': from_address,
+                    'value': value,
+                })
+                if from_address == address:
+                    value_out += value
+                    sent = True
+        # Inputs spending an output with several addresses are listed once per address, and counted once.
+        from_count = len(inputs)
+        found_count = sum(1 for spent_outputs in inputs.values() if spent_outputs)
+        fee = int(total_vin_value - total_vout_value)
+    else:
+        from_count = found_count = 0
+        if coinbase:
+            from_count = found_count = 1
+            from_details.append({
+                'address': False,
+                'coinbase': coinbase['coinbase'],
+                'value': coinbase['value'],
+            })
+        fee = 0
+
+    if found_count < 1 or found_count != from_count:
+        utils.debug(message='ERROR: spent output found for %d of %d inputs of txid %s' % (found_count, from_count,
+                                                                                           txid))
+        errors += 1
+
+    if len(to_details) < 1:
+        utils.debug(message='ERROR: empty to array on txid %s' % txid)
+        errors += 1
+
+    return {
+        'txid': txid,
+        'block': int(height),
+        'confirmations': int(blockcount) - int(height),
+        'timestamp': int(timestamp),
+        'received': received,
+        'value_in': value_in,
+        'sent': sent,
+        'value_out': value_out,
+        'from_count': from_count,
+        'to_count': len(to_details),
+        'fee': fee,
+        'from':  from_details,
+        'to': to_details,
+    }, vin_count, errors
+
+def address_response(type, details, totals, segment, transactions, error_count):
+    '''
+    The response of get_address().
+
+    :param totals: dictionary with the received, sent, vin, vout and blockcount totals.
+    :param segment: dictionary with the index of the segment listed, the number of segments, and the first and last
+      height of the segment.
+    :param transactions: the transactions of the segment, from address_transaction().
+    '''
+    status_code = 200
+    balance = totals['received'] - totals['sent']
+    if balance < 0:
+        utils.debug(message='ERROR: negative balance')
+        error_count += 1
+
+    close_request(type)
+    return jsonify({
+        'status': 'OK',
+        'code': status_code,
+        'debug': utils.debug(),
+        'errors': error_count,
+        'data': {
+            'coin': type,
+            'symbol': settings.coins[type]['symbol'],
+            'address': details,
+            'balance': balance,
+            'total': totals,
+            'segment': segment,
+            'transactions': transactions,
+        }
+    }), status_code
+
+def get_address_normalized(type, address, details):
+    '''
+    get_address() using the normalized tables: the outputs of the address, then the outputs and inputs of the
+    transactions of one segment are each read with indexed range queries, instead of reading and decoding the rows
+    of each txid.
+
+    Like the address table, the txids sending to the address are split into segments of address_segment_size txids
+    ordered by height, each segment listing them and the transactions spending their outputs.
+    '''
+    outputs = dbutils.select_outputs(type, 'address', [address])
+    if not outputs:
+        return address_error(type, details, 404, 'address not found', 'address has no transactions')
+
+    # Outputs are ordered by height, then txid.
+    received_txids = []
+    for output in outputs:
+        if not received_txids or received_txids[-1] != output['txid']:
+            received_txids.append(output['txid'])
+    segment_size = dbutils.get_address_segment_size()
+    segments = max(1, -(-len(received_txids) // segment_size))
+    segment = request.args.get('segment', -1, type=int)
+    try:
+        segment = range(segments)[segment]
+    except IndexError:
+        return address_error(type, details, 400, 'segment not found', 'address has %d segments' % segments)
+    segment_txids = set(received_txids[segment * segment_size:(segment + 1) * segment_size])
+    segment_outputs = [output for output in outputs if output['txid'] in segment_txids]
+
+    # The transactions of the segment: those sending to the address, and those spending from it.
+    txids = set(segment_txids)
+    txids.update(output['spent_txid'] for output in segment_outputs if output['spent_txid'] is not None)
+    tx_outputs = {}
+    for output in dbutils.select_outputs(type, 'txid', txids):
+        tx_outputs.setdefault(output['txid'], []).append(output)
+    tx_inputs = {}
+    for vin in dbutils.select_inputs(type, txids):
+        tx_inputs.setdefault(vin['txid'], {}).setdefault(vin['vin_n'], [])
+        if vin['address'] is not None:
+            tx_inputs[vin['txid']][vin['vin_n']].append((vin['address'], vin['value']))
+    coinbase = dbutils.select_many(type, 'coinbase', [txid for txid in tx_outputs if txid not in tx_inputs])
+
+    blockcount = get_blockcount(type)
+    if blockcount is None:
+        return address_error(type, details, 503, 'failed to communicate with daemon', 'chain tip not available yet')
+
+    transactions = []
+    vin_count = vout_count = error_count = 0
+    # Newest first.
+    for txid in sorted(tx_outputs, key=lambda txid: (tx_outputs[txid][0]['height'], txid), reverse=True):
+        _, coinbase_json = coinbase.get(txid, (None, None))
+        transaction, tx_vin_count, errors = address_transaction(
+            address, txid, tx_outputs[txid][0]['height'], tx_outputs[txid][0]['timestamp'],
+            [(output['address'], output['value'], output['spent_txid'] is not None) for output in tx_outputs[txid]],
+            tx_inputs.get(txid), coinbase_json[txid] if coinbase_json else None, blockcount)
+        transactions.append(transaction)
+        vin_count += tx_vin_count
+        vout_count += transaction['to_count']
+        error_count += errors
+
+    # The totals are for the entire address.
+    address_balance = dbutils.select_address_balance(type, address) if dbutils.has_complete_utxo_tables(type) else None
+    if address_balance:
+        received_total = address_balance['received']
+        sent_total = address_balance['sent']
+    else:
+        received_total = sum(output['value'] for output in outputs)
+        sent_total = sum(output['value'] for output in outputs if output['spent_txid'] is not None)
+    segment_heights = [output['height'] for output in segment_outputs]
+
+    return address_response(type, details, {
+        'received': received_total,
+        'sent': sent_total,
+        'vin': vin_count,
+        'vout': vout_count,
+        'blockcount': blockcount,
+    }, {
+        'index': segment,
+        'segments': segments,
+        'first_height': min(segment_heights),
+        'last_height': max(segment_heights),
+    }, transactions, error_count)
+
 @app.route('/api/address/<type>/<address>', methods=['GET'])
 def get_address(type, address):
     message, validated = validate_type(type)
@@ -141,218 +468,154 @@ def get_address(type, address):
         except:
             pass
 
-    address_json = dbutils.select(type, 'address', address)
+    if dbutils.has_complete_normalized_tables(type):
+        return get_address_normalized(type, address, details)
+
+    # Addresses are stored in segments of address_segment_size txids ordered by height, list the transactions of one
+    # segment: the most recent by default, select the others with the segment parameter (negative values count from
+    # the end). Addresses stored in a single row before segments were introduced are split the same way.
+    segment = request.args.get('segment', -1, type=int)
+    view = dbutils.select_address_view(type, address)
+    if not view:
+        return address_error(type, details, 404, 'address not found', 'address has no transactions')
+    segments = len(view['directory']['segments'])
+    try:
+        segment = range(segments)[segment]
+    except IndexError:
+        return address_error(type, details, 400, 'segment not found', 'address has %d segments' % segments)
+    address_json = dbutils.select_address_segment(type, address, view, segment)
     utils.debug(message={'address_json': address_json}, level=3)
-    address_txids = None
+
+    blockcount = get_blockcount(type)
+    if blockcount is None:
+        return address_error(type, details, 503, 'failed to communicate with daemon', 'chain tip not available yet')
+
     error_count = 0
-    if address_json:
-        status_code = 200
-        timestamp = time.time()
-        blockcount = rpc.rpc_request(method='getblockcount')
-        utils.debug({
-            'activity': 'RPC query',
-            'rpc_method': 'getblockcount',
-            'parameters': None,
-            'elapsed': utils.elapsed(timestamp, 5),
-        }, level=2)
-        if len(address_json[address]) > 15000:
-            transactions = []
-            utils.debug(message="ERROR: too many transactions (%d or more), not calculating" % len(address_json[address]))
-            sent_total = received_total = vin_count = vout_count = is_spent = "not calculated"
-            error_count += 1
+    transactions = []
+    sent_total = received_total = vin_count = vout_count = 0
+
+    # Rows are read breadth-first, with a few batched queries instead of one query per txid.
+    vout = select_rows(type, 'vout', address_json[address], {})
+    vin_spent = select_rows(type, 'vin_spent', address_json[address], {})
+
+    # Generate a list of all txids including the address
+    address_txids = {}
+    for txid in address_json[address]:
+        # Get the height and timestamp of the transaction
+        key = next(iter(address_json[address][txid]))
+        txid_height = address_json[address][txid][key]['height']
+
+        # Build object allowing us to sort transactions by height
+        if txid_height in address_txids:
+            address_txids[txid_height].append(txid)
         else:
-            transactions = []
-            sent_total = received_total = vin_count = vout_count = txid_height = txid_timestamp = 0
-
-            # Generate a list of all txids including the address
-            address_txids = {}
-            for txid in address_json[address]:
-                # Get the height and timestamp of the transaction
-                key = next(iter(address_json[address][txid]))
-                txid_height = address_json[address][txid][key]['height']
-
-                # Build object allowing us to sort transactions by height
-                if txid_height in address_txids:
-                    address_txids[txid_height].append(txid)
-                else:
-                    address_txids.update({
-                        txid_height: [txid],
-                    })
-
-                # Load to details for each transaction
-                tx_vout_json = dbutils.select(type, 'vout', txid)
-                utils.debug(message={'tx_vout_json': tx_vout_json}, level=3)
-                for to_address in tx_vout_json[txid]['addresses']:
-                    if address == to_address:
-                        for vout_sent in tx_vout_json[txid]['addresses'][to_address]:
-                            # Search for received that have subsequently been spent
-                            tx_vin_spent_json = dbutils.select(type, 'vin_spent', txid)
-                            utils.debug(message={'tx_vin_spent_json': tx_vin_spent_json}, level=3)
-                            if tx_vin_spent_json and vout_sent in tx_vin_spent_json[txid]:
-                                height = tx_vin_spent_json[txid][vout_sent]['height']
-                                if height in address_txids:
-                                    address_txids[height].append(tx_vin_spent_json[txid][vout_sent]['txid'])
-                                else:
-                                    address_txids.update({
-                                        height: [tx_vin_spent_json[txid][vout_sent]['txid']],
-                                    })
-
-            # Loop through all transactions involving this address, newest first.
-            for height in sorted(address_txids, reverse=True):
-                txids = address_txids[height]
-                for txid in set(txids):
-                    received_from_count = 0
-                    sent_to_count = 0
-                    received = sent = False
-                    value_in = value_out = 0
-
-                    # Load to details for each transaction
-                    tx_vout_json = dbutils.select(type, 'vout', txid)
-                    utils.debug(message={'tx_vout_json': tx_vout_json}, level=3)
-                    txid_height = tx_vout_json[txid]['height']
-                    txid_timestamp = tx_vout_json[txid]['timestamp']
-                    to_details = []
-                    total_vout_value = 0
-                    for to_address in tx_vout_json[txid]['addresses']:
-                        for vout_sent in tx_vout_json[txid]['addresses'][to_address]:
-                            vout_count += 1
-                            sent_to_count += 1
-                            total_vout_value += tx_vout_json[txid]['addresses'][to_address][vout_sent]['value']
-                            if address == to_address:
-                                received_total += tx_vout_json[txid]['addresses'][to_address][vout_sent]['value']
-                                value_in += tx_vout_json[txid]['addresses'][to_address][vout_sent]['value']
-                                received = True
-
-                            # Determine if this vout has subsequently been spent
-                            tx_vin_spent_json = dbutils.select(type, 'vin_spent', txid)
-                            utils.debug(message={'tx_vin_spent_json': tx_vin_spent_json}, level=3)
-                            if tx_vin_spent_json and vout_sent in tx_vin_spent_json[txid]:
-                                is_spent = True
-                            else:
-                                is_spent = False
-
-                            to_details.append({
-                                'address': to_address,
-                                'value': tx_vout_json[txid]['addresses'][to_address][vout_sent]['value'],
-                                'is_spent': is_spent,
-                            })
-
-                    tx_vin_json = dbutils.select(type, 'vin_txid', txid)
-                    utils.debug(message={'tx_vin_json': tx_vin_json}, level=3)
-                    from_details = []
-                    total_vin_value = 0
-                    if tx_vin_json and txid in tx_vin_json:
-                        for vin in tx_vin_json[txid]['vin']:
-                            received_from_count += 1
-                            spent_txid = tx_vin_json[txid]['vin'][vin]['spent']
-                            spent_vout = tx_vin_json[txid]['vin'][vin]['vout']
-
-                            # Finally, look up the address associated with this spent txid/vout
-                            spent_json = dbutils.select(type, 'vout', spent_txid)
-                            utils.debug(message={'spent_json': spent_json}, level=3)
-                            for from_address in spent_json[spent_txid]['addresses']:
-                                if spent_vout in spent_json[spent_txid]['addresses'][from_address]:
-                                    total_vin_value += spent_json[spent_txid]['addresses'][from_address][spent_vout]['value']
-                                    vin_count += 1
-                                    from_details.append({
-                                        'address': from_address,
-                                        'value': spent_json[spent_txid]['addresses'][from_address][spent_vout]['value'],
-                                        # We can easily provide more details here:
-                                        #'spent': {
-                                        #    'txid': spent_txid,
-                                        #    'vout': spent_vout,
-                                        #}
-                                    })
-                                    if address == from_address:
-                                        sent_total += spent_json[spent_txid]['addresses'][from_address][spent_vout]['value']
-                                        value_out += spent_json[spent_txid]['addresses'][from_address][spent_vout]['value']
-                                        sent = True
-                        fee = int(total_vin_value - total_vout_value)
-                    else:
-                        coinbase_json = dbutils.select(type, 'coinbase', txid)
-                        utils.debug(message={'coinbase_json': coinbase_json}, level=3)
-                        if coinbase_json and txid in coinbase_json:
-                            received_from_count += 1
-                            from_details.append({
-                                'address': False,
-                                'coinbase': coinbase_json[txid]['coinbase'],
-                                'value': coinbase_json[txid]['value'],
+            address_txids.update({
+                txid_height: [txid],
+            })
+
+        # Load to details for each transaction
+        tx_vout_json = vout[txid]
+        utils.debug(message={'tx_vout_json': tx_vout_json}, level=3)
+        for to_address in tx_vout_json[txid]['addresses']:
+            if address == to_address:
+                for vout_sent in tx_vout_json[txid]['addresses'][to_address]:
+                    # Search for received that have subsequently been spent
+                    tx_vin_spent_json = vin_spent[txid]
+                    utils.debug(message={'tx_vin_spent_json': tx_vin_spent_json}, level=3)
+                    if tx_vin_spent_json and vout_sent in tx_vin_spent_json[txid]:
+                        height = tx_vin_spent_json[txid][vout_sent]['height']
+                        if height in address_txids:
+                            address_txids[height].append(tx_vin_spent_json[txid][vout_sent]['txid'])
+                        else:
+                            address_txids.update({
+                                height: [tx_vin_spent_json[txid][vout_sent]['txid']],
                             })
-                        fee = 0
-
-                    if len(from_details) < 1 or len(from_details) != received_from_count:
-                        utils.debug(message='ERROR: length of from array: %d, reported length: %d' % (len(from_details),
-                                                                                        received_from_count))
-                        error_count += 1
-
-                    if len(to_details) < 1:
-                        utils.debug(message='ERROR: empty to array on txid %s' % txid)
-                        error_count += 1
-
-                    transactions.append({
-                        'txid': txid,
-                        'block': int(txid_height),
-                        'confirmations': int(blockcount) - int(txid_height),
-                        'timestamp': int(txid_timestamp),
-                        'received': received,
-                        'value_in': value_in,
-                        'sent': sent,
-                        'value_out': value_out,
-                        'from_count': int(received_from_count),
-                        'to_count': int(sent_to_count),
-                        'fee': fee,
-                        'from':  from_details,
-                        'to': to_details,
-                    })
-
-        try:
-            balance = received_total - sent_total
-            if balance < 0:
-                utils.debug(message='ERROR: negative balance')
-                error_count += 1
-        except:
-            balance = 'not calculated'
-
-        utils.debug(message={'address_txids': address_txids}, level=3)
-
-        dbutils.close_database_connection(type)
-        utils.debug(message={'total elapsed': utils.elapsed(globals.start, 3)})
-        return jsonify({
-            'status': 'OK',
-            'code': status_code,
-            'debug': utils.debug(),
-            'errors': error_count,
-            'data': {
-                'coin': type,
-                'symbol': settings.coins[type]['symbol'],
-                'address': details,
-                'balance': balance,
-                'total': {
-                    'received': received_total,
-                    'sent': sent_total,
-                    'vin': vin_count,
-                    'vout': vout_count,
-                    'blockcount': blockcount,
-                },
-                'transactions': transactions,
-            }
-        }), status_code
 
-    else:
-        status_code = 404
-        dbutils.close_database_connection(type)
-        utils.debug(message={'total elapsed': utils.elapsed(globals.start, 3)})
-        return jsonify({
-            'status': 'ERROR',
-            'code': status_code,
-            'error': 'address not found',
-            'debug': utils.debug(),
-            'data': {
-                'coin': type,
-                'symbol': settings.coins[type]['symbol'],
-                'address': details,
-            },
-        }), status_code
+    # The rows of the transactions spending from the address, then of the outputs spent by their inputs.
+    all_txids = set(txid for txids in address_txids.values() for txid in txids)
+    select_rows(type, 'vout', all_txids, vout)
+    select_rows(type, 'vin_spent', all_txids, vin_spent)
+    vin_txid = select_rows(type, 'vin_txid', all_txids, {})
+    spent_txids = set()
+    coinbase_txids = set()
+    for txid in all_txids:
+        if vin_txid[txid] and txid in vin_txid[txid]:
+            spent_txids.update(vin['spent'] for vin in vin_txid[txid][txid]['vin'].values())
+        else:
+            coinbase_txids.add(txid)
+    select_rows(type, 'vout', spent_txids, vout)
+    coinbase = select_rows(type, 'coinbase', coinbase_txids, {})
+
+    # Loop through all transactions involving this address, newest first.
+    for height in sorted(address_txids, reverse=True):
+        for txid in set(address_txids[height]):
+            tx_vout_json = vout[txid]
+            tx_vin_spent_json = vin_spent[txid]
+            utils.debug(message={'tx_vout_json': tx_vout_json, 'tx_vin_spent_json': tx_vin_spent_json}, level=3)
+            outputs = []
+            for to_address in tx_vout_json[txid]['addresses']:
+                for vout_sent, output in tx_vout_json[txid]['addresses'][to_address].items():
+                    # Determine if this vout has subsequently been spent
+                    is_spent = bool(tx_vin_spent_json and vout_sent in tx_vin_spent_json[txid])
+                    outputs.append((to_address, output['value'], is_spent))
+
+            tx_vin_json = vin_txid[txid]
+            utils.debug(message={'tx_vin_json': tx_vin_json}, level=3)
+            inputs = None
+            if tx_vin_json and txid in tx_vin_json:
+                inputs = {}
+                for vin, spent in tx_vin_json[txid]['vin'].items():
+                    # Look up the addresses of the spent txid and vout.
+                    spent_json = vout[spent['spent']]
+                    inputs[vin] = []
+                    if spent_json:
+                        for from_address, spent_outputs in spent_json[spent['spent']]['addresses'].items():
+                            if spent['vout'] in spent_outputs:
+                                inputs[vin].append((from_address, spent_outputs[spent['vout']]['value']))
+
+            coinbase_json = coinbase[txid] if inputs is None else None
+            utils.debug(message={'coinbase_json': coinbase_json}, level=3)
+            transaction, tx_vin_count, errors = address_transaction(
+                address, txid, tx_vout_json[txid]['height'], tx_vout_json[txid]['timestamp'], outputs, inputs,
+                coinbase_json[txid] if coinbase_json and txid in coinbase_json else None, blockcount)
+            transactions.append(transaction)
+            received_total += transaction['value_in']
+            sent_total += transaction['value_out']
+            vin_count += tx_vin_count
+            vout_count += transaction['to_count']
+            error_count += errors
+
+    address_balance = None
+    if dbutils.has_complete_utxo_tables(type):
+        address_balance = dbutils.select_address_balance(type, address)
+    if address_balance:
+        # Maintained by the extract script, the totals are for the entire address.
+        received_total = address_balance['received']
+        sent_total = address_balance['sent']
+    elif segments > 1:
+        # Only the transactions of one segment are listed, the totals of the entire address are kept in its directory
+        # row.
+        received_total = view['directory']['received']
+        sent_total = view['directory'].get('sent')
+        if sent_total is None:
+            # Stored in a single row by an older version (segmented once compacted), or segmented before spent outputs
+            # were counted: count them from its history.
+            sent_total, _ = dbutils.count_address_sent(type, address, view)
+
+    utils.debug(message={'address_txids': address_txids}, level=3)
+
+    return address_response(type, details, {
+        'received': received_total,
+        'sent': sent_total,
+        'vin': vin_count,
+        'vout': vout_count,
+        'blockcount': blockcount,
+    }, {
+        'index': segment,
+        'segments': segments,
+        'first_height': view['directory']['segments'][segment]['first_height'],
+        'last_height': view['directory']['segments'][segment]['last_height'],
+    }, transactions, error_count)
 
 @app.route('/api/address/<type>/<address>/unspent', methods=['GET'])
 def get_address_unspent(type, address):
@@ -374,65 +637,40 @@ def get_address_unspent(type, address):
         except:
             pass
 
-    address_json = dbutils.select(type, 'address', address)
-    utils.debug(message={'address_json': address_json}, level=3)
-    error_count = 0
-    if address_json:
-        status_code = 200
-        if len(address_json[address]) > 15000:
-            unspent = {}
-            balance = 'unknown'
-            utils.debug(message='too many transactions (%d or more), not calculating' % len(address_json[address]))
-            error_count += 0
-        else:
-            unspent = {}
-            balance = 0
-            for txid in address_json[address]:
-                tx_vin_spent_json = dbutils.select(type, 'vin_spent', txid)
-                utils.debug(message={'tx_vin_spent_json': tx_vin_spent_json}, level=3)
-                # Determine which vout are spent, and which are unspent.
-                for vout in address_json[address][txid]:
-                    # If this txid:vout pair exists in the vin_spent table, it has been spent
-                    if not tx_vin_spent_json or vout not in tx_vin_spent_json[txid]:
-                        value = int(Decimal(address_json[address][txid][vout]['value']) * 100000000)
-                        balance += value
-                        if txid in unspent:
-                            unspent[txid][vout] = value,
-                        else:
-                            unspent[txid] = {
-                                vout: value,
-                                'height': address_json[address][txid][vout]['height'],
-                            }
-
-        dbutils.close_database_connection(type)
-        utils.debug(message={'total elapsed': utils.elapsed(globals.start, 3)})
-        return jsonify({
-            'status': 'OK',
-            'code': status_code,
-            'debug': utils.debug(),
-            'data': {
-                'coin': type,
-                'symbol': settings.coins[type]['symbol'],
-                'address': details,
-                'balance': balance,
-                'unspent': unspent,
-            }
-        }), status_code
-    else:
-        status_code = 404
-        dbutils.close_database_connection(type)
-        utils.debug(message={'total elapsed': utils.elapsed(globals.start, 3)})
-        return jsonify({
-            'status': 'ERROR',
-            'code': status_code,
-            'error': 'address not found',
-            'debug': utils.debug(),
-            'data': {
-                'coin': type,
-                'symbol': settings.coins[type]['symbol'],
-                'address': details,
-            },
-        }), status_code
+    found = False
+    if dbutils.has_complete_utxo_tables(type):
+        # The unspent outputs are read from the UTXO set, without reading the history of the address. Addresses
+        # without a balance are looked up in their history, like when the UTXO tables aren't used.
+        found = dbutils.select_address_balance(type, address) is not None
+        if found:
+            unspent, balance = get_unspent_outputs(dbutils.select_utxo(type, address))
+    if not found and dbutils.has_complete_normalized_tables(type):
+        outputs = dbutils.select_outputs(type, 'address', [address])
+        found = bool(outputs)
+        if found:
+            unspent, balance = get_unspent_outputs(outputs)
+    elif not found:
+        view = dbutils.select_address_view(type, address)
+        found = view is not None
+        if found:
+            unspent, balance = get_unspent(type, address, view)
+    if not found:
+        return address_error(type, details, 404, 'address not found', 'address has no transactions')
+
+    status_code = 200
+    close_request(type)
+    return jsonify({
+        'status': 'OK',
+        'code': status_code,
+        'debug': utils.debug(),
+        'data': {
+            'coin': type,
+            'symbol': settings.coins[type]['symbol'],
+            'address': details,
+            'balance': balance,
+            'unspent': unspent,
+        }
+    }), status_code
 
 @app.route('/api/tx/<type>/<txid>', methods=['GET'])
 def get_tx(type, txid):
@@ -504,6 +742,8 @@ def get_block(type, hash):
 # Create a generic object, and populate with parameters expected by our helper functions.
 globals.args = type('', (), {})()
 globals.args.db = None
+# The embedded store is opened read-only.
+globals.args.read_only = True
 globals.args.verbose = 0
 globals.settings = settings
 globals.db_connection = {}
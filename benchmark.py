@@ -0,0 +1,284 @@
+'''
+Benchmarks, run against the CSV files written by a previous extraction (python extract.py -t <coin> --single).
+
+All files generated by the benchmarks are written to a benchmark/ directory inside the working directory.
+'''
+import argparse
+import csv
+import gzip
+import os
+import random
+import time
+import zlib
+
+# Custom libraries:
+from include import address
+from include import codec
+from include import dbutils
+from include import globals
+from include import rpc
+from include import utils
+import extract
+import settings
+
+
+def get_loaders():
+    '''
+    The tables grouped by the load phases, with the function grouping their rows and the file merge-joined with them.
+    '''
+    return [
+        ('vout', extract.group_transaction_vout, 'txid', None),
+        ('coinbase', extract.group_transaction_vin_coinbase, 'txid', 'vout'),
+        ('vin_spent', extract.group_transaction_vin_spent, 'spent', None),
+        ('vin_txid', extract.group_transaction_vin_txid, 'txid', None),
+        ('address', extract.group_address, 'address, txid', None),
+        ('block', extract.group_block, 'block hash', None),
+    ]
+
+def tsv_checksum(path):
+    '''
+    Order independent checksum of a file, to compare the grouped rows generated by different pipelines.
+
+    :return: tuple of (number of lines, checksum).
+    '''
+    lines = checksum = 0
+    with open(path, 'rb') as f_tsv:
+        for line in f_tsv:
+            lines += 1
+            checksum = (checksum + zlib.crc32(line)) & 0xffffffffffffffff
+    return lines, checksum
+
+def split_partitions(file, partitions):
+    '''
+    Split an extracted CSV file into hash partitions, as extract_blockchain does with --partitions.
+    '''
+    with gzip.open(globals.args.working_path + file + '.csv.gz', 'rb') as f_source:
+        partition_files = [gzip.open(extract.partition_path(file, partition), 'wb',
+                                     compresslevel=globals.args.compress_level) for partition in range(partitions)]
+        try:
+            for line in f_source:
+                key = line.split(b',', 1)[0].decode()
+                partition_files[extract.get_partition(key, partitions)].write(line)
+        finally:
+            for f_partition in partition_files:
+                f_partition.close()
+
+def run_loaders(args, results, pipeline):
+    for file, group, grouping, join in get_loaders():
+        timer = time.time()
+        extract.load_rows(args, file, group, grouping=grouping, desc=file, unit='row', join=join)
+        results[pipeline][file] = utils.elapsed(timer, 3)
+        destination_file = args.working_path + file + '.csv.' + pipeline
+        os.replace(args.working_path + file + '.csv', destination_file)
+        results[pipeline][file + ' checksum'] = tsv_checksum(destination_file)
+
+def partitions(args):
+    '''
+    Compare the sort-based pipeline (sort_files, then group the sorted files) with the hash-partitioned pipeline
+    (group each partition in memory), checking that both generate the same grouped rows.
+    '''
+    results = {
+        'sorted': {},
+        'partitioned': {},
+    }
+    files = [file for file, _, _, _ in get_loaders()]
+
+    utils.vprint("benchmarking sort-based pipeline")
+    globals.metadata['extract_blockchain']['partitions'] = 0
+    timer = time.time()
+    extract.sort_files(args)
+    results['sorted']['sort'] = utils.elapsed(timer, 3)
+    run_loaders(args, results, 'sorted')
+
+    utils.vprint("benchmarking hash-partitioned pipeline with %d partitions and %d workers" % (args.partitions,
+                                                                                            args.workers))
+    globals.metadata['extract_blockchain']['partitions'] = args.partitions
+    timer = time.time()
+    for file in files:
+        split_partitions(file, args.partitions)
+    # Extraction writes the partitions directly, this is only needed to benchmark from existing CSV files.
+    results['partitioned']['split (not needed when extracting)'] = utils.elapsed(timer, 3)
+    run_loaders(args, results, 'partitioned')
+
+    print("%-36s %12s %12s" % ('', 'sorted', 'partitioned'))
+    for pipeline in results:
+        results[pipeline]['total'] = round(sum(value for key, value in results[pipeline].items()
+                                               if not key.endswith('checksum') and not key.startswith('split')), 3)
+    for key in ['sort', 'split (not needed when extracting)'] + files + ['total']:
+        print("%-36s %12s %12s" % (key, results['sorted'].get(key, '-'), results['partitioned'].get(key, '-')))
+    for file in files:
+        if results['sorted'][file + ' checksum'] != results['partitioned'][file + ' checksum']:
+            print("MISMATCH: %s grouped rows differ (%s, %s)" % (file, results['sorted'][file + ' checksum'],
+                                                                  results['partitioned'][file + ' checksum']))
+            return 1
+    print("grouped rows are identical")
+    return 0
+
+def read_grouped_rows(path, limit):
+    '''
+    Read the rows of a tab separated file written by a load phase.
+    '''
+    rows = []
+    with open(path, newline='') as f_tsv:
+        for key, data in csv.reader(f_tsv, delimiter='\t', quoting=csv.QUOTE_NONE, escapechar='\\'):
+            rows.append(codec.decode_tsv(data))
+            if len(rows) >= limit:
+                break
+    return rows
+
+def codecs(args, source_path):
+    '''
+    Compare the codecs of the data column on the grouped rows written by the last load phases (python extract.py
+    -t <coin> --phase 3): encoded size, and encode and decode throughput.
+    '''
+    names = []
+    for name, (_, serializer, compressor) in codec.CODECS.items():
+        if (serializer == 'msgpack' and codec.msgpack is None) or (compressor == 'zstd' and codec.zstandard is None):
+            print("skipping %s, library not installed" % name)
+        else:
+            names.append(name)
+
+    print("%-14s %-14s %10s %12s %8s %14s %14s" % ('table', 'codec', 'rows', 'size', 'ratio', 'encode row/s',
+                                                   'decode row/s'))
+    for table in dbutils.get_tables():
+        path = source_path + table + '.csv'
+        if not os.path.isfile(path):
+            utils.vprint("'%s' does not exist, skipping" % path)
+            continue
+        rows = read_grouped_rows(path, args.rows)
+        if not rows:
+            continue
+        json_size = None
+        for name in names:
+            timer = time.time()
+            encoded = [codec.encode_value(row, name) for row in rows]
+            encode_elapsed = max(time.time() - timer, 1e-9)
+            timer = time.time()
+            for data in encoded:
+                codec.decode(data)
+            decode_elapsed = max(time.time() - timer, 1e-9)
+            size = sum(len(data) for data in encoded)
+            if json_size is None:
+                json_size = size
+            print("%-14s %-14s %10d %12s %8.3f %14d %14d" % (table, name, len(rows), utils.human_readable(size),
+                                                             size / json_size, len(rows) / encode_elapsed,
+                                                             len(rows) / decode_elapsed))
+    return 0
+
+def generate_addresses(address_settings, count):
+    '''
+    Random addresses of each type the coin supports, and the same addresses with one character changed.
+
+    :return: dictionary of address type: list of addresses.
+    '''
+    generated = {
+        'p2pkh': [address.base58check_encode(address_settings['pubkey_address'], os.urandom(20))
+                  for _ in range(count)],
+        'p2sh': [address.base58check_encode(address_settings['script_address'], os.urandom(20)) for _ in range(count)],
+    }
+    if address_settings['bech32_hrp']:
+        for name, witness_version, length in (('p2wpkh', 0, 20), ('p2wsh', 0, 32), ('p2tr', 1, 32)):
+            generated[name] = [address.segwit_encode(address_settings['bech32_hrp'], witness_version,
+                                                     os.urandom(length)) for _ in range(count)]
+    invalid = []
+    for name in list(generated):
+        for encoded in generated[name]:
+            i = random.randrange(len(encoded))
+            replacement = random.choice([c for c in address.BASE58_ALPHABET if c != encoded[i]])
+            invalid.append(encoded[:i] + replacement + encoded[i + 1:])
+    generated['invalid'] = invalid
+    return generated
+
+def addresses(args):
+    '''
+    Address validation throughput of the offline validator (address_validation setting), optionally compared with the
+    validateaddress RPC of the coin daemon.
+    '''
+    address_settings = address.get_address_settings(args.type)
+    generated = generate_addresses(address_settings, args.addresses)
+    print("%-10s %10s %10s %14s" % ('type', 'addresses', 'valid', 'validations/s'))
+    total = total_elapsed = 0
+    for name, encoded in generated.items():
+        timer = time.time()
+        results = [address.validate_address(a, address_settings) for a in encoded]
+        elapsed = max(time.time() - timer, 1e-9)
+        valid = sum(1 for result in results if result['isvalid'])
+        if (name == 'invalid' and valid > len(encoded) * 0.01) or (name != 'invalid' and valid != len(encoded)):
+            print("%s: unexpected number of valid addresses: %d of %d" % (name, valid, len(encoded)))
+            return 1
+        print("%-10s %10d %10d %14d" % (name, len(encoded), valid, len(encoded) / elapsed))
+        total += len(encoded)
+        total_elapsed += elapsed
+    print("%-10s %10d %10s %14d" % ('total', total, '', total / total_elapsed))
+
+    if args.compare:
+        fields = ['isvalid', 'address', 'scriptPubKey', 'isscript', 'iswitness', 'witness_version', 'witness_program']
+        mismatches = 0
+        timer = time.time()
+        sample = random.sample([a for encoded in generated.values() for a in encoded], min(args.compare, total))
+        for encoded in sample:
+            validated = address.validate_address(encoded, address_settings)
+            expected = rpc.rpc_request(method='validateaddress', parameters=[encoded])
+            differences = {field: (validated.get(field), expected.get(field)) for field in fields
+                           if validated.get(field) != expected.get(field)}
+            if differences:
+                mismatches += 1
+                print("%s: %s" % (encoded, differences))
+        print("compared %d addresses with validateaddress in %s seconds: %d mismatches" % (
+            len(sample), utils.elapsed(timer), mismatches))
+        if mismatches:
+            return 1
+    return 0
+
+def main(args):
+    # Run against the CSV files of a previous extraction, writing all files to a benchmark directory.
+    source_path = utils.working_path()
+    if args.subparser_name == 'codecs':
+        return codecs(args, source_path)
+    if args.subparser_name == 'addresses':
+        return addresses(args)
+    globals.metadata_file = source_path + "metadata"
+    globals.metadata = extract.read_metadata()
+    if 'extract_blockchain' not in globals.metadata:
+        print("no extracted CSV files found in %s" % source_path)
+        return 1
+    args.working_path = source_path + "benchmark/"
+    os.makedirs(args.working_path, exist_ok=True)
+    for file in extract.get_extract_files():
+        link = args.working_path + file + '.csv.gz'
+        if not os.path.lexists(link):
+            os.symlink(os.path.abspath(source_path + file + '.csv.gz'), link)
+
+    if args.subparser_name == 'partitions':
+        return partitions(args)
+
+if __name__ == '__main__':
+    globals.init()
+    globals.settings = settings
+    globals.notify = {}
+    globals.snapshot_memory = False
+    globals.snapshot_timer = 300
+    parser = argparse.ArgumentParser(description="Benchmark the extract pipeline")
+    parser.add_argument('-t', '--type', help="coin type", type=str, choices=utils.supported_coins(settings),
+                        required=True)
+    parser.add_argument('-v', dest='verbose', action='count', help="verbose output")
+    parser.add_argument('--working', help="full path to working directory of the extraction", type=str)
+    parser.add_argument('--compress-level', help="compress level for temporary files (0-9, defaults to 6)", type=int,
+                        default=6)
+    subparsers = parser.add_subparsers(dest='subparser_name', help="BENCHMARKS", required=True)
+    subparser = subparsers.add_parser('partitions', help="Compare sorting the extracted files with hash partitioning"
+                                                         " them.")
+    subparser.add_argument('--partitions', help="number of hash partitions per table", type=int, default=16)
+    subparser.add_argument('--workers', help="number of processes loading partitions in parallel", type=int,
+                           default=os.cpu_count() or 1)
+    subparser = subparsers.add_parser('codecs', help="Compare the codecs of the data column on the rows written by "
+                                                     "the load phases.")
+    subparser.add_argument('--rows', help="maximum number of rows per table", type=int, default=100000)
+    subparser = subparsers.add_parser('addresses', help="Measure the throughput of the offline address validation.")
+    subparser.add_argument('--addresses', help="number of addresses generated per address type", type=int,
+                           default=100000)
+    subparser.add_argument('--compare', help="number of addresses also validated by the coin daemon, to compare the "
+                                             "results", type=int, default=0)
+    globals.args = parser.parse_args()
+    globals.args.initial = True
+    exit(main(globals.args))
@@ -0,0 +1,84 @@
+import argparse
+import os
+import random
+import tempfile
+import unittest
+
+from fixtures import synthetic
+from include import blockfiles
+from include import globals
+import settings
+
+
+class BlockFilesTestCase(unittest.TestCase):
+    def setUp(self):
+        globals.init()
+        globals.settings = settings
+        globals.args = argparse.Namespace(verbose=0, blocks_dir=None)
+        self.directory = tempfile.TemporaryDirectory()
+        self.blocks_dir = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, coin, blocks, **kwargs):
+        synthetic.write_block_files(self.blocks_dir, blockfiles.get_magic(coin), [raw for raw, _ in blocks], **kwargs)
+
+    def best_chain(self, coin='bitcoin'):
+        return [hash[::-1].hex() for hash in blockfiles.load_chain(coin, self.blocks_dir)['chain']]
+
+    def test_each_coin(self):
+        # Blocks are read back with each coin's magic, from obfuscated and preallocated files.
+        for coin in settings.coins:
+            with self.subTest(coin=coin):
+                self.directory.cleanup()
+                self.directory = tempfile.TemporaryDirectory()
+                self.blocks_dir = self.directory.name
+                blocks = synthetic.chain(5)
+                self.write(coin, blocks, blocks_per_file=2, xor_key=os.urandom(8), preallocate=1000)
+                chain = blockfiles.load_chain(coin, self.blocks_dir)
+                self.assertEqual([hash[::-1].hex() for hash in chain['chain']], [hash for _, hash in blocks])
+                read = list(blockfiles.read_blocks(coin, chain))
+                self.assertEqual([block['hash'] for block in read], [hash for _, hash in blocks])
+                self.assertEqual([block['height'] for block in read], list(range(5)))
+
+    def test_other_magic_skipped(self):
+        # Blocks framed with another network's magic aren't indexed.
+        self.write('bitcoin_testnet3', synthetic.chain(3))
+        self.assertEqual(self.best_chain('bitcoin'), [])
+
+    def test_out_of_order(self):
+        blocks = synthetic.chain(10)
+        shuffled = list(blocks)
+        random.Random(1).shuffle(shuffled)
+        self.write('bitcoin', shuffled, blocks_per_file=3)
+        self.assertEqual(self.best_chain(), [hash for _, hash in blocks])
+
+    def test_shorter_fork(self):
+        main = synthetic.chain(6)
+        fork = synthetic.chain(2, previous_hash=main[2][1], tag=b'fork')
+        self.write('bitcoin', main[:4] + fork + main[4:])
+        self.assertEqual(self.best_chain(), [hash for _, hash in main])
+
+    def test_longer_fork(self):
+        main = synthetic.chain(6)
+        fork = synthetic.chain(5, previous_hash=main[2][1], tag=b'fork')
+        self.write('bitcoin', fork + main)
+        self.assertEqual(self.best_chain(), [hash for _, hash in main[:3] + fork])
+
+    def test_most_work(self):
+        # A shorter fork with more work per block is the best chain.
+        main = synthetic.chain(6)
+        fork = synthetic.chain(2, previous_hash=main[2][1], bits=0x1f00ffff, tag=b'fork')
+        self.write('bitcoin', main + fork)
+        self.assertEqual(self.best_chain(), [hash for _, hash in main[:3] + fork])
+
+    def test_orphan(self):
+        # Blocks whose parent isn't in the block files are never part of the best chain, however long.
+        main = synthetic.chain(3)
+        orphans = synthetic.chain(5, previous_hash='11' * 32, tag=b'orphan')
+        self.write('bitcoin', orphans + main)
+        self.assertEqual(self.best_chain(), [hash for _, hash in main])
+
+if __name__ == '__main__':
+    unittest.main()
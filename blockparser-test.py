@@ -0,0 +1,70 @@
+import csv
+import io
+import json
+import os
+import unittest
+
+from include import address
+from include import blockparser
+from include import globals
+import extract
+import settings
+
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'blocks.json')
+
+def csv_streams(block):
+    '''
+    The six CSV files extract.py writes for a block, as strings.
+    '''
+    streams = {file: io.StringIO() for file in extract.get_extract_files()}
+    writers = {file: csv.writer(stream) for file, stream in streams.items()}
+    for file, row in extract.block_rows(block):
+        writers[file].writerow(row)
+    return {file: stream.getvalue() for file, stream in streams.items()}
+
+
+class BlockParserTestCase(unittest.TestCase):
+    def setUp(self):
+        globals.init()
+        globals.settings = settings
+        # Fixture blocks are generated with fixtures/make-blocks.py.
+        with open(FIXTURE) as f:
+            self.blocks = json.load(f)
+
+    def parse(self, fixture):
+        return blockparser.parse_block(bytes.fromhex(fixture['raw']), fixture['height'],
+                                       address.get_address_settings(fixture['coin']),
+                                       auxpow=settings.coins[fixture['coin']].get('auxpow', False))
+
+    def test_csv_identical(self):
+        for fixture in self.blocks:
+            raw_streams = csv_streams(self.parse(fixture))
+            json_streams = csv_streams(fixture['json'])
+            for file in extract.get_extract_files():
+                self.assertEqual(raw_streams[file], json_streams[file],
+                                 "%s rows of block %d differ" % (file, fixture['height']))
+
+    def test_fixture_coverage(self):
+        # The fixture exercises P2PK, bech32 (witness v0) and bech32m (witness v1+) outputs and a segwit txid.
+        addresses = set()
+        for fixture in self.blocks:
+            for row in csv.reader(io.StringIO(csv_streams(self.parse(fixture))['address'])):
+                addresses.add(row[0])
+        for expected in ('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa', 'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4',
+                         'bc1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3qccfmv3',
+                         'bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqzk5jj0', 'bc1sw50qgdz25j',
+                         'bc1zw508d6qejxtdg4y5r3zarvaryvaxxpcs'):
+            self.assertIn(expected, addresses)
+
+    def test_genesis(self):
+        block = self.parse(self.blocks[0])
+        self.assertEqual(block['hash'], '000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f')
+        self.assertEqual(block['tx'][0]['txid'], '4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b')
+
+    def test_witness_excluded_from_txid(self):
+        block = self.parse(self.blocks[1])
+        self.assertEqual([tx['txid'] for tx in block['tx']], [tx['txid'] for tx in self.blocks[1]['json']['tx']])
+
+if __name__ == '__main__':
+    unittest.main()
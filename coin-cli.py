@@ -1,4 +1,6 @@
 import argparse
+import json
+import sys
 
 # Custom libraries:
 from include import utils
@@ -7,7 +9,25 @@ from include import globals
 import settings
 
 
+def batch(args):
+    '''
+    Invoke a batch of RPC commands, read as a JSON array of [method, [parameters]] pairs.
+    '''
+    if args.file == '-':
+        calls = json.load(sys.stdin)
+    else:
+        with open(args.file) as f_batch:
+            calls = json.load(f_batch)
+    utils.vprint("invoking batch of %d RPC commands against %s daemon" % (len(calls), args.type))
+
+    responses = rpc.rpc_batch([(call[0], call[1] if len(call) > 1 else []) for call in calls],
+                              batch_size=args.batch_size)
+    print(json.dumps(responses, indent=2))
+
 def main(args):
+    if args.subparser_name == 'batch':
+        return batch(args)
+
     utils.vprint("invoking RPC command against %s daemon" % (args.type))
     # @TODO: support parameters
 
@@ -46,6 +66,10 @@ if __name__ == '__main__':
             else:
                 format = str
             subparser.add_argument("--" + parameter['parameter'], help=parameter['description'], type=format, required=parameter['required'])
+    subparser = subparsers.add_parser('batch', help="Invoke many RPC commands in JSON-RPC batches, reading a JSON array"
+                                                    " of [method, [parameters]] pairs.")
+    subparser.add_argument('--file', help="file containing the batch ('-' to read from stdin)", type=str, default='-')
+    subparser.add_argument('--batch-size', help="maximum number of commands sent per request", type=int)
     globals.args = parser.parse_args()
     utils.vprint("starting ...")
     rc = main(globals.args)
@@ -0,0 +1,48 @@
+'''
+Fold the address deltas appended while processing new blocks into the address table.
+
+Can run in the background while extract.py is processing blocks, for example from cron.
+'''
+import time
+import argparse
+import logging
+
+# Custom libraries:
+from include import dbutils
+from include import lookup
+from include import rowcache
+from include import utils
+from include import globals
+import settings
+
+
+def main(args):
+    start = time.time()
+    addresses = dbutils.get_address_deltas(args.type, min_deltas=args.min_deltas, limit=args.limit)
+    utils.vprint("compacting %d addresses with at least %d deltas" % (len(addresses), args.min_deltas))
+    folded = 0
+    for address, deltas in addresses:
+        utils.vprint(" > compacting %s (%d deltas)" % (address, deltas), level=2)
+        folded += dbutils.compact_address(args.type, address)
+    if folded:
+        state = rowcache.publish(args.type, 'compact')
+        if lookup.is_enabled(args.type):
+            # The API merges the deltas that are left with the indexed addresses, so it needs the compacted addresses.
+            lookup.build(args.type, dbutils.select_ordered, tables=['address'], state=state)
+    dbutils.close_database_connection(args.type)
+    utils.vprint("folded %d deltas into %d addresses in %s seconds" % (folded, len(addresses), utils.elapsed(start)))
+    logging.info("folded %d deltas into %d addresses in %s seconds" % (folded, len(addresses),
+                                                                       utils.elapsed(start)))
+
+if __name__ == '__main__':
+    globals.init()
+    globals.settings = settings
+    parser = argparse.ArgumentParser(description="Compact address deltas.")
+    parser.add_argument('-t', '--type', help="coin type", type=str, choices=utils.supported_coins(settings),
+                        required=True)
+    parser.add_argument('--min-deltas', help="only compact addresses with at least this many deltas (defaults to 1)",
+                        type=int, default=1)
+    parser.add_argument('-l', '--limit', help="maximum number of addresses to compact", type=int)
+    parser.add_argument('-v', dest='verbose', action='count', help="verbose output")
+    globals.args = parser.parse_args()
+    main(globals.args)
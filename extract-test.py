@@ -0,0 +1,48 @@
+import argparse
+import unittest
+
+from include import globals
+import extract
+import settings
+
+
+class PhasesTestCase(unittest.TestCase):
+    def setUp(self):
+        globals.init()
+        globals.settings = settings
+        globals.metadata = {}
+        self.run = []
+        self.original = extract.run_phase, extract.write_metadata
+        extract.run_phase = lambda args, phase, phase_counter: self.run.append((phase.__name__, phase_counter)) or True
+        extract.write_metadata = lambda: None
+
+    def tearDown(self):
+        extract.run_phase, extract.write_metadata = self.original
+
+    def run_phases(self, phase=None, single=False):
+        args = argparse.Namespace(phase=phase, single=single, phase_concurrency=1, verbose=0)
+        globals.args = args
+        phases, first_phase = extract.select_phases(args)
+        extract.run_phases(args, phases, first_phase)
+        return self.run
+
+    def test_all(self):
+        names = extract.get_phases(as_strings=True)
+        self.assertEqual(self.run_phases(), list(zip(names, range(1, len(names) + 1))))
+
+    def test_phase(self):
+        # Phases before the selected one aren't run, and the selected one keeps its number.
+        names = extract.get_phases(as_strings=True)
+        first = names.index('load_address')
+        self.assertEqual(self.run_phases(phase='load_address'),
+                         list(zip(names[first:], range(first + 1, len(names) + 1))))
+
+    def test_single(self):
+        first = extract.get_phases(as_strings=True).index('load_address')
+        self.assertEqual(self.run_phases(phase='load_address', single=True), [('load_address', first + 1)])
+
+    def test_single_first_phase(self):
+        self.assertEqual(self.run_phases(single=True), [('extract_blockchain', 1)])
+
+if __name__ == '__main__':
+    unittest.main()
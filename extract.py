@@ -1,21 +1,34 @@
 import argparse
+import concurrent.futures
+import contextlib
 import os
 import gzip
 import csv
+import functools
 import json
 import pathlib
 import logging
+import multiprocessing
+import shutil
 import time
+import zlib
 from decimal import Decimal
 
 # Libraries that must be installed:
 from tqdm import tqdm
-import requests
 
 # Custom libraries:
 from include import utils
 from include import dbutils
 from include import rpc
+from include import prefetch
+from include import blockfiles
+from include import chaintip
+from include import codec
+from include import lookup
+from include import rowcache
+from include import sort
+from include import transport
 from include import globals
 import settings
 
@@ -54,148 +67,385 @@ def write_metadata():
         utils.vprint("writing cache metadata to %s" % globals.metadata_file, level=2)
         json.dump(globals.metadata, f_cache_metadata, indent=2)
 
-def extract_blockchain(args):
+def block_rows(block):
     '''
-    Connect to the coin daemon and extract all blocks via REST requests.
+    Generate the CSV rows extracted from a single block.
 
-    This is the first step in building a searchable database of all addresses in the blockchain. It steps through the
-    entire blockchain and writes data to several CSV files which we later import into a key-value store.
+    :param block: the block, either decoded from the daemon's JSON output or parsed from a raw block.
+    :return: generator of (file, row) tuples.
+    '''
+    for tx in block['tx']:
+        vin_count = len(tx['vin'])
+        vout_count = len(tx['vout'])
+        yield 'block', [block['hash'], tx['txid'], block['height'], block['time'], vin_count, vout_count]
 
-    :param args: Arguments used to invoke extract script.
-    :return: True or False, indicating success.
+        for vout in tx['vout']:
+            try:
+                addresses = vout['scriptPubKey']['addresses']
+            except Exception as e:
+                # https://bitcoin.stackexchange.com/questions/60463/segwit-bitcoin-json-rpc-and-strange-addresses
+                # https://github.com/bitcoin/bips/blob/master/bip-0173.mediawiki
+                yield 'vout', [tx['txid'], vout['n'], 'unknown', vout['value'], block['height'], block['hash'],
+                               block['time'], vin_count, vout_count]
+                # I don't think there's much value in lumping all these undecipherable addresses into
+                # a single bucket in the database. Instead we just ignore them, leaving them only in
+                # their specific transactions.
+                #yield 'address', ['unknown', tx['txid'], vout['n'], vout['value'], block['height'], block['time']]
+                continue
+
+            for address in addresses:
+                # Group by txid, we will use this to process vin (looking up spent).
+                yield 'vout', [tx['txid'], vout['n'], address, vout['value'], block['height'], block['hash'],
+                               block['time'], vin_count, vout_count]
+                # Group by address, we will use this to find txids.
+                yield 'address', [address, tx['txid'], vout['n'], vout['value'], block['height'], block['time']]
+
+        vin_n = 0
+        for vin in tx['vin']:
+            try:
+                # Spent are most common, so try them first.
+                spent = vin['txid']
+                vout = vin['vout']
+                yield 'vin_spent', [spent, vout, tx['txid'], vin_n, block['time'], block['height']]
+                yield 'vin_txid', [tx['txid'], vin_n, spent, vout, block['time'], block['height']]
+            except:
+                coinbase = vin['coinbase']
+                # Coinbase transaction always has exactly one vin.
+                yield 'coinbase', [tx['txid'], coinbase, vin_n, block['time'], block['height']]
+                assert len(tx['vin']) == 1
+            vin_n += 1
+
+def validate_raw_block(block):
     '''
-    utils.vprint("extract %s blockchain from REST server: %s" % (args.type, settings.coins[args.type]['server']))
-    logging.info("extract %s blockchain from REST server: %s" % (args.type, settings.coins[args.type]['server']))
+    Compare the rows extracted from a parsed raw block with the rows extracted from the daemon's JSON output.
 
-    utils.memory_snapshot()
-    timer = time.time()
+    :param block: the block parsed from the raw block.
+    :return: True if the rows are identical.
+    '''
+    json_block = utils.request_block(block['hash'], settings)
+    raw_rows = list(block_rows(block))
+    json_rows = list(block_rows(json_block))
+    if raw_rows == json_rows:
+        return True
+
+    for raw_row, json_row in zip(raw_rows, json_rows):
+        if raw_row != json_row:
+            print("raw block row:  %s" % (raw_row,))
+            print("json block row: %s" % (json_row,))
+            break
+    print("INVALID DATA: raw block %s (%d rows) doesn't match JSON block (%d rows)" % (block['hash'], len(raw_rows),
+                                                                                     len(json_rows)))
+    logging.critical("INVALID DATA: raw block %s doesn't match JSON block" % (block['hash'],))
+    return False
+
+def run_worker(function, *args):
+    '''
+    Call a function in a pool worker process. exit() in a worker (for example after a failed query in dbutils) raises
+    SystemExit, which stops the worker without returning a result, so the parent would wait for it forever: it's
+    raised as a RuntimeError instead, which the pool passes on to the parent.
+    '''
+    try:
+        return function(*args)
+    except SystemExit as e:
+        raise RuntimeError("%s() exited with status %s" % (function.__name__, e.code))
 
-    if args.limit:
-        blocks = args.limit
+def extract_shard(shard):
+    '''
+    Extract a range of blocks, writing the six CSV files with the shard's suffix.
+
+    :param shard: dictionary with the first and last height of the shard, the height of the chain tip, the suffix
+      appended to the CSV file names, the position of the progress bar and the hash the first block must follow.
+    :return: dictionary with the number of lines written to each file and details about the last block extracted,
+      and an error if a raw block failed validation.
+    '''
+    args = globals.args
+    start = timer = time.time()
+    if args.blocks_dir:
+        # Blocks are read from local files, there are no requests to queue.
+        blocks = ((block, 0) for block in blockfiles.read_blocks(args.type, globals.block_chain, shard['start'],
+                                                                  shard['end']))
     else:
-        chaininfo = utils.request_chaininfo(settings)
-        blocks = chaininfo['blocks']
+        blocks = prefetch.prefetch_blocks(shard['start'], shard['end'], concurrency=args.fetch_concurrency,
+                                          window=args.prefetch_window, raw=args.raw_blocks)
+
     # tx-vin, address-vout, tx-vout and block are used to build a local database of blockchain data.
     # types simply tracks all the different script-types we see in the blockchain.
     # segwit logs all segregated witness transactions seen in the blockchain.
-    with gzip.open(args.working_path + "vin_spent.csv.gz", "wt", compresslevel=args.compress_level) as f_tx_vin_spent, \
-            gzip.open(args.working_path + "vin_txid.csv.gz", "wt", compresslevel=args.compress_level) as f_tx_vin_txid, \
-            gzip.open(args.working_path + "coinbase.csv.gz", "wt", compresslevel=args.compress_level) as f_tx_coinbase, \
-            gzip.open(args.working_path + "vout.csv.gz", "wt", compresslevel=args.compress_level) as f_tx_vout, \
-            gzip.open(args.working_path + "address.csv.gz", "wt", compresslevel=args.compress_level) as f_address, \
-            gzip.open(args.working_path + "block.csv.gz", "wt", compresslevel=args.compress_level) as f_block:
-        txvin_lines = txcoinbase_lines = address_lines = txvout_lines = block_lines = 0
-        total_tx = 0
-        csv_tx_vin_spent = csv.writer(f_tx_vin_spent)
-        csv_tx_vin_txid = csv.writer(f_tx_vin_txid)
-        csv_tx_coinbase = csv.writer(f_tx_coinbase)
-        csv_address = csv.writer(f_address)
-        csv_tx_vout = csv.writer(f_tx_vout)
-        csv_block = csv.writer(f_block)
-
-        next = globals.next_block
-        print("starting with: ", next)
-        request_counter = 0
-        try:
-            total = blocks - globals.last_processed_block_height
-        except:
-            total = blocks
+    with contextlib.ExitStack() as stack:
+        csv_writers = {}
+        lines = {}
+        for file, paths in get_extract_paths(args).items():
+            csv_writers[file] = []
+            for path in paths:
+                f_csv = stack.enter_context(gzip.open(path + shard['suffix'], "wt", compresslevel=args.compress_level))
+                csv_writers[file].append(csv.writer(f_csv))
+            lines[file] = 0
+        block_lines = total_tx = 0
+
+        first_previous_hash = last_block = last_height = notify = error = None
+        # Each block must follow the previous one, otherwise the chain was reorganized while extracting.
+        previous_hash = shard['previous_hash']
         # use tqdm to provide a progress bar: it's based on blocks so not generally accurate for time estimates
         # because blocks can be big or small, containing lots or few transactions.
-        with tqdm(total=total, desc=args.type, unit='blk', unit_scale=True, dynamic_ncols=True, smoothing=0,
-                  miniters=1, mininterval=1.0) as pbar:
-            while next:
+        with tqdm(total=shard['end'] - shard['start'] + 1, desc=args.type + shard['suffix'], unit='blk',
+                  unit_scale=True, dynamic_ncols=True, smoothing=0, miniters=1, mininterval=1.0,
+                  position=shard['position']) as pbar:
+            for block, queue_depth in blocks:
                 if utils.elapsed(timer) >= globals.snapshot_timer:
                     utils.memory_snapshot("memory snapshot loop")
                     timer = time.time()
-                last_processed_block = next
-                block = utils.request_block(next, settings)
                 if block is None:
                     break
+                elif previous_hash and block.get('previousblockhash') != previous_hash:
+                    # The chain was reorganized while we were extracting: stop here, the orphaned blocks are
+                    # unwound the next time we run.
+                    utils.vprint("block %s doesn't follow %s, chain reorganized, stopping" % (block['hash'],
+                                                                                             previous_hash))
+                    logging.warning("block %s doesn't follow %s, chain reorganized, stopping" % (block['hash'],
+                                                                                                previous_hash))
+                    break
+                elif (args.raw_blocks or args.blocks_dir) and args.validate and not validate_raw_block(block):
+                    # The parent process exits once the other shards complete.
+                    error = "raw block %s doesn't match the JSON block" % (block['hash'],)
+                    break
                 else:
-                    assert block['hash'] == next
+                    if not block_lines:
+                        first_previous_hash = block.get('previousblockhash')
                     block_lines += 1
                     # track and visualize how many transactions we've extracted so far
                     total_tx += len(block['tx'])
-                    pbar.set_postfix(tx=total_tx, refresh=False)
+                    pbar.set_postfix(tx=total_tx, bps="%.1f" % (block_lines / max(utils.elapsed(start, 3), 0.001)),
+                                     queue=queue_depth, refresh=False)
                     pbar.update(1)
-                    for tx in block['tx']:
-                        vin_count = len(tx['vin'])
-                        vout_count = len(tx['vout'])
-                        csv_block.writerow([block['hash'], tx['txid'], block['height'], block['time'],
-                                            vin_count, vout_count])
-
-                        for vout in tx['vout']:
-                            try:
-                                for address in vout['scriptPubKey']['addresses']:
-                                    # Group by txid, we will use this to process vin (looking up spent).
-                                    csv_tx_vout.writerow(
-                                        [tx['txid'], vout['n'], address, vout['value'], block['height'],
-                                         block['hash'], block['time'], vin_count, vout_count])
-                                    # Group by address, we will use this to find txids.
-                                    csv_address.writerow([address, tx['txid'], vout['n'], vout['value'], block['height'], block['time']])
-                                    txvout_lines += 1
-                                    address_lines += 1
-
-                            except Exception as e:
-                                # https://bitcoin.stackexchange.com/questions/60463/segwit-bitcoin-json-rpc-and-strange-addresses
-                                # https://github.com/bitcoin/bips/blob/master/bip-0173.mediawiki
-                                csv_tx_vout.writerow(
-                                    [tx['txid'], vout['n'], 'unknown', vout['value'], block['height'], block['hash'],
-                                     block['time'], vin_count, vout_count])
-                                # I don't think there's much value in lumping all these undecipherable addresses into
-                                # a single bucket in the database. Instead we just ignore them, leaving them only in
-                                # their specific transactions.
-                                #csv_address.writerow(['unknown', tx['txid'], vout['n'], vout['value'], block['height'], block['time']])
-                                txvout_lines += 1
-                                address_lines += 1
-
-                        vin_n = 0
-                        for vin in tx['vin']:
-                            try:
-                                # Spent are most common, so try them first.
-                                spent = vin['txid']
-                                vout = vin['vout']
-                                csv_tx_vin_spent.writerow([spent, vout, tx['txid'], vin_n, block['time'], block['height']])
-                                csv_tx_vin_txid.writerow([tx['txid'], vin_n, spent, vout, block['time'], block['height']])
-                                txvin_lines += 1
-                            except:
-                                coinbase = vin['coinbase']
-                                # Coinbase transaction always has exactly one vin.
-                                csv_tx_coinbase.writerow([tx['txid'], coinbase, vin_n, block['time'], block['height']])
-                                txcoinbase_lines += 1
-                                assert len(tx['vin']) == 1
-                            vin_n += 1
-
-                    request_counter += 1
-                    if args.limit and request_counter >= args.limit:
-                        utils.vprint("requested limit of %d blocks, finished" % (args.limit,))
-                        break
+                    for file, row in block_rows(block):
+                        writers = csv_writers[file]
+                        if len(writers) > 1:
+                            writers[get_partition(row[0], len(writers))].writerow(row)
+                        else:
+                            writers[0].writerow(row)
+                        lines[file] += 1
+
+                    last_block = previous_hash = block['hash']
+                    last_height = block['height']
                     utils.vprint("lines: txvout(%d) txvin(%d) txcoinbase(%d) address(%d) block(%d)" %
-                                 (txvout_lines, txvin_lines, txcoinbase_lines, address_lines, block_lines), level=5)
-
-                    if block and "nextblockhash" in block:
-                        next = block["nextblockhash"]
-                    else:
-                        next = False
-                        if not globals.args.initial:
-                            globals.notify = {
-                                'height': block['height'],
-                                'hash': block['hash'],
-                                'timestamp': block['time'],
-                                'addresses': [],
-                            }
+                                 (lines['vout'], lines['vin_spent'], lines['coinbase'], lines['address'],
+                                  lines['block']), level=5)
+
+                    # Raw blocks don't include nextblockhash, so compare with the chain tip instead.
+                    if block['height'] >= shard['tip'] and not globals.args.initial:
+                        notify = {
+                            'height': block['height'],
+                            'hash': block['hash'],
+                            'timestamp': block['time'],
+                            'addresses': [],
+                        }
+
+    return {
+        'lines': lines,
+        'blocks': block_lines,
+        'error': error,
+        'first-previous-block': first_previous_hash,
+        'last-block': last_block,
+        'last-height': last_height,
+        'complete': last_height == shard['end'],
+        'notify': notify,
+    }
+
+def check_shards(results):
+    '''
+    Exit if a shard failed, once all shards returned.
+    '''
+    errors = [result['error'] for result in results if result['error']]
+    for error in errors:
+        print("INVALID DATA: %s" % (error,))
+        logging.critical("INVALID DATA: %s" % (error,))
+    if errors:
+        exit(1)
+
+def get_extract_files():
+    return ['vin_spent', 'vin_txid', 'coinbase', 'vout', 'address', 'block']
+
+def get_partition(key, partitions):
+    '''
+    Hash partition of a row, based on the key rows are grouped by when loading them (the first column).
+    '''
+    return zlib.crc32(str(key).encode()) % partitions
+
+def partition_path(file, partition):
+    return globals.args.working_path + file + ".part-%03d.csv.gz" % partition
+
+def get_extract_paths(args):
+    '''
+    The CSV files written when extracting the blockchain: a single file per table which is sorted before loading,
+    or with --partitions one file per hash partition, each of which is sorted in memory while loading.
+
+    :param args: Arguments used to invoke extract script.
+    :return: dictionary mapping each table to the list of files its rows are written to.
+    '''
+    paths = {}
+    for file in get_extract_files():
+        if args.partitions:
+            paths[file] = [partition_path(file, partition) for partition in range(args.partitions)]
+        else:
+            paths[file] = [args.working_path + file + ".csv.gz"]
+    return paths
+
+def get_partitions():
+    '''
+    The number of hash partitions the last extraction wrote, or 0 if it wrote a single file per table.
+    '''
+    try:
+        return globals.metadata["extract_blockchain"].get("partitions", 0)
+    except:
+        return 0
+
+def merge_shards(args, shards):
+    '''
+    Merge the CSV files written by each shard into a single set of CSV files.
+
+    A gzip file may contain multiple members, so the compressed shards are simply concatenated in height order.
+
+    :param args: Arguments used to invoke extract script.
+    :param shards: list of shards to merge, in height order.
+    :return: None
+    '''
+    for paths in get_extract_paths(args).values():
+        for destination_file in paths:
+            utils.vprint("merging %d shards into %s" % (len(shards), destination_file), level=2)
+            with open(destination_file, 'wb') as f_destination:
+                for shard in shards:
+                    with open(destination_file + shard['suffix'], 'rb') as f_shard:
+                        shutil.copyfileobj(f_shard, f_destination)
+
+    # Remove all shards, including any that were not merged.
+    path = pathlib.Path(args.working_path)
+    for p in path.glob("*.gz.shard-*"):
+        p.unlink()
+
+def extract_blockchain(args):
+    '''
+    Connect to the coin daemon and extract all blocks via REST requests.
+
+    This is the first step in building a searchable database of all addresses in the blockchain. It steps through the
+    entire blockchain and writes data to several CSV files which we later import into a key-value store.
+
+    With --workers the range of heights is split into shards that are extracted in parallel by a pool of processes,
+    each writing its own CSV files, which are merged once all shards are extracted.
+
+    :param args: Arguments used to invoke extract script.
+    :return: True or False, indicating success.
+    '''
+    if args.blocks_dir:
+        utils.vprint("extract %s blockchain from block files: %s" % (args.type, args.blocks_dir))
+        logging.info("extract %s blockchain from block files: %s" % (args.type, args.blocks_dir))
+    else:
+        utils.vprint("extract %s blockchain from REST server: %s" % (args.type, settings.coins[args.type]['server']))
+        logging.info("extract %s blockchain from REST server: %s" % (args.type, settings.coins[args.type]['server']))
+
+    utils.memory_snapshot()
+
+    # Determine the range of heights to extract.
+    start_height = globals.next_block_height
+    if args.blocks_dir:
+        globals.block_chain = blockfiles.load_chain(args.type, args.blocks_dir)
+        tip_height = len(globals.block_chain['chain']) - 1
+        tip_hash = globals.block_chain['chain'][-1][::-1].hex() if globals.block_chain['chain'] else None
+    else:
+        chaininfo = utils.request_chaininfo(settings)
+        tip_height = chaininfo['blocks']
+        tip_hash = chaininfo['bestblockhash']
+    tip_read = time.time()
+    end_height = tip_height
+    if args.limit:
+        end_height = min(end_height, start_height + args.limit - 1)
+
+    print("starting with: ", globals.next_block)
+    # If no new blocks are processed, the last processed block doesn't change.
+    try:
+        last_processed_block = globals.metadata["extract_blockchain"]["last-processed-block"]
+    except:
+        last_processed_block = None
+    previous_hash = None if globals.args.initial else last_processed_block
+
+    total = max(0, end_height - start_height + 1)
+    if args.workers > 1 and total > 1:
+        # Early blocks are much smaller than recent blocks, so split into more shards than workers to balance the
+        # work: each worker picks up the next shard as soon as it finishes the previous one.
+        shard_count = min(args.workers * 4, total)
+        shards = []
+        for n in range(shard_count):
+            shards.append({
+                'start': start_height + total * n // shard_count,
+                'end': start_height + total * (n + 1) // shard_count - 1,
+                'tip': tip_height,
+                'suffix': '.shard-%03d' % n,
+                'position': n % args.workers,
+                'previous_hash': previous_hash if n == 0 else None,
+            })
+        utils.vprint("extracting %d blocks in %d shards with %d workers" % (total, shard_count, args.workers))
+        with multiprocessing.get_context('fork').Pool(processes=args.workers) as pool:
+            try:
+                results = pool.map(functools.partial(run_worker, extract_shard), shards)
+            except Exception as e:
+                utils.vprint("extracting shards failed: %s" % (e,))
+                logging.critical("extracting shards failed: %s" % (e,))
+                exit(1)
+        check_shards(results)
+
+        # Only merge shards that follow on from each other without a gap: if a shard stopped early (for example
+        # because the chain was reorganized) the following shards are discarded and extracted again next time.
+        merged = []
+        for shard, result in zip(shards, results):
+            previous_result = merged[-1][1] if merged else None
+            if previous_result and (not previous_result['complete'] or
+                                    result['first-previous-block'] != previous_result['last-block']):
+                utils.vprint("shard %s doesn't follow the previous shard, discarding remaining shards" %
+                             shard['suffix'])
+                logging.warning("shard %s doesn't follow the previous shard, discarding remaining shards" %
+                                shard['suffix'])
+                break
+            if result['last-block'] is None:
+                break
+            merged.append((shard, result))
+        merge_shards(args, [shard for shard, _ in merged])
+        results = [result for _, result in merged]
+    else:
+        results = [extract_shard({
+            'start': start_height,
+            'end': end_height,
+            'tip': tip_height,
+            'suffix': '',
+            'position': 0,
+            'previous_hash': previous_hash,
+        })]
+        check_shards(results)
+
+    lines = {}
+    for file in get_extract_files():
+        lines[file] = sum(result['lines'][file] for result in results)
+    for result in results:
+        if result['last-block']:
+            last_processed_block = result['last-block']
+        if result['notify']:
+            globals.notify = result['notify']
+
+    # The block file has a row per transaction.
+    if args.limit and sum(result['blocks'] for result in results) >= args.limit:
+        utils.vprint("requested limit of %d blocks, finished" % (args.limit,))
 
     # If we got here, this phase completed successfully.
     return {
-        'vout': txvout_lines,
-        'vin_spent': txvin_lines,
-        'vin_txid': txvin_lines,
-        'coinbase': txcoinbase_lines,
-        'address': address_lines,
-        'block': block_lines,
+        'vout': lines['vout'],
+        'vin_spent': lines['vin_spent'],
+        'vin_txid': lines['vin_txid'],
+        'coinbase': lines['coinbase'],
+        'address': lines['address'],
+        'block': lines['block'],
         'last-processed-block': last_processed_block,
+        # The daemon's tip when the extraction started, published for the API.
+        'chain-tip': {'height': tip_height, 'hash': tip_hash, 'read': tip_read},
         'limit': args.limit,
+        'partitions': args.partitions,
     }
 
 def sort_files(args):
@@ -209,13 +459,134 @@ def sort_files(args):
     :return: True or False, indicating success.
     '''
     # Phase 2: sort the extracted transaction CSV files
+    if get_partitions():
+        # Each partition is sorted in memory while loading it.
+        utils.vprint("rows were extracted to %d hash partitions, nothing to sort" % (get_partitions(),))
+        return True
     utils.vprint("sort transaction CSV files extracted from blockchain")
+    files = []
     for file in ['vin_spent', 'vin_txid', 'vout', 'coinbase', 'address', 'block']:
         source_file = args.working_path + file + ".csv.gz"
         destination_file = args.working_path + file + "_sorted.csv.gz"
-        utils.gzipped_sort(source_file, destination_file, lines=globals.metadata["extract_blockchain"][file])
+        files.append((source_file, destination_file, globals.metadata["extract_blockchain"][file]))
+
+    if hasattr(settings, 'system_sort_command'):
+        # A custom sort command is configured in local settings.
+        for source_file, destination_file, lines in files:
+            utils.gzipped_sort(source_file, destination_file, lines=lines)
+        return True
+
+    try:
+        sort.sort_files(files, compress_level=args.compress_level)
+    except Exception as e:
+        utils.vprint("sort failed: %s" % (e,))
+        logging.critical("sort failed: %s" % (e,))
+        exit(1)
     return True
 
+def get_tsv_writer(f_tsv):
+    return csv.writer(f_tsv, delimiter='\t', quoting=csv.QUOTE_NONE, quotechar='', escapechar='\\')
+
+def load_rows(args, file, group, grouping, desc, unit, join=None, table=None):
+    '''
+    Group the rows extracted from the blockchain by key, writing the grouped rows to a tab separated file that is
+    then loaded into the database.
+
+    Rows are read from the sorted CSV file. If the rows were extracted to hash partitions instead, all rows with the
+    same key are in the same partition: a pool of worker processes sorts and groups one partition at a time in
+    memory, each writing its own tab separated file, and the files are then concatenated.
+
+    :param args: Arguments used to invoke extract script.
+    :param file: the name of the extracted CSV file (and of the table).
+    :param group: function grouping sorted rows, writing them with the provided csv writer.
+    :param grouping: description of the key rows are grouped by.
+    :param desc: description of the progress bar.
+    :param unit: unit of the progress bar.
+    :param join: optional name of another extracted CSV file, whose rows (sorted and partitioned the same way) are
+      passed to the group function to merge-join them.
+    :param table: optional name of the table the grouped rows are loaded into, if it isn't the name of the file.
+    :return: None
+    '''
+    destination_file = globals.args.working_path + (table or file) + '.csv'
+    partitions = get_partitions()
+    if not partitions:
+        source_file = args.working_path + file + '_sorted.csv.gz'
+        utils.vprint("processing %s, grouping by %s" % (source_file, grouping))
+        with open(destination_file, 'wt') as f_destination:
+            csv_writer = get_tsv_writer(f_destination)
+            with gzip.open(source_file, 'rt') as csvfile:
+                source_csv = csv.reader(csvfile)
+                group_args = [tqdm(iterable=source_csv, desc=desc, total=globals.metadata["extract_blockchain"][file],
+                                   unit=unit, unit_scale=True, dynamic_ncols=True, smoothing=0, miniters=1,
+                                   mininterval=1.0), csv_writer]
+                if join:
+                    with gzip.open(args.working_path + join + '_sorted.csv.gz', 'rt') as join_csvfile:
+                        group(*group_args, csv.reader(join_csvfile))
+                else:
+                    group(*group_args)
+        return
+
+    utils.vprint("processing %d partitions of %s, grouping by %s" % (partitions, file, grouping))
+    # Worker processes open their own database connections.
+    dbutils.close_database_connection(args.type)
+    with tqdm(total=globals.metadata["extract_blockchain"][file], desc=desc, unit=unit, unit_scale=True,
+              dynamic_ncols=True, smoothing=0, miniters=1, mininterval=1.0) as pbar, \
+            multiprocessing.get_context('fork').Pool(processes=max(1, args.workers)) as pool:
+        try:
+            for lines, addresses in pool.imap_unordered(functools.partial(run_worker, load_partition, file, table,
+                                                                          group, join), range(partitions)):
+                pbar.update(lines)
+                if 'addresses' in globals.notify:
+                    globals.notify['addresses'].extend(addresses)
+        except Exception as e:
+            utils.vprint("loading %s partitions failed: %s" % (file, e))
+            logging.critical("loading %s partitions failed: %s" % (file, e))
+            exit(1)
+
+    utils.vprint("merging %d partitions into %s" % (partitions, destination_file), level=2)
+    with open(destination_file, 'wb') as f_destination:
+        for partition in range(partitions):
+            path = destination_file + '.part-%03d' % partition
+            with open(path, 'rb') as f_partition:
+                shutil.copyfileobj(f_partition, f_destination)
+            os.unlink(path)
+
+def read_partition(file, partition):
+    '''
+    Read and sort a single hash partition in memory.
+
+    :return: tuple of (number of rows in the partition, csv reader of the sorted rows).
+    '''
+    with gzip.open(partition_path(file, partition), 'rb') as f_source:
+        lines = f_source.readlines()
+    # Sort the same way as the sorted CSV files, so rows with the same key are consecutive and grouped identically.
+    return len(lines), csv.reader(line.decode() for line in sorted(set(lines)))
+
+def load_partition(file, table, group, join, partition):
+    '''
+    Sort and group a single hash partition, in a worker process.
+
+    :param file: the name of the extracted CSV file.
+    :param table: optional name of the table the grouped rows are loaded into, see load_rows().
+    :param group: function grouping sorted rows.
+    :param join: optional name of another extracted CSV file to merge-join, see load_rows().
+    :param partition: the partition to process.
+    :return: tuple of (number of rows in the partition, addresses to notify).
+    '''
+    count, rows = read_partition(file, partition)
+    group_args = [rows]
+    # Addresses to notify are returned to the parent process.
+    if 'addresses' in globals.notify:
+        globals.notify['addresses'] = []
+    with open(globals.args.working_path + (table or file) + '.csv.part-%03d' % partition, 'wt') as f_destination:
+        group_args.append(get_tsv_writer(f_destination))
+        if join:
+            # Rows with the same key are in the partition with the same number.
+            group_args.append(read_partition(join, partition)[1])
+        group(*group_args)
+    dbutils.close_database_connection(globals.args.type)
+    return count, globals.notify.get('addresses', [])
+
 def load_transaction_vout(args):
     '''
     Load tx-vout-sorted CSV, grouping by txid and address.
@@ -227,69 +598,72 @@ def load_transaction_vout(args):
     :return: True or False, indicating success.
     '''
     utils.vprint("load sorted transaction vout data into the database")
+    load_rows(args, 'vout', group_transaction_vout, grouping='txid', desc='tx-vout', unit='txid')
+    if globals.args.initial:
+        dbutils.truncate_tables(coin=globals.args.type, tables=['vout'])
+    dbutils.load_data_infile(coin=globals.args.type, table='vout')
+    return True
+
+def group_transaction_vout(rows, csv_writer):
+    '''
+    Group tx-vout rows by txid, writing one row per txid.
+
+    :param rows: tx-vout rows, sorted by txid.
+    :param csv_writer: writer for the grouped rows.
+    :return: None
+    '''
     timer = time.time()
-    source_file = args.working_path + 'vout_sorted.csv.gz'
     tx_json = {}
-    utils.vprint("processing %s, grouping by txid" % (source_file,))
-    with open(globals.args.working_path + 'vout.csv', 'wt') as vout_csv:
-        csv_writer = csv.writer(vout_csv, delimiter='\t', quoting=csv.QUOTE_NONE, quotechar='', escapechar='\\')
-        with gzip.open(source_file, 'rt') as csvfile:
-            source_csv = csv.reader(csvfile)
-            for row in tqdm(iterable=source_csv, desc='tx-vout', total=globals.metadata["extract_blockchain"]['vout'],
-                            unit="txid", unit_scale=True, dynamic_ncols=True, smoothing=0, miniters=1, mininterval=1.0):
-                if utils.elapsed(timer) >= globals.snapshot_timer:
-                    utils.memory_snapshot("memory snapshot loop")
-                    timer = time.time()
-
-                (txid, n, address, value, height, block_hash, timestamp, vin_count, vout_count) = row
-                # Convert to integer
-                value = int(Decimal(value) * 100000000)
-                vout = {
-                    'value': value,
-                    'timestamp': timestamp,
+    for row in rows:
+        if utils.elapsed(timer) >= globals.snapshot_timer:
+            utils.memory_snapshot("memory snapshot loop")
+            timer = time.time()
+
+        (txid, n, address, value, height, block_hash, timestamp, vin_count, vout_count) = row
+        # Convert to integer
+        value = int(Decimal(value) * 100000000)
+        vout = {
+            'value': value,
+            'timestamp': timestamp,
+        }
+        if txid in tx_json:
+            if address in tx_json[txid]['addresses']:
+                if n in tx_json[txid]['addresses'][address]:
+                    utils.vprint("txid %s, address %s, n %s already exists, ignoring" % (txid, address, n))
+                else:
+                    # Add a new vout for an existing address.
+                    tx_json[txid]['addresses'][address][n] = vout
+            else:
+                tx_json[txid]['addresses'][address] = {
+                    n: vout,
                 }
-                if txid in tx_json:
-                    if address in tx_json[txid]['addresses']:
-                        if n in tx_json[txid]['addresses'][address]:
-                            utils.vprint("txid %s, address %s, n %s already exists, ignoring" % (txid, address, n))
-                        else:
-                            # Add a new vout for an existing address.
-                            tx_json[txid]['addresses'][address][n] = vout
-                    else:
-                        tx_json[txid]['addresses'][address] = {
+        else:
+            # New txid, write the old one
+            if tx_json:
+                old_txid, = tx_json.keys()
+                csv_writer.writerow([old_txid, codec.encode_tsv(globals.args.type, tx_json)])
+                del tx_json
+            tx_json = {
+                txid: {
+                    'height': height,
+                    'block_hash': block_hash,
+                    'timestamp': timestamp,
+                    'vin_count': vin_count,
+                    'vout_count': vout_count,
+                    'addresses': {
+                        address: {
                             n: vout,
-                        }
-                else:
-                    # New txid, write the old one
-                    if tx_json:
-                        old_txid, = tx_json.keys()
-                        csv_writer.writerow([old_txid, json.dumps(tx_json)])
-                        del tx_json
-                    tx_json = {
-                        txid: {
-                            'height': height,
-                            'block_hash': block_hash,
-                            'timestamp': timestamp,
-                            'vin_count': vin_count,
-                            'vout_count': vout_count,
-                            'addresses': {
-                                address: {
-                                    n: vout,
-                                },
-                            },
                         },
-                    }
-            # Write the last txid to database.
-            try:
-                last_txid, = tx_json.keys()
-                csv_writer.writerow([last_txid, json.dumps(tx_json)])
-            except:
-                # Empty file, safe to ignore.
-                pass
-    if globals.args.initial:
-        dbutils.truncate_tables(coin=globals.args.type, tables=['vout'])
-    dbutils.load_data_infile(coin=globals.args.type, table='vout')
-    return True
+                    },
+                },
+            }
+    # Write the last txid to database.
+    try:
+        last_txid, = tx_json.keys()
+        csv_writer.writerow([last_txid, codec.encode_tsv(globals.args.type, tx_json)])
+    except:
+        # Empty file, safe to ignore.
+        pass
 
 def load_transaction_vin_coinbase(args):
     '''
@@ -299,65 +673,73 @@ def load_transaction_vin_coinbase(args):
     :return: True or False, indicating success.
     '''
     utils.vprint("load sorted transaction vin coinbase data into the database")
-    timer = time.time()
-    source_file = args.working_path + 'coinbase_sorted.csv.gz'
-    utils.vprint("processing %s, grouping by txid" % (source_file,))
-    with open(globals.args.working_path + 'coinbase.csv', 'wt') as coinbase_csv:
-        csv_writer = csv.writer(coinbase_csv, delimiter='\t', quoting=csv.QUOTE_NONE, quotechar='', escapechar='\\')
-        with gzip.open(source_file, 'rt') as csvfile:
-            source_csv = csv.reader(csvfile)
-            for row in tqdm(iterable=source_csv, desc='coinbase', total=globals.metadata["extract_blockchain"]['coinbase'],
-                            unit="txid", unit_scale=True, dynamic_ncols=True, smoothing=0, miniters=1, mininterval=1.0):
-                if utils.elapsed(timer) >= globals.snapshot_timer:
-                    utils.memory_snapshot("memory snapshot loop")
-                    timer = time.time()
-                (txid, coinbase, vin_n, timestamp, height) = row
-                tx_data = dbutils.select(coin=globals.args.type, table='vout', key=txid)
-                try:
-                    # A transaction can only have a single txid, so we unwrap from the returned array.
-                    (vout_txid,) = tx_data.keys()
-                except Exception as e:
-                    print('tx_data', json.dumps(tx_data, indent=2, sort_keys=True))  # @DEBUG
-                    print("INVALID DATA: tx_data is empty for txid[%s] (%s)" % (txid, e))
-                    logging.warning("INVALID DATA: tx_data is empty for txid[%s] (%s)" % (txid, e))
-                    '''
-                    #exit(1)
-                    In litecoin_testnet4 we have to ignore these errors:
-                    INVALID DATA: tx_data is empty for txid[ffffc6459cea025951a3eba5bb5fe2d6eb4df03ce9589fcc333553c1748ec683] ('NoneType' object has no attribute 'keys')
-                    tx_data null
-                    INVALID DATA: tx_data is empty for txid[ffffccd3189eb1eb4052aaa4195aace8f49c664bd589272e448495617aa6f1e0] ('NoneType' object has no attribute 'keys')
-                    tx_data null
-                    INVALID DATA: tx_data is empty for txid[ffffdc5b5db9a9e2aefba05b9469e49809da50ee36d4a69c8a1310cbdcf4b48b] ('NoneType' object has no attribute 'keys')
-                    tx_data null
-                    INVALID DATA: tx_data is empty for txid[fffffe73c83ef944a15242bccaa12a4cba160f41dc0eb0c34eb7b8bd661ac3a2] ('NoneType' object has no attribute 'keys')
-                    Continuing instead of exiting.
-                    '''
-                    continue
-
-                # Coinbase can be sent to any number of addresses:
-                value = 0
-                #print('tx_data', json.dumps(tx_data, indent=2, sort_keys=True)) # @DEBUG
-                #print('vout_txid', vout_txid)
-                for address in tx_data[vout_txid]['addresses']:
-                    for vout in tx_data[vout_txid]['addresses'][address]:
-                        value += tx_data[vout_txid]['addresses'][address][vout]['value']
-
-                coinbase_json = {
-                    txid: {
-                        'value': value,
-                        'coinbase': coinbase,
-                        'vin_n': vin_n,
-                        'timestamp': timestamp,
-                        'height': height,
-                    }
-                }
-                txid, = coinbase_json.keys()
-                csv_writer.writerow([txid, json.dumps(coinbase_json)])
+    load_rows(args, 'coinbase', group_transaction_vin_coinbase, grouping='txid', desc='coinbase', unit='txid',
+              join='vout')
     if globals.args.initial:
         dbutils.truncate_tables(coin=globals.args.type, tables=['coinbase'])
     dbutils.load_data_infile(coin=globals.args.type, table='coinbase')
     return True
 
+def group_transaction_vin_coinbase(rows, csv_writer, vout_rows):
+    '''
+    Add the value of the outputs to each coinbase row, writing one row per txid.
+
+    Coinbase and tx-vout rows are both sorted by txid, so the outputs of each coinbase transaction are found by
+    merge-joining the two, without querying the database.
+
+    :param rows: coinbase rows, sorted by txid.
+    :param csv_writer: writer for the grouped rows.
+    :param vout_rows: tx-vout rows, sorted by txid.
+    :return: None
+    '''
+    timer = time.time()
+    vout_rows = iter(vout_rows)
+    vout_row = next(vout_rows, None)
+    previous_txid = previous_value = None
+    for row in rows:
+        if utils.elapsed(timer) >= globals.snapshot_timer:
+            utils.memory_snapshot("memory snapshot loop")
+            timer = time.time()
+        (txid, coinbase, vin_n, timestamp, height) = row
+
+        if txid == previous_txid:
+            # A duplicate coinbase txid (in early blocks, before BIP30), which has the same outputs in the vout table.
+            value = previous_value
+        else:
+            # Skip over the outputs of transactions that aren't coinbase transactions.
+            while vout_row is not None and vout_row[0] < txid:
+                vout_row = next(vout_rows, None)
+
+            # Coinbase can be sent to any number of addresses: like load_transaction_vout(), only the first output
+            # with each address and n is kept.
+            value = 0
+            outputs = set()
+            while vout_row is not None and vout_row[0] == txid:
+                (_, n, address, vout_value) = vout_row[:4]
+                if (address, n) not in outputs:
+                    outputs.add((address, n))
+                    value += int(Decimal(vout_value) * 100000000)
+                vout_row = next(vout_rows, None)
+
+            if not outputs:
+                print("INVALID DATA: no vout for coinbase txid[%s]" % (txid,))
+                logging.warning("INVALID DATA: no vout for coinbase txid[%s]" % (txid,))
+                continue
+            previous_txid = txid
+            previous_value = value
+
+        coinbase_json = {
+            txid: {
+                'value': value,
+                'coinbase': coinbase,
+                'vin_n': vin_n,
+                'timestamp': timestamp,
+                'height': height,
+            }
+        }
+        txid, = coinbase_json.keys()
+        csv_writer.writerow([txid, codec.encode_tsv(globals.args.type, coinbase_json)])
+
 def load_transaction_vin_spent(args):
     '''
     We may spend from a txid that has other spent vout; this requires checking for an existing entry in the
@@ -367,101 +749,77 @@ def load_transaction_vin_spent(args):
     :return:
     '''
     utils.vprint("load sorted transaction vin data into the database")
-    timer = time.time()
-    source_file = args.working_path + 'vin_spent_sorted.csv.gz'
-    spent_json = {}
-    utils.vprint("processing %s, grouping by spent" % (source_file,))
-    with open(globals.args.working_path + 'vin_spent.csv', 'wt') as vin_spent_csv:
-        csv_writer = csv.writer(vin_spent_csv, delimiter='\t', quoting=csv.QUOTE_NONE, quotechar='',
-                                escapechar='\\')
-        with gzip.open(source_file, 'rt') as csvfile:
-            source_csv = csv.reader(csvfile)
-            for row in tqdm(iterable=source_csv, desc='tx-vin', total=globals.metadata["extract_blockchain"]['vin_spent'],
-                            unit="spent", unit_scale=True, dynamic_ncols=True, smoothing=0, miniters=1, mininterval=1.0):
-                if utils.elapsed(timer) >= globals.snapshot_timer:
-                    utils.memory_snapshot("memory snapshot loop")
-                    timer = time.time()
-                (spent, vout, txid, vin_n, timestamp, height) = row
-
-                if not globals.args.initial and not spent_json:
-                    # This is the first row of the CSV, and we're updating an existing database; see if txid already exists.
-                    spent_json = dbutils.select(coin=globals.args.type, table='vin_spent', key=spent)
-                    if not spent_json:
-                        # Not found, restore spent_json from None to empty dictionary.
-                        spent_json = {}
-
-                if spent in spent_json:
-                    spent_json[spent][vout] = {
-                        'timestamp': timestamp,
-                        'height': height,
-                        'txid': txid,
-                        'vin_n': vin_n,
-                    }
-                else:
-                    # New spent, write the previous one to the database.
-                    if spent_json:
-                        old_spent, = spent_json.keys()
-                        if globals.args.initial:
-                            # We do bulk inserts on the first pass through the blockchain.
-                            csv_writer.writerow([old_spent, json.dumps(spent_json)])
-                        else:
-                            # We do per-spent inserts on subsequent passes
-                            spent_exists = dbutils.select(coin=globals.args.type, table='vin_spent', key=old_spent,
-                                                          check_if_exists=True)
-                            if spent_exists:
-                                dbutils.update(coin=globals.args.type, table='vin_spent', key=old_spent, value=spent_json)
-                            else:
-                                dbutils.insert(coin=globals.args.type, table='vin_spent', key=old_spent, value=spent_json)
-                        del spent_json
-
-                    if not globals.args.initial:
-                        spent_json = dbutils.select(coin=globals.args.type, table='vin_spent', key=spent)
-                    else:
-                        spent_json = None
-
-                    if spent_json:
-                        spent_json[spent][vout] = {
-                            'timestamp': timestamp,
-                            'height': height,
-                            'txid': txid,
-                            'vin_n': vin_n,
-                        }
-                    else:
-                        spent_json = {
-                            spent: {
-                                vout: {
-                                    'timestamp': timestamp,
-                                    'height': height,
-                                    'txid': txid,
-                                    'vin_n': vin_n,
-                                }
-                            }
-                        }
-
-            try:
-                # Write the last vin to the csv.
-                last_spent, = spent_json.keys()
-                if globals.args.initial:
-                    csv_writer.writerow([last_spent, json.dumps(spent_json)])
-                else:
-                    spent_exists = dbutils.select(coin=globals.args.type, table='vin_spent', key=last_spent,
-                                                  check_if_exists=True)
-                    if spent_exists:
-                        dbutils.update(coin=globals.args.type, table='vin_spent', key=last_spent, value=spent_json)
-                    else:
-                        dbutils.insert(coin=globals.args.type, table='vin_spent', key=last_spent, value=spent_json)
-            except Exception as e:
-                # Exception raised when nothing was spent.
-                utils.vprint("no spent processed")
-                logging.info("no spent processed: %s" % e)
-                pass
-
+    load_rows(args, 'vin_spent', group_transaction_vin_spent, grouping='spent', desc='tx-vin', unit='spent')
     if globals.args.initial:
         # Bulk load the entire CSV file on the first pass through the blockchain.
         dbutils.truncate_tables(coin=globals.args.type, tables=['vin_spent'])
         dbutils.load_data_infile(coin=globals.args.type, table='vin_spent')
     return True
 
+def group_transaction_vin_spent(rows, csv_writer):
+    '''
+    Group tx-vin rows by spent txid, writing one row per spent txid (or merging them into the database in batches
+    after the --initial pass).
+
+    :param rows: tx-vin rows, sorted by spent.
+    :param csv_writer: writer for the grouped rows.
+    :return: None
+    '''
+    timer = time.time()
+    spent_json = {}
+    pending = {}
+    for row in rows:
+        if utils.elapsed(timer) >= globals.snapshot_timer:
+            utils.memory_snapshot("memory snapshot loop")
+            timer = time.time()
+        (spent, vout, txid, vin_n, timestamp, height) = row
+
+        if spent not in spent_json:
+            # New spent, write the previous one.
+            if spent_json:
+                old_spent, = spent_json.keys()
+                if globals.args.initial:
+                    # We do bulk inserts on the first pass through the blockchain.
+                    csv_writer.writerow([old_spent, codec.encode_tsv(globals.args.type, spent_json)])
+                else:
+                    # We merge batches of spent into the database on subsequent passes.
+                    pending[old_spent] = spent_json
+                    if len(pending) >= globals.args.batch_size:
+                        dbutils.upsert_merged(coin=globals.args.type, table='vin_spent', values=pending,
+                                              merge=merge_spent)
+                        pending = {}
+            spent_json = {
+                spent: {},
+            }
+
+        spent_json[spent][vout] = {
+            'timestamp': timestamp,
+            'height': height,
+            'txid': txid,
+            'vin_n': vin_n,
+        }
+
+    if spent_json:
+        # Write the last spent.
+        last_spent, = spent_json.keys()
+        if globals.args.initial:
+            csv_writer.writerow([last_spent, codec.encode_tsv(globals.args.type, spent_json)])
+        else:
+            pending[last_spent] = spent_json
+    else:
+        utils.vprint("no spent processed")
+        logging.info("no spent processed")
+    if pending:
+        dbutils.upsert_merged(coin=globals.args.type, table='vin_spent', values=pending, merge=merge_spent)
+
+def merge_spent(spent_json, new_spent_json):
+    '''
+    Merge newly spent vout into the existing row of a spent txid.
+    '''
+    spent, = new_spent_json.keys()
+    spent_json[spent].update(new_spent_json[spent])
+    return spent_json
+
 def load_transaction_vin_txid(args):
     '''
     Except for where instances of a duplicate txid, this will always be new txid each time we process
@@ -471,206 +829,156 @@ def load_transaction_vin_txid(args):
     existence (ie when first forking bitcoin) and is a solved issue in all coins we've reviewed.
     '''
     utils.vprint("load sorted transaction vin data into the database")
+    load_rows(args, 'vin_txid', group_transaction_vin_txid, grouping='txid', desc='tx-vin', unit='txid')
+    if globals.args.initial:
+        dbutils.truncate_tables(coin=globals.args.type, tables=['vin_txid'])
+    dbutils.load_data_infile(coin=globals.args.type, table='vin_txid')
+    return True
+
+def group_transaction_vin_txid(rows, csv_writer):
+    '''
+    Group tx-vin rows by txid, writing one row per txid.
+
+    :param rows: tx-vin rows, sorted by txid.
+    :param csv_writer: writer for the grouped rows.
+    :return: None
+    '''
     timer = time.time()
-    source_file = args.working_path + 'vin_txid_sorted.csv.gz'
     txid_json = {}
-    utils.vprint("processing %s, grouping by txid" % (source_file,))
-    with open(globals.args.working_path + 'vin_txid.csv', 'wt') as txvin_csv:
-        csv_writer = csv.writer(txvin_csv, delimiter='\t', quoting=csv.QUOTE_NONE, quotechar='', escapechar='\\')
-        with gzip.open(source_file, 'rt') as csvfile:
-            source_csv = csv.reader(csvfile)
-            for row in tqdm(iterable=source_csv, desc='tx-vin', total=globals.metadata["extract_blockchain"]['vin_txid'],
-                            unit="txid", unit_scale=True, dynamic_ncols=True, smoothing=0, miniters=1, mininterval=1.0):
-                if utils.elapsed(timer) >= globals.snapshot_timer:
-                    utils.memory_snapshot("memory snapshot loop")
-                    timer = time.time()
-                (txid, vin_n, spent, vout, timestamp, height) = row
-
-                if txid in txid_json:
-                    txid_json[txid]['vin'][vin_n] = {
-                        'spent': spent,
-                        'vout': vout,
-                    }
-                else:
-                    if txid_json:
-                        old_txid, = txid_json.keys()
-                        csv_writer.writerow([old_txid, json.dumps(txid_json)])
-                        del txid_json
+    for row in rows:
+        if utils.elapsed(timer) >= globals.snapshot_timer:
+            utils.memory_snapshot("memory snapshot loop")
+            timer = time.time()
+        (txid, vin_n, spent, vout, timestamp, height) = row
+
+        if txid in txid_json:
+            txid_json[txid]['vin'][vin_n] = {
+                'spent': spent,
+                'vout': vout,
+            }
+        else:
+            if txid_json:
+                old_txid, = txid_json.keys()
+                csv_writer.writerow([old_txid, codec.encode_tsv(globals.args.type, txid_json)])
+                del txid_json
 
-                    txid_json = {
-                        txid: {
-                            'timestamp': timestamp,
-                            'height': height,
-                            'vin': {
-                                vin_n: {
-                                    'spent': spent,
-                                    'vout': vout,
-                                }
-                            }
+            txid_json = {
+                txid: {
+                    'timestamp': timestamp,
+                    'height': height,
+                    'vin': {
+                        vin_n: {
+                            'spent': spent,
+                            'vout': vout,
                         }
                     }
+                }
+            }
 
-            # Write the last vin to database.
-            try:
-                last_txid, = txid_json.keys()
-                csv_writer.writerow([last_txid, json.dumps(txid_json)])
-            except Exception as e:
-                # Exception raised when nothing was spent.
-                utils.vprint("no txid processed")
-                logging.info("no txid processed: %s" % e)
-                pass
-
-    if globals.args.initial:
-        dbutils.truncate_tables(coin=globals.args.type, tables=['vin_txid'])
-    dbutils.load_data_infile(coin=globals.args.type, table='vin_txid')
-    return True
+    # Write the last vin to database.
+    try:
+        last_txid, = txid_json.keys()
+        csv_writer.writerow([last_txid, codec.encode_tsv(globals.args.type, txid_json)])
+    except Exception as e:
+        # Exception raised when nothing was spent.
+        utils.vprint("no txid processed")
+        logging.info("no txid processed: %s" % e)
+        pass
 
 def load_address(args):
     '''
     Load addresses, grouping by txid and vout (n).
 
-    Addresses can be re-used at any point, so this will require checking if the address already exists each time
-    a new block is processed.
+    After the --initial pass, the vout of new blocks are appended to the address_delta table instead of rewriting the
+    row of each address, see compact.py.
+
+    Addresses with more than address_segment_size txids are stored in segments ordered by height, with a directory
+    row holding the boundaries of each segment and the totals of the address.
 
     :param args: Arguments used to invoke extract script.
     :return: True or False, indicating success.
     '''
     utils.vprint("load sorted address data into the database")
-    timer = time.time()
-    source_file = args.working_path + 'address_sorted.csv.gz'
-    address_json = {}
-    utils.vprint("processing %s, grouping by address, txid" % (source_file,))
-    with open(globals.args.working_path + 'address.csv', 'wt') as address_csv:
-        csv_writer = csv.writer(address_csv, delimiter='\t', quoting=csv.QUOTE_NONE, quotechar='', escapechar='\\')
-        with gzip.open(source_file, 'rt') as csvfile:
-            source_csv = csv.reader(csvfile)
-            for row in tqdm(iterable=source_csv, desc='addresses', total=globals.metadata["extract_blockchain"]['address'],
-                            unit="adr", unit_scale=True, dynamic_ncols=True, smoothing=0, miniters=1, mininterval=1.0):
-
-                # Optional logging/tracing of memory usage
-                if utils.elapsed(timer) >= globals.snapshot_timer:
-                    utils.memory_snapshot("memory snapshot loop")
-                    timer = time.time()
+    load_rows(args, 'address', group_address, grouping='address, txid', desc='addresses', unit='adr')
+    if globals.args.initial:
+        # Bulk load the entire CSV file on the first pass through the blockchain.
+        dbutils.truncate_tables(coin=globals.args.type, tables=['address', 'address_delta'])
+        dbutils.load_data_infile(coin=globals.args.type, table='address')
 
-                (address, txid, n, value, height, timestamp) = row
+    return True
 
-                if not globals.args.initial and not address_json:
-                    # This is the first row of the CSV, and we're updating an existing database; see if address already
-                    #  exists.
-                    address_json = dbutils.select(coin=globals.args.type, table='address', key=address)
-                    if not address_json:
-                        # Not found, restore address_json from None to empty dictionary.
-                        address_json = {}
-
-                if address in address_json:
-                    if 'skip' not in address_json[address]:
-                        if len(address_json[address]) > 1000000:
-                            # For now, completely skip over addresses with 1 million+ transactions.
-                            # @TODO FIXME ^^ Optimize handling of addresses with lots of transactions.
-                            address_json = {
-                                address: {
-                                    'skip': True,
-                                }
-                            }
-                            logging.warning('skipping address %s with > 1 million transactions' % address)
-                        if txid in address_json[address]:
-                            address_json[address][txid][n] = {
-                                'value': value,
-                                'height': height,
-                                'timestamp': timestamp,
-                            }
-                        else:
-                            address_json[address][txid] = {
-                                n: {
-                                    'value': value,
-                                    'height': height,
-                                    'timestamp': timestamp,
-                                },
-                            }
-                else:
-                    # Save previous address, unless this is the first row of the CSV and there is no previous address.
-                    if address_json:
-                        old_address, = address_json.keys()
-                        if globals.args.initial:
-                            # We do bulk inserts on the first pass through the blockchain.
-                            csv_writer.writerow([old_address, json.dumps(address_json)])
-                        else:
-                            # We do per-address inserts on subsequent passes
-                            address_exists = dbutils.select(coin=globals.args.type, table='address', key=old_address,
-                                                            check_if_exists=True)
-                            if address_exists:
-                                dbutils.update(coin=globals.args.type, table='address', key=old_address,
-                                               value=address_json)
-                            else:
-                                dbutils.insert(coin=globals.args.type, table='address', key=old_address,
-                                               value=address_json)
-                            try:
-                                globals.notify['addresses'].append(old_address)
-                            except:
-                                # If this isn't defined, we're running a catch-up job, and aren't
-                                # going to bother notifying the UI as it could be a massive
-                                # number of addresses.
-                                pass
-                        del address_json
-
-                    # Previous address saved, start the next
-                    if not globals.args.initial:
-                        address_json = dbutils.select(coin=globals.args.type, table='address', key=address)
-                    else:
-                        address_json = False
-
-                    if address_json:
-                        if txid in address_json[address]:
-                            address_json[address][txid][n] = {
-                                'value': value,
-                                'height': height,
-                                'timestamp': timestamp,
-                            }
-                        else:
-                            address_json[address][txid] = {
-                                n: {
-                                    'value': value,
-                                    'height': height,
-                                    'timestamp': timestamp,
-                                }
-                            }
-                    else:
-                        address_json = {
-                            address: {
-                                txid: {
-                                    n: {
-                                        'value': value,
-                                        'height': height,
-                                        'timestamp': timestamp,
-                                    }
-                                }
-                            }
-                        }
+def group_address(rows, csv_writer):
+    '''
+    Group address rows by address, writing one row per address (or appending them to the address deltas in batches
+    after the --initial pass).
 
-            try:
-                address, = address_json.keys()
+    :param rows: address rows, sorted by address.
+    :param csv_writer: writer for the grouped rows.
+    :return: None
+    '''
+    timer = time.time()
+    address_json = {}
+    pending = {}
+    for row in rows:
+        # Optional logging/tracing of memory usage
+        if utils.elapsed(timer) >= globals.snapshot_timer:
+            utils.memory_snapshot("memory snapshot loop")
+            timer = time.time()
+
+        (address, txid, n, value, height, timestamp) = row
+
+        if address not in address_json:
+            # Save previous address, unless this is the first row of the CSV and there is no previous address.
+            if address_json:
+                old_address, = address_json.keys()
                 if globals.args.initial:
-                    csv_writer.writerow([address, json.dumps(address_json)])
+                    # We do bulk inserts on the first pass through the blockchain.
+                    for key, data in dbutils.address_rows(old_address, address_json):
+                        csv_writer.writerow([key, codec.encode_tsv(globals.args.type, data)])
                 else:
-                    address_exists = dbutils.select(coin=globals.args.type, table='address', key=address,
-                                                    check_if_exists=True)
-                    if address_exists:
-                        dbutils.update(coin=globals.args.type, table='address', key=address, value=address_json)
-                    else:
-                        dbutils.insert(coin=globals.args.type, table='address', key=address, value=address_json)
-                    globals.notify['addresses'].append(address)
-            except Exception as e:
-                # Exception raised when there is no address to process.
-                utils.vprint("no addresses processed: %s" % e)
-                logging.info("no addresses processed: %s" % e)
-                pass
+                    # We merge batches of addresses into the database on subsequent passes.
+                    pending[old_address] = address_json
+                    if len(pending) >= globals.args.batch_size:
+                        flush_addresses(pending)
+                        pending = {}
+            address_json = {
+                address: {},
+            }
+
+        if txid not in address_json[address]:
+            address_json[address][txid] = {}
+        address_json[address][txid][n] = {
+            'value': value,
+            'height': height,
+            'timestamp': timestamp,
+        }
 
-    if globals.args.initial:
-        # Bulk load the entire CSV file on the first pass through the blockchain.
-        dbutils.truncate_tables(coin=globals.args.type, tables=['address'])
-        dbutils.load_data_infile(coin=globals.args.type, table='address')
+    if address_json:
+        # Save the last address.
+        address, = address_json.keys()
+        if globals.args.initial:
+            for key, data in dbutils.address_rows(address, address_json):
+                csv_writer.writerow([key, codec.encode_tsv(globals.args.type, data)])
+        else:
+            pending[address] = address_json
+    else:
+        # There is no address to process.
+        utils.vprint("no addresses processed")
+        logging.info("no addresses processed")
+    if pending:
+        flush_addresses(pending)
 
-    return True
+def flush_addresses(pending):
+    '''
+    Append a batch of grouped addresses to the address deltas, then notify the UI about them.
+    '''
+    dbutils.append_address_deltas(coin=globals.args.type, values=pending)
+    try:
+        globals.notify['addresses'].extend(pending.keys())
+    except:
+        # If this isn't defined, we're running a catch-up job, and aren't going to bother notifying the UI as it
+        # could be a massive number of addresses.
+        pass
 
 def load_block(args):
     '''
@@ -678,68 +986,505 @@ def load_block(args):
     :return: True or False, indicating success.
     '''
     utils.vprint("load sorted blocks data into the database")
+    load_rows(args, 'block', group_block, grouping='block hash', desc='block', unit='block')
+    if globals.args.initial:
+        dbutils.truncate_tables(coin=globals.args.type, tables=['block'])
+    dbutils.load_data_infile(coin=globals.args.type, table='block')
+    return True
+
+def group_block(rows, csv_writer):
+    '''
+    Group block rows by block hash, writing one row per block.
+
+    :param rows: block rows, sorted by block hash.
+    :param csv_writer: writer for the grouped rows.
+    :return: None
+    '''
     timer = time.time()
-    source_file = args.working_path + 'block_sorted.csv.gz'
     block_json = {}
-    utils.vprint("processing %s, grouping by block hash" % (source_file,))
-    with open(globals.args.working_path + 'block.csv', 'wt') as block_csv:
-        csv_writer = csv.writer(block_csv, delimiter='\t', quoting=csv.QUOTE_NONE, quotechar='', escapechar='\\')
-        with gzip.open(source_file, 'rt') as csvfile:
-            source_csv = csv.reader(csvfile)
-            for row in tqdm(iterable=source_csv, desc='block', total=globals.metadata["extract_blockchain"]['block'],
-                            unit="block", unit_scale=True, dynamic_ncols=True, smoothing=0, miniters=1, mininterval=1.0):
-                if utils.elapsed(timer) >= globals.snapshot_timer:
-                    utils.memory_snapshot("memory snapshot loop")
-                    timer = time.time()
-                (hash, txid, height, timestamp, vin_count, vout_count) = row
-
-                if hash in block_json:
-                    block_json[hash]['tx'][txid] = {
-                        'vin_vount': vin_count,
-                        'vout_count': vout_count,
-                    }
-                else:
-                    if block_json:
-                        old_hash, = block_json.keys()
-                        csv_writer.writerow([old_hash, json.dumps(block_json)])
-                        del block_json
-
-                    block_json = {
-                        hash: {
-                            'height': height,
-                            'timestamp': timestamp,
-                            'tx': {
-                                txid: {
-                                    'vin_vount': vin_count,
-                                    'vout_count': vout_count,
-                                }
-                            }
+    for row in rows:
+        if utils.elapsed(timer) >= globals.snapshot_timer:
+            utils.memory_snapshot("memory snapshot loop")
+            timer = time.time()
+        (hash, txid, height, timestamp, vin_count, vout_count) = row
+
+        if hash in block_json:
+            block_json[hash]['tx'][txid] = {
+                'vin_vount': vin_count,
+                'vout_count': vout_count,
+            }
+        else:
+            if block_json:
+                old_hash, = block_json.keys()
+                csv_writer.writerow([old_hash, codec.encode_tsv(globals.args.type, block_json)])
+                del block_json
+
+            block_json = {
+                hash: {
+                    'height': height,
+                    'timestamp': timestamp,
+                    'tx': {
+                        txid: {
+                            'vin_vount': vin_count,
+                            'vout_count': vout_count,
                         }
                     }
+                }
+            }
 
-            # Write the last vin to database.
-            try:
-                last_hash, = block_json.keys()
-                csv_writer.writerow([last_hash, json.dumps(block_json)])
-            except:
-                # Empty file, safe to ignore.
-                pass
+    # Write the last vin to database.
+    try:
+        last_hash, = block_json.keys()
+        csv_writer.writerow([last_hash, codec.encode_tsv(globals.args.type, block_json)])
+    except:
+        # Empty file, safe to ignore.
+        pass
+
+def load_output(args):
+    '''
+    Load tx-vout-sorted CSV into the normalized output table, one row per output and address, if enabled with the
+    normalized_tables setting.
+
+    Outputs are only ever added, so the rows of new blocks are bulk-loaded on every pass. Like the UTXO tables, the API
+    only uses the normalized tables once they were loaded by an --initial pass.
+
+    :param args: Arguments used to invoke extract script.
+    :return: True or False, indicating success.
+    '''
+    if not dbutils.use_normalized_tables(globals.args.type):
+        utils.vprint("normalized tables are disabled, skipping", level=2)
+        return True
+    utils.vprint("load sorted transaction vout data into the normalized output table")
+    load_rows(args, 'vout', group_output, grouping='txid', desc='output', unit='vout', table='output')
     if globals.args.initial:
-        dbutils.truncate_tables(coin=globals.args.type, tables=['block'])
-    dbutils.load_data_infile(coin=globals.args.type, table='block')
+        # The API stops using the tables until they are loaded again.
+        dbutils.set_table_status(coin=globals.args.type, name='output', height=None, complete=False)
+        dbutils.truncate_tables(coin=globals.args.type, tables=['output'])
+    dbutils.load_data_infile(coin=globals.args.type, table='output')
+    if globals.args.initial:
+        dbutils.set_table_status(coin=globals.args.type, name='output', height=None, complete=True)
+    elif not (dbutils.get_table_status(globals.args.type, 'output') or {}).get('complete'):
+        utils.vprint("the output table wasn't loaded from the genesis block, the API doesn't use the normalized tables "
+                     "until the next --initial pass")
+    return True
+
+def group_output(rows, csv_writer):
+    '''
+    Write one row per output and address. Like group_transaction_vout(), only the first row with each txid, n and
+    address is kept.
+
+    :param rows: tx-vout rows, sorted by txid.
+    :param csv_writer: writer for the output rows.
+    :return: None
+    '''
+    timer = time.time()
+    outputs = set()
+    previous_txid = None
+    for row in rows:
+        if utils.elapsed(timer) >= globals.snapshot_timer:
+            utils.memory_snapshot("memory snapshot loop")
+            timer = time.time()
+        (txid, n, address, value, height, block_hash, timestamp, vin_count, vout_count) = row
+
+        if txid != previous_txid:
+            outputs = set()
+            previous_txid = txid
+        if (n, address) in outputs:
+            continue
+        outputs.add((n, address))
+        csv_writer.writerow([txid, n, address, int(Decimal(value) * 100000000), height, timestamp])
+
+def load_spend(args):
+    '''
+    Load tx-vin-sorted CSV into the normalized spend table, one row per spent output, if enabled with the
+    normalized_tables setting.
+
+    Unlike the vin_spent table, spent outputs of the same txid are separate rows, so the rows of new blocks are
+    bulk-loaded on every pass instead of being merged into existing rows.
+
+    :param args: Arguments used to invoke extract script.
+    :return: True or False, indicating success.
+    '''
+    if not dbutils.use_normalized_tables(globals.args.type):
+        utils.vprint("normalized tables are disabled, skipping", level=2)
+        return True
+    utils.vprint("load sorted transaction vin data into the normalized spend table")
+    load_rows(args, 'vin_spent', group_spend, grouping='spent', desc='spend', unit='vin', table='spend')
+    if globals.args.initial:
+        # The API stops using the tables until they are loaded again.
+        dbutils.set_table_status(coin=globals.args.type, name='spend', height=None, complete=False)
+        dbutils.truncate_tables(coin=globals.args.type, tables=['spend'])
+    dbutils.load_data_infile(coin=globals.args.type, table='spend')
+    if globals.args.initial:
+        dbutils.set_table_status(coin=globals.args.type, name='spend', height=None, complete=True)
+    elif not (dbutils.get_table_status(globals.args.type, 'spend') or {}).get('complete'):
+        utils.vprint("the spend table wasn't loaded from the genesis block, the API doesn't use the normalized tables "
+                     "until the next --initial pass")
+    return True
+
+def group_spend(rows, csv_writer):
+    '''
+    Write one row per spent output.
+
+    :param rows: tx-vin rows, sorted by spent.
+    :param csv_writer: writer for the spend rows.
+    :return: None
+    '''
+    timer = time.time()
+    for row in rows:
+        if utils.elapsed(timer) >= globals.snapshot_timer:
+            utils.memory_snapshot("memory snapshot loop")
+            timer = time.time()
+        (spent, vout, txid, vin_n, timestamp, height) = row
+        csv_writer.writerow([spent, vout, txid, vin_n, height, timestamp])
+
+def load_utxo(args):
+    '''
+    Update the UTXO set and the balance of each address with the outputs and spent outputs of the extracted blocks,
+    if enabled with the utxo_tables setting.
+
+    Outputs and spent outputs are bulk-loaded into staging tables, then applied with a few queries, see
+    dbutils.apply_utxo(). After the --initial pass the changes of new blocks are applied in a single transaction, and
+    they are reverted when unwinding orphaned blocks.
+
+    The API only uses the UTXO tables once they were loaded by an --initial pass: enabled on an existing database,
+    they only have the changes of the blocks loaded since.
+
+    :param args: Arguments used to invoke extract script.
+    :return: True or False, indicating success.
+    '''
+    if not dbutils.use_utxo_tables(globals.args.type):
+        utils.vprint("UTXO tables are disabled, skipping", level=2)
+        return True
+    utils.vprint("load sorted transaction vout and vin data into the UTXO set")
+    load_rows(args, 'vout', group_output, grouping='txid', desc='utxo-add', unit='vout', table='utxo_add')
+    load_rows(args, 'vin_spent', group_spend, grouping='spent', desc='utxo-spend', unit='vin', table='utxo_spend')
+    if globals.args.initial:
+        # The API stops using the tables until they are loaded again.
+        dbutils.set_table_status(coin=globals.args.type, name='utxo', height=None, complete=False)
+        dbutils.truncate_tables(coin=globals.args.type, tables=['utxo', 'address_balance'])
+    dbutils.truncate_tables(coin=globals.args.type, tables=['utxo_add', 'utxo_spend'])
+    dbutils.load_data_infile(coin=globals.args.type, table='utxo_add')
+    dbutils.load_data_infile(coin=globals.args.type, table='utxo_spend')
+    status = dbutils.apply_utxo(coin=globals.args.type, transaction=not globals.args.initial,
+                                complete=True if globals.args.initial else None)
+    if not status['complete']:
+        utils.vprint("UTXO tables weren't loaded from the genesis block, the API doesn't use them until the next "
+                     "--initial pass")
+        logging.warning("UTXO tables weren't loaded from the genesis block, the API doesn't use them until the next "
+                        "--initial pass")
+    # The staging tables are only needed until they are applied.
+    dbutils.truncate_tables(coin=globals.args.type, tables=['utxo_add', 'utxo_spend'])
     return True
 
+def load_address_sent(args):
+    '''
+    Count the outputs spent by the extracted blocks in the directory row of segmented addresses, which keeps the sent
+    total and balance of the address (see dbutils.address_directory()) so that the API doesn't read the entire
+    history of the address to total it.
+
+    Spending an output doesn't change the rows of its address: the address of each spent output is read from the vout
+    row of its transaction once the rows of the extracted blocks are loaded. After the --initial pass, the spent
+    outputs of each segmented address are counted from its history instead.
+
+    :param args: Arguments used to invoke extract script.
+    :return: True or False, indicating success.
+    '''
+    first_segment = dbutils.address_segment_key('', 0)
+    if globals.args.initial:
+        utils.vprint("count the spent outputs of segmented addresses")
+        # The first segment of each segmented address is stored under its own key.
+        addresses = [key[:-len(first_segment)] for key, _ in dbutils.select_ordered(globals.args.type, 'address')
+                     if key.endswith(first_segment)]
+        updated = dbutils.update_address_sent(coin=globals.args.type, spends={address: [] for address in addresses})
+        utils.vprint("counted the spent outputs of %d segmented addresses" % updated)
+        return True
+
+    utils.vprint("count the spent outputs of segmented addresses spent from by the extracted blocks")
+    load_rows(args, 'vin_spent', group_address_sent, grouping='spent', desc='address-sent', unit='vin',
+              table='address_sent')
+    spends = {}
+    with open(globals.args.working_path + 'address_sent.csv') as f_sent:
+        for address, value, height in csv.reader(f_sent, delimiter='\t'):
+            if address not in spends:
+                if not dbutils.select(coin=globals.args.type, table='address',
+                                      key=dbutils.address_segment_key(address, 0), check_if_exists=True):
+                    spends[address] = None
+                    continue
+                spends[address] = []
+            if spends[address] is not None:
+                spends[address].append((int(value), int(height)))
+    updated = dbutils.update_address_sent(coin=globals.args.type,
+                                          spends={address: spends[address] for address in spends if spends[address]})
+    utils.vprint("updated the sent total of %d segmented addresses" % updated, level=2)
+    return True
+
+def group_address_sent(rows, csv_writer):
+    '''
+    Write the address, value and height of each spent output, reading the vout rows of the spent transactions in
+    batches.
+
+    :param rows: tx-vin rows, sorted by spent.
+    :param csv_writer: writer for the address rows.
+    :return: None
+    '''
+    timer = time.time()
+    batch = []
+    spent_txids = set()
+    for row in rows:
+        if utils.elapsed(timer) >= globals.snapshot_timer:
+            utils.memory_snapshot("memory snapshot loop")
+            timer = time.time()
+        (spent, vout, txid, vin_n, timestamp, height) = row
+
+        if spent not in spent_txids and len(spent_txids) >= globals.args.batch_size:
+            write_address_sent(batch, csv_writer)
+            batch = []
+            spent_txids = set()
+        spent_txids.add(spent)
+        batch.append((spent, vout, height))
+    write_address_sent(batch, csv_writer)
+
+def write_address_sent(batch, csv_writer):
+    for address, spends in dbutils.select_spent_addresses(coin=globals.args.type, spends=batch).items():
+        for value, height in spends:
+            csv_writer.writerow([address, value, height])
+
 def get_phases(as_strings=False):
     phases = [extract_blockchain, sort_files, load_transaction_vout, load_transaction_vin_coinbase,
-              load_transaction_vin_spent, load_transaction_vin_txid, load_address, load_block]
+              load_transaction_vin_spent, load_transaction_vin_txid, load_address, load_block, load_output,
+              load_spend, load_utxo, load_address_sent]
     if as_strings:
         return [phase.__name__ for phase in phases]
     else:
         return phases
 
+def prepare_extract(args):
+    '''
+    Determine the first block to extract: the genesis block on the initial pass, otherwise the block following the
+    last processed block, first unwinding it if it was orphaned.
+
+    :param args: Arguments used to invoke extract script.
+    :return: None
+    '''
+    if globals.args.initial and args.blocks_dir:
+        # The genesis block is the first block of the best chain found in the block files.
+        globals.next_block = 'genesis'
+        globals.next_block_height = 0
+        logging.info("starting with genesis block from %s" % args.blocks_dir)
+        utils.vprint("starting with genesis block from %s" % args.blocks_dir)
+    elif globals.args.initial:
+        genesis_hash = rpc.rpc_request(method='getblockhash', parameters=[0])
+        if not genesis_hash:
+            try:
+                genesis_hash = settings.coins[args.type]['genesis_hash']
+            except:
+                logging.critical("failed to determine genesis hash")
+                print("failed to determine genesis hash")
+                exit(1)
+        globals.next_block = genesis_hash
+        globals.next_block_height = 0
+        logging.info("starting with genesis hash (%d: %s)" % (0, genesis_hash))
+        utils.vprint("starting with genesis hash (%d: %s)" % (0, genesis_hash))
+    else:
+        # @TODO wrap this in a transaction so we can restart only new blocks
+        # Determine the last block extracted:
+        last_processed_hash = globals.metadata["extract_blockchain"]["last-processed-block"]
+        last_processed_block = rpc.rpc_request(method='getblock', parameters=[last_processed_hash])
+        globals.last_processed_block_height = last_processed_block["height"]
+        confirmations = last_processed_block["confirmations"]
+        logging.info(">> resuming where we left off (%d: %s)" % (globals.last_processed_block_height,
+                                                                 last_processed_hash))
+        utils.vprint(">> resuming where we left off (%d: %s)" % (globals.last_processed_block_height,
+                                                                 last_processed_hash))
+
+        if confirmations < 0:
+            utils.vprint("!! this is an orphaned block")
+            # Unwinding must be durable before the metadata points at the new last processed block.
+            with dbutils.write_behind(args.type, batch_size=args.batch_size):
+                last_processed_block = unwind_orphan_chain(last_processed_block)
+            logging.info("metadata before: %s" % globals.metadata)
+            globals.metadata["extract_blockchain"]["last-processed-block"] = last_processed_block["hash"]
+            logging.info("metadata after: %s" % globals.metadata)
+            write_metadata()
+            # Rows of any table may have been removed, the API drops the rows it cached and stops using the lookup
+            # index until the next one is built.
+            rowcache.publish(args.type, 'orphan', tip=last_processed_block["hash"])
+        try:
+            globals.next_block = last_processed_block["nextblockhash"]
+            globals.next_block_height = last_processed_block["height"] + 1
+        except Exception as e:
+            utils.vprint("no nextblockhash, end of blockchain")
+            logging.info("no nextblockhash, end of blockchain: %s" % e)
+            exit(0)
+
+def get_phase_dependencies():
+    '''
+    The phases each phase depends on. Each load phase reads its own sorted (or partitioned) CSV files and writes its
+    own table, so they only depend on sort_files and can run at the same time, except load_address_sent.
+    '''
+    return {
+        'extract_blockchain': [],
+        'sort_files': ['extract_blockchain'],
+        'load_transaction_vout': ['sort_files'],
+        'load_transaction_vin_coinbase': ['sort_files'],
+        'load_transaction_vin_spent': ['sort_files'],
+        'load_transaction_vin_txid': ['sort_files'],
+        'load_address': ['sort_files'],
+        'load_block': ['sort_files'],
+        'load_output': ['sort_files'],
+        'load_spend': ['sort_files'],
+        'load_utxo': ['sort_files'],
+        # Reads the vout and vin_spent rows of the extracted blocks, and updates the directory rows of addresses.
+        'load_address_sent': ['load_transaction_vout', 'load_transaction_vin_spent', 'load_address'],
+    }
+
+def run_phase(args, phase, phase_counter):
+    if phase_counter == 1:
+        prepare_extract(args)
+    utils.vprint("phase %d, invoking %s()" % (phase_counter, phase.__name__,))
+    logging.info("phase %d, invoking %s()" % (phase_counter, phase.__name__,))
+    utils.memory_snapshot()
+    # Buffered writes are flushed when the phase returns, before its completion is recorded in the metadata.
+    with dbutils.write_behind(args.type, batch_size=args.batch_size):
+        rc = phase(args)
+    stats = dbutils.write_behind_stats(args.type)
+    if stats['rows']:
+        utils.vprint("phase %d, %s() write-behind: %s" % (phase_counter, phase.__name__, stats), level=2)
+        logging.info("phase %d, %s() write-behind: %s" % (phase_counter, phase.__name__, stats))
+    dbutils.close_database_connection(args.type)
+    return rc
+
+def run_phase_process(args, phase_name, phase_counter, metadata):
+    '''
+    Run a phase in a worker process, with its own database connection.
+
+    :return: tuple of (the phase's return code, addresses to notify).
+    '''
+    phase, = [phase for phase in get_phases() if phase.__name__ == phase_name]
+    globals.metadata = metadata
+    # Addresses to notify are returned to the parent process.
+    if 'addresses' in globals.notify:
+        globals.notify['addresses'] = []
+    rc = run_phase(args, phase, phase_counter)
+    return rc, globals.notify.get('addresses', [])
+
+def complete_phase(phase, phase_counter, rc):
+    '''
+    Record the completion of a phase in the metadata, or exit if the phase failed.
+    '''
+    if not rc:
+        utils.vprint("phase %d, %s() failed, exiting" % (phase_counter, phase.__name__,))
+        logging.critical("phase %d, %s() failed, exiting" % (phase_counter, phase.__name__,))
+        exit(1)
+    globals.metadata.update({
+        phase.__name__: rc,
+    })
+    if phase.__name__ not in globals.metadata['completed-phases']:
+        globals.metadata['completed-phases'].append(phase.__name__)
+    write_metadata()
+
+def select_phases(args):
+    '''
+    The phases to run: all of them, or from the phase selected with --phase on, or only that phase with --single.
+
+    :param args: Arguments used to invoke extract script.
+    :return: tuple of (the phases to run, index of the first phase to run in get_phases()).
+    '''
+    phases = get_phases()
+    first_phase = 0
+    if args.phase:
+        first_phase = get_phases(as_strings=True).index(args.phase)
+        for phase_counter, phase in enumerate(phases[:first_phase], start=1):
+            # Skip until we get to the desired phase
+            utils.vprint("skipping phase %s (%d)" % (phase.__name__, phase_counter))
+            logging.info("skipping phase %s (%d)" % (phase.__name__, phase_counter))
+    if args.single:
+        return [phases[first_phase]], first_phase
+    return phases[first_phase:], first_phase
+
+def run_phases(args, phases, first_phase):
+    '''
+    Run phases once the phases they depend on are completed.
+
+    A phase is run in this process when it is the only phase that can run, otherwise with --phase-concurrency phases
+    that don't depend on each other run at the same time in a pool of processes. Completed phases are recorded in the
+    metadata: when resuming with --phase, phases after it that were already completed are skipped, unless they depend
+    on a phase that is run again.
+
+    :param args: Arguments used to invoke extract script.
+    :param phases: the phases to run, in order.
+    :param first_phase: index of the first phase to run in get_phases().
+    :return: None
+    '''
+    dependencies = get_phase_dependencies()
+    if first_phase == 0:
+        globals.metadata['completed-phases'] = []
+    else:
+        globals.metadata.setdefault('completed-phases', [])
+
+    counters = {}
+    pending = []
+    for phase_counter, phase in enumerate(phases, start=first_phase + 1):
+        counters[phase.__name__] = phase_counter
+        if phase_counter > first_phase + 1 and phase.__name__ in globals.metadata['completed-phases'] and \
+                not set(dependencies[phase.__name__]) & set(pending_phase.__name__ for pending_phase in pending):
+            utils.vprint("skipping completed phase %s (%d)" % (phase.__name__, phase_counter))
+            logging.info("skipping completed phase %s (%d)" % (phase.__name__, phase_counter))
+            continue
+        pending.append(phase)
+
+    # Phases that aren't run are considered completed.
+    completed = set(get_phases(as_strings=True)) - set(phase.__name__ for phase in pending)
+    running = {}
+    executor = None
+    try:
+        while pending or running:
+            ready = [phase for phase in pending if set(dependencies[phase.__name__]) <= completed]
+            if (not running and len(ready) == 1) or args.phase_concurrency <= 1:
+                phase = pending.pop(pending.index(ready[0]))
+                complete_phase(phase, counters[phase.__name__], run_phase(args, phase, counters[phase.__name__]))
+                completed.add(phase.__name__)
+                continue
+
+            for phase in ready[:args.phase_concurrency - len(running)]:
+                if executor is None:
+                    # Worker processes open their own database connections.
+                    dbutils.close_database_connection(args.type)
+                    executor = concurrent.futures.ProcessPoolExecutor(
+                        max_workers=args.phase_concurrency, mp_context=multiprocessing.get_context('fork'))
+                pending.remove(phase)
+                running[executor.submit(run_phase_process, args, phase.__name__, counters[phase.__name__],
+                                        globals.metadata)] = phase
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                phase = running.pop(future)
+                try:
+                    rc, addresses = future.result()
+                except BaseException as e:
+                    utils.vprint("phase %s() raised %r" % (phase.__name__, e))
+                    logging.critical("phase %s() raised %r" % (phase.__name__, e))
+                    rc = addresses = None
+                if rc and 'addresses' in globals.notify:
+                    globals.notify['addresses'].extend(addresses)
+                if not rc:
+                    # Let the other running phases complete before exiting.
+                    concurrent.futures.wait(running)
+                    for future in running:
+                        if not future.exception() and future.result()[0]:
+                            complete_phase(running[future], counters[running[future].__name__], future.result()[0])
+                complete_phase(phase, counters[phase.__name__], rc)
+                completed.add(phase.__name__)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
 def unwind_orphan_chain(block):
     # Load the entire block, with transactions
     block = utils.request_block(block["hash"], settings)
+    unwound_sent = {}
+    unwound_height = None
     while block["confirmations"] < 0:
         utils.vprint("- removing orphaned block: %s" % block["hash"], level=2)
         logging.warning("- removing orphaned block: %s" % block["hash"])
@@ -752,6 +1497,25 @@ def unwind_orphan_chain(block):
             'addresses': [],
         }
 
+        utxo_addresses = set()
+        utxo_status = dbutils.get_table_status(globals.args.type, 'utxo') if \
+            dbutils.has_utxo_tables(globals.args.type) else None
+        # Only blocks that were applied to the UTXO set are reverted.
+        if utxo_status and utxo_status['height'] is not None and utxo_status['height'] >= block['height']:
+            # Outputs spent in the same block must be restored before the transaction creating them is reverted.
+            for tx in reversed(block["tx"]):
+                utxo_addresses.update(dbutils.unwind_utxo_transaction(
+                    coin=globals.args.type, txid=tx["txid"],
+                    spent_outputs=[(vin["txid"], vin["vout"]) for vin in tx["vin"] if "txid" in vin]))
+            dbutils.set_table_status(globals.args.type, 'utxo', block['height'] - 1, utxo_status['complete'])
+
+        # The addresses of the outputs spent by the block are read before the vout rows of the block are removed.
+        spent_outputs = [(vin["txid"], str(vin["vout"]), block["height"]) for tx in block["tx"] for vin in tx["vin"]
+                         if "txid" in vin]
+        for address, spends in dbutils.select_spent_addresses(globals.args.type, spent_outputs).items():
+            unwound_sent.setdefault(address, []).extend(spends)
+        unwound_height = block["height"]
+
         for tx in block["tx"]:
             utils.vprint("-- removing tx %s" % tx["txid"], level=2)
             logging.info("-- removing tx %s" % tx["txid"])
@@ -770,6 +1534,9 @@ def unwind_orphan_chain(block):
                     logging.info("--- affected vin coinbase %s" % vin['coinbase'])
                     dbutils.delete(coin=globals.args.type, table='coinbase', key=tx["txid"])
 
+            if dbutils.has_normalized_tables(globals.args.type):
+                dbutils.remove_normalized_transaction(coin=globals.args.type, txid=tx["txid"])
+
             utils.vprint("--- removing %d vout" % len(tx["vout"]), level=2)
             logging.info("--- removing %d vout" % len(tx["vout"]))
             dbutils.delete(coin=globals.args.type, table='vout', key=tx["txid"])
@@ -781,16 +1548,9 @@ def unwind_orphan_chain(block):
                         utils.vprint("--- affected vout: n: %d value: %s" % (vout["n"], vout["value"]), level=2)
                         logging.info("--- affected vout: n: %d value: %s" % (vout["n"], vout["value"]))
                         globals.notify['addresses'].append(address)
-                        address_json = dbutils.select(coin=globals.args.type, table='address', key=address)
-                        need_to_update = True
-                        del(address_json[address][tx["txid"]][str(vout["n"])])
-                        if len(address_json[address][tx["txid"]]) == 0:
-                            del(address_json[address][tx["txid"]])
-                            if len(address_json[address]) == 0:
-                                dbutils.delete(coin=globals.args.type, table='address', key=address)
-                                need_to_update = False
-                        if need_to_update:
-                            dbutils.update(coin=globals.args.type, table='address', key=address, value=address_json)
+                        if not dbutils.remove_address_output(coin=globals.args.type, address=address, txid=tx["txid"],
+                                                             n=str(vout["n"])):
+                            logging.warning("--- vout not found in address %s" % address)
 
                 except Exception as e:
                     # https://bitcoin.stackexchange.com/questions/60463/segwit-bitcoin-json-rpc-and-strange-addresses
@@ -816,10 +1576,17 @@ def unwind_orphan_chain(block):
                             dbutils.update(coin=globals.args.type, table='address', key=address, value=address_json)
                     '''
 
+        # The outputs of the orphaned block are removed from the address table, read the heights from it again.
+        dbutils.unwind_address_heights(coin=globals.args.type, addresses=utxo_addresses, height=block["height"])
+
         # The orphaned block is now removed, notify backend then load previous block looking for valid chain
         notify_colpo('orphan block')
         block = utils.request_block(block["previousblockhash"], settings)
 
+    if unwound_sent:
+        # Segmented addresses count the spends of the new blocks from the first orphaned block on.
+        dbutils.unwind_address_sent(globals.args.type, unwound_sent, unwound_height)
+
     # If we got here, we're back on the main blockchain
     utils.vprint("++ found main blockchain", level=2)
     logging.info("++ found main blockchain")
@@ -838,7 +1605,10 @@ def notify_colpo(event):
             'addresses': ",".join(set(globals.notify['addresses'])),
         }
         try:
-            requests.post(url=settings.new_block_notification, data=message, timeout=60.0)
+            response = transport.request('colpo', 'POST', settings.new_block_notification, retry_limit=1,
+                                         data=message, timeout=60.0)
+            if response is None:
+                raise Exception("no response")
             utils.vprint("notified colpo at %s" % settings.new_block_notification)
             logging.info("notified colpo at %s" % settings.new_block_notification)
         except Exception as e:
@@ -894,88 +1664,39 @@ def main(args):
                 p.unlink()
 
     # List of functions to invoke.
-    phases = get_phases()
+    phases, first_phase = select_phases(args)
 
-    phase_counter = 0
-    for phase in phases:
-        phase_counter += 1
-
-        if args.phase:
-            if args.phase != phase.__name__:
-                # Skip until we get to the desired phase
-                utils.vprint("skipping phase %s (%d)" % (phase.__name__, phase_counter))
-                logging.info("skipping phase %s (%d)" % (phase.__name__, phase_counter))
-                continue
-            else:
-                args.phase = None
-
-        if phase_counter == 1 and args.regenerate:
-            # Regenerate flag; flush metadata.
-            utils.vprint("-r flag set, ignoring metadata and regenerating CSV files")
-            globals.metadata = {}
-            dbutils.truncate_tables(args.type)
-
-        if phase_counter == 1:
-            if globals.args.initial:
-                genesis_hash = rpc.rpc_request(method='getblockhash', parameters=[0])
-                if not genesis_hash:
-                    try:
-                        genesis_hash = settings.coins[args.type]['genesis_hash']
-                    except:
-                        logging.critical("failed to determine genesis hash")
-                        print("failed to determine genesis hash")
-                        exit(1)
-                globals.next_block = genesis_hash
-                logging.info("starting with genesis hash (%d: %s)" % (0, genesis_hash))
-                utils.vprint("starting with genesis hash (%d: %s)" % (0, genesis_hash))
-            else:
-                # @TODO wrap this in a transaction so we can restart only new blocks
-                # Determine the last block extracted:
-                last_processed_hash = globals.metadata["extract_blockchain"]["last-processed-block"]
-                last_processed_block = rpc.rpc_request(method='getblock', parameters=[last_processed_hash])
-                globals.last_processed_block_height = last_processed_block["height"]
-                confirmations = last_processed_block["confirmations"]
-                logging.info(">> resuming where we left off (%d: %s)" % (globals.last_processed_block_height,
-                                                                         last_processed_hash))
-                utils.vprint(">> resuming where we left off (%d: %s)" % (globals.last_processed_block_height,
-                                                                         last_processed_hash))
-
-                if confirmations < 0:
-                    utils.vprint("!! this is an orphaned block")
-                    last_processed_block = unwind_orphan_chain(last_processed_block)
-                    logging.info("metadata before: %s" % globals.metadata)
-                    globals.metadata["extract_blockchain"]["last-processed-block"] = last_processed_block["hash"]
-                    logging.info("metadata after: %s" % globals.metadata)
-                    write_metadata()
-                try:
-                    globals.next_block = last_processed_block["nextblockhash"]
-                except Exception as e:
-                    utils.vprint("no nextblockhash, end of blockchain")
-                    logging.info("no nextblockhash, end of blockchain: %s" % e)
-                    exit(0)
+    if first_phase == 0 and args.regenerate:
+        # Regenerate flag; flush metadata.
+        utils.vprint("-r flag set, ignoring metadata and regenerating CSV files")
+        globals.metadata = {}
+        dbutils.truncate_tables(args.type)
 
-        utils.vprint("phase %d, invoking %s()" % (phase_counter, phase.__name__,))
-        logging.info("phase %d, invoking %s()" % (phase_counter, phase.__name__,))
-        utils.memory_snapshot()
-        rc = phase(args)
-        if rc:
-            globals.metadata.update({
-                phase.__name__: rc,
-            })
-            write_metadata()
-        else:
-            utils.vprint("phase %d, %s() failed, exiting" % (phase_counter, phase.__name__,))
-            exit(1)
-        dbutils.close_database_connection(args.type)
+    run_phases(args, phases, first_phase)
 
-        if args.single:
-            utils.vprint("--single flag set, exiting now after running a single phase")
-            exit(0)
+    if args.single:
+        utils.vprint("--single flag set, exiting now after running a single phase")
+        exit(0)
     globals.metadata.update({
         'completed': True,
     })
     write_metadata()
 
+    # The API stops using the rows it cached of the tables that changed, and the indexed rows of these tables.
+    state = rowcache.publish(args.type, 'tip',
+                             tip=globals.metadata.get('extract_blockchain', {}).get('last-processed-block'))
+
+    if lookup.is_enabled(args.type):
+        # The API switches to the new lookup index once it is swapped in.
+        start = time.time()
+        path = lookup.build(args.type, dbutils.select_ordered, state=state)
+        dbutils.close_database_connection(args.type)
+        logging.info("built lookup index %s in %s seconds" % (path, utils.elapsed(start)))
+    # The API counts confirmations from this tip until its workers poll a newer one from the daemon.
+    chain_tip = globals.metadata.get('extract_blockchain', {}).get('chain-tip')
+    if chain_tip and chain_tip['hash']:
+        chaintip.publish(args.type, chain_tip['height'], chain_tip['hash'], 'extract', updated=chain_tip['read'])
+
     notify_colpo('new block')
 
 if __name__ == '__main__':
@@ -987,11 +1708,31 @@ if __name__ == '__main__':
     parser.add_argument('--working', help="full path to working directory (defaults to current directory; files can get very large)", type=str)
     parser.add_argument('-r', '--regenerate', help="regenerate temporary CSV files", action="store_true")
     parser.add_argument('--validate', help="perform extra data validations (slower)", action="store_true")
+    parser.add_argument('--raw-blocks', help="request raw (binary) blocks and parse them locally instead of requesting"
+                                             " JSON blocks (with --validate, compare with the JSON blocks)",
+                        action="store_true")
+    parser.add_argument('--workers', help="number of processes extracting blocks, and loading partitions, in parallel"
+                                          " (defaults to 1)", type=int, default=1)
+    parser.add_argument('--partitions', help="extract rows to this many hash partitions per table, which are sorted"
+                                             " in memory while loading instead of sorting each table (each partition"
+                                             " must fit in memory)", type=int, default=0)
+    parser.add_argument('--blocks-dir', help="read blocks directly from the blk*.dat files in this directory instead of"
+                                             " requesting them from the REST server (for example"
+                                             " '/root/.bitcoin/blocks')", type=str)
     parser.add_argument('--initial', help="initial pass, optimize import", action="store_true")
     parser.add_argument('--cleanup', help="cleanup files on startup", action="store_true")
     parser.add_argument('--single', help="run only a single phase", action="store_true")
+    parser.add_argument('--batch-size', help="number of keys read and written per query when updating the database"
+                                             " after the --initial pass (defaults to 1000)", type=int, default=1000)
+    parser.add_argument('--phase-concurrency', help="number of phases that don't depend on each other to run at the"
+                                                    " same time, each in its own process (defaults to 1)", type=int,
+                        default=1)
     parser.add_argument('--compress-level', help="compress level for temporary files (0-9, defaults to 6)", type=int)
     parser.add_argument('--host', help="coin daemon host and port (for example 'localhost:8332')", type=str)
+    parser.add_argument('--fetch-concurrency', help="number of concurrent block requests (defaults to 4)", type=int,
+                        default=4)
+    parser.add_argument('--prefetch-window', help="maximum number of blocks requested ahead of processing (defaults to 16)",
+                        type=int, default=16)
     parser.add_argument('-v', dest='verbose', action='count', help="verbose output", default=0)
     globals.args = parser.parse_args()
     globals.settings = settings
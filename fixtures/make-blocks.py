@@ -0,0 +1,148 @@
+'''
+Generate fixtures/blocks.json: raw blocks with the JSON output of the daemon's /rest/block/<hash>.json endpoint for the
+same blocks, compared by blockparser-test.py.
+
+ - height 0: the bitcoin genesis block (a P2PK output)
+ - height 1: a synthetic block with a segwit coinbase, a segwit transaction paying to P2WSH, P2TR (bech32m), witness
+   versions 16 and 2 (bech32m), P2PKH, P2SH, nulldata and bare multisig outputs, and a legacy transaction spending
+   from it to a compressed P2PK output
+
+The expected addresses are spelled out: they come from the BIP173 and BIP350 test vectors and well-known keys, not from
+include/address.py.
+
+Run from the repository root: python fixtures/make-blocks.py
+'''
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Custom libraries:
+from fixtures import synthetic
+
+
+GENESIS = bytes.fromhex(
+    '0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3'
+    '888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c0101000000010000000000000000000000000000000000000000000000000000'
+    '000000000000ffffffff4d04ffff001d0104455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f6e2062'
+    '72696e6b206f66207365636f6e64206261696c6f757420666f722062616e6b73ffffffff0100f2052a01000000434104678afdb0fe554827'
+    '1967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac'
+    '00000000')
+GENESIS_HASH = '000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f'
+GENESIS_TXID = '4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b'
+GENESIS_COINBASE = '04ffff001d0104455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f6e206272696e6b206f' \
+                   '66207365636f6e64206261696c6f757420666f722062616e6b73'
+GENESIS_PUBKEY = '04678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c' \
+                 '384df7ba0b8d578a4c702b6bf11d5f'
+# The public key of private key 1.
+G_PUBKEY = '0279be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798'
+
+# (scriptPubKey, type, addresses)
+OUTPUTS = {
+    'p2pk': ('41' + GENESIS_PUBKEY + 'ac', 'pubkey', ['1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa']),
+    'p2pk_compressed': ('21' + G_PUBKEY + 'ac', 'pubkey', ['1BgGZ9tcN4rm9KBzDn7KprQz87SZ26SAMH']),
+    'p2pkh': ('76a91477bff20c60e522dfaa3350c39b030a5d004e839a88ac', 'pubkeyhash',
+              ['1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN2']),
+    'p2sh': ('a914b472a266d0bd89c13706a4132ccfb16f7c3b9fcb87', 'scripthash', ['3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy']),
+    'p2wpkh': ('0014751e76e8199196d454941c45d1b3a323f1433bd6', 'witness_v0_keyhash',
+               ['bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4']),
+    'p2wsh': ('00201863143c14c5166804bd19203356da136c985678cd4d27a1b8c6329604903262', 'witness_v0_scripthash',
+              ['bc1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3qccfmv3']),
+    'p2tr': ('512079be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798', 'witness_v1_taproot',
+             ['bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqzk5jj0']),
+    'witness_v16': ('6002751e', 'witness_unknown', ['bc1sw50qgdz25j']),
+    'witness_v2': ('5210751e76e8199196d454941c45d1b3a323', 'witness_unknown', ['bc1zw508d6qejxtdg4y5r3zarvaryvaxxpcs']),
+    'nulldata': ('6a0b68656c6c6f20776f726c64', 'nulldata', None),
+    'multisig': ('5141' + GENESIS_PUBKEY + '21' + G_PUBKEY + '52ae', 'multisig',
+                 ['1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa', '1BgGZ9tcN4rm9KBzDn7KprQz87SZ26SAMH']),
+}
+
+def json_vout(n, value, output):
+    '''
+    A vout of the daemon's JSON output, with the value in satoshis.
+    '''
+    script_pubkey, type, addresses = OUTPUTS[output]
+    vout = {
+        'value': float('%d.%08d' % divmod(value, 100000000)),
+        'n': n,
+        'scriptPubKey': {'hex': script_pubkey, 'type': type},
+    }
+    if addresses:
+        vout['scriptPubKey']['reqSigs'] = 1
+        vout['scriptPubKey']['addresses'] = addresses
+    return vout
+
+def json_tx(txid, vin, vout):
+    return {'txid': txid, 'vin': vin, 'vout': [json_vout(n, value, output) for n, (value, output) in enumerate(vout)]}
+
+def genesis():
+    json_block = {
+        'hash': GENESIS_HASH,
+        'height': 0,
+        'version': 1,
+        'merkleroot': GENESIS_TXID,
+        'time': 1231006505,
+        'nonce': 2083236893,
+        'bits': '1d00ffff',
+        'tx': [json_tx(GENESIS_TXID, [{'coinbase': GENESIS_COINBASE, 'sequence': 4294967295}],
+                       [(50 * 100000000, 'p2pk')])],
+    }
+    return GENESIS, json_block
+
+def segwit_block():
+    # Coinbase with the witness reserved value.
+    coinbase_vout = [(5000000000, 'p2wpkh'), (0, 'nulldata')]
+    coinbase_script = bytes.fromhex('510101')
+    coinbase, coinbase_txid = synthetic.transaction(
+        [(None, 0, coinbase_script)], [(value, bytes.fromhex(OUTPUTS[output][0])) for value, output in coinbase_vout],
+        witnesses=[[b'\0' * 32]])
+
+    # Spends the genesis output, with a witness.
+    segwit_vout = [(1234567891, 'p2wsh'), (100000000, 'p2tr'), (1, 'witness_v16'), (10000, 'witness_v2'),
+                   (2500000000, 'p2pkh'), (33333333, 'p2sh'), (0, 'nulldata'), (546, 'multisig')]
+    segwit, segwit_txid = synthetic.transaction(
+        [(GENESIS_TXID, 0, b'')], [(value, bytes.fromhex(OUTPUTS[output][0])) for value, output in segwit_vout],
+        witnesses=[[b'\x30' * 71, bytes.fromhex(G_PUBKEY)]], version=2)
+
+    # Spends two outputs of the segwit transaction, without witness data.
+    legacy_vout = [(2499990000, 'p2pk_compressed'), (10000000, 'p2pkh')]
+    legacy, legacy_txid = synthetic.transaction(
+        [(segwit_txid, 4, synthetic.push(b'\x30' * 71) + synthetic.push(bytes.fromhex(G_PUBKEY))),
+         (segwit_txid, 5, synthetic.push(b'\x51'))],
+        [(value, bytes.fromhex(OUTPUTS[output][0])) for value, output in legacy_vout])
+
+    raw, hash = synthetic.block(GENESIS_HASH, [(coinbase, coinbase_txid), (segwit, segwit_txid),
+                                               (legacy, legacy_txid)], 1600000000)
+    json_block = {
+        'hash': hash,
+        'height': 1,
+        'previousblockhash': GENESIS_HASH,
+        'time': 1600000000,
+        'tx': [
+            json_tx(coinbase_txid, [{'coinbase': coinbase_script.hex(), 'sequence': 4294967295}], coinbase_vout),
+            json_tx(segwit_txid, [{'txid': GENESIS_TXID, 'vout': 0, 'sequence': 4294967295}], segwit_vout),
+            json_tx(legacy_txid, [{'txid': segwit_txid, 'vout': 4, 'sequence': 4294967295},
+                                  {'txid': segwit_txid, 'vout': 5, 'sequence': 4294967295}], legacy_vout),
+        ],
+    }
+    return raw, json_block
+
+def main():
+    genesis_raw, _ = genesis()
+    # The genesis block and its coinbase are hashed like any other block and transaction.
+    assert synthetic.address.sha256d(genesis_raw[:80])[::-1].hex() == GENESIS_HASH
+    assert synthetic.address.sha256d(genesis_raw[81:])[::-1].hex() == GENESIS_TXID
+    assert synthetic.merkle_root([GENESIS_TXID]) == genesis_raw[36:68]
+
+    blocks = []
+    for raw, json_block in (genesis(), segwit_block()):
+        blocks.append({'coin': 'bitcoin', 'height': json_block['height'], 'raw': raw.hex(), 'json': json_block})
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blocks.json')
+    with open(path, 'w') as f:
+        json.dump(blocks, f, indent=1)
+        f.write('\n')
+    print("wrote %d blocks to %s" % (len(blocks), path))
+
+if __name__ == '__main__':
+    main()
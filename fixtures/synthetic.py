@@ -0,0 +1,140 @@
+'''
+Synthetic transactions, blocks and block files, to test the raw block parser and the block file reader without a coin
+daemon.
+
+Blocks aren't mined: their headers link to the previous block and carry the bits the chain work is computed from, but
+their hashes don't meet the target.
+'''
+import os
+import struct
+
+# Custom libraries:
+from include import address
+
+
+# Compact bits of the regtest proof of work limit, the least work a block can have.
+REGTEST_BITS = 0x207fffff
+
+def varint(value):
+    if value < 0xfd:
+        return bytes([value])
+    elif value <= 0xffff:
+        return b'\xfd' + struct.pack('<H', value)
+    elif value <= 0xffffffff:
+        return b'\xfe' + struct.pack('<I', value)
+    return b'\xff' + struct.pack('<Q', value)
+
+def push(data):
+    '''
+    A script pushing data.
+    '''
+    return varint(len(data)) + data
+
+def transaction(vin, vout, witnesses=None, version=1, locktime=0):
+    '''
+    Serialize a transaction.
+
+    :param vin: list of (txid, vout, scriptSig) tuples, with a None txid for the coinbase input.
+    :param vout: list of (value in satoshis, scriptPubKey) tuples.
+    :param witnesses: optional list of witness stacks (lists of bytes), one per input.
+    :return: tuple of (serialized transaction, txid).
+    '''
+    inputs = varint(len(vin))
+    for txid, n, script_sig in vin:
+        if txid is None:
+            inputs += b'\0' * 32 + struct.pack('<I', 0xffffffff)
+        else:
+            inputs += bytes.fromhex(txid)[::-1] + struct.pack('<I', n)
+        inputs += push(script_sig) + struct.pack('<I', 0xffffffff)
+    outputs = varint(len(vout))
+    for value, script_pubkey in vout:
+        outputs += struct.pack('<q', value) + push(script_pubkey)
+
+    prefix = struct.pack('<i', version)
+    suffix = struct.pack('<I', locktime)
+    # The txid is the hash of the transaction serialized without witness data.
+    txid = address.sha256d(prefix + inputs + outputs + suffix)[::-1].hex()
+    if witnesses is None:
+        return prefix + inputs + outputs + suffix, txid
+    witness = b''.join(varint(len(stack)) + b''.join(push(item) for item in stack) for stack in witnesses)
+    return prefix + b'\0\1' + inputs + outputs + witness + suffix, txid
+
+def merkle_root(txids):
+    hashes = [bytes.fromhex(txid)[::-1] for txid in txids]
+    while len(hashes) > 1:
+        if len(hashes) % 2:
+            hashes.append(hashes[-1])
+        hashes = [address.sha256d(hashes[i] + hashes[i + 1]) for i in range(0, len(hashes), 2)]
+    return hashes[0]
+
+def header(previous_hash, txids, timestamp, bits=REGTEST_BITS, version=0x20000000, nonce=0):
+    '''
+    Serialize a block header.
+
+    :param previous_hash: hash of the previous block (hex), None for a genesis block.
+    '''
+    previous = bytes.fromhex(previous_hash)[::-1] if previous_hash else b'\0' * 32
+    return struct.pack('<i', version) + previous + merkle_root(txids) + struct.pack('<III', timestamp, bits, nonce)
+
+def block(previous_hash, transactions, timestamp, bits=REGTEST_BITS, version=0x20000000, nonce=0):
+    '''
+    Serialize a block.
+
+    :param transactions: list of (serialized transaction, txid) tuples, from transaction().
+    :return: tuple of (serialized block, block hash).
+    '''
+    block_header = header(previous_hash, [txid for _, txid in transactions], timestamp, bits, version, nonce)
+    raw = block_header + varint(len(transactions)) + b''.join(tx for tx, _ in transactions)
+    return raw, address.sha256d(block_header)[::-1].hex()
+
+def chain(length, previous_hash=None, timestamp=1600000000, bits=REGTEST_BITS, tag=b''):
+    '''
+    A chain of blocks with only a coinbase transaction each.
+
+    :param previous_hash: the block the chain builds on, None to start with a genesis block.
+    :param tag: added to the coinbase of each block, so that forks have different block hashes.
+    :return: list of (serialized block, block hash) tuples.
+    '''
+    blocks = []
+    for n in range(length):
+        coinbase = transaction([(None, 0, push(struct.pack('<I', n)) + tag)], [(50 * 100000000, b'\x51')])
+        raw, previous_hash = block(previous_hash, [coinbase], timestamp + n * 600, bits)
+        blocks.append((raw, previous_hash))
+    return blocks
+
+def obfuscate(data, key, offset):
+    '''
+    XOR data written at an offset of a block file with the obfuscation key (the same operation deobfuscates it).
+    '''
+    if not key:
+        return data
+    stream = (key * (len(data) // len(key) + 2))[offset % len(key):offset % len(key) + len(data)]
+    return bytes(a ^ b for a, b in zip(data, stream))
+
+def write_block_files(blocks_dir, magic, blocks, blocks_per_file=None, xor_key=None, preallocate=0):
+    '''
+    Write blocks to blk*.dat files the way the daemon stores them: each block prefixed by the network magic and its
+    size, optionally obfuscated with the key in xor.dat.
+
+    :param magic: the network magic bytes, see blockfiles.get_magic().
+    :param blocks: list of serialized blocks, in the order they are written.
+    :param blocks_per_file: number of blocks per file, all blocks are written to a single file by default.
+    :param xor_key: optional 8 byte obfuscation key, written to xor.dat.
+    :param preallocate: number of zero bytes appended to the last file, like the daemon preallocates files.
+    :return: list of the files written.
+    '''
+    os.makedirs(blocks_dir, exist_ok=True)
+    if xor_key is not None:
+        with open(os.path.join(blocks_dir, 'xor.dat'), 'wb') as f_xor:
+            f_xor.write(xor_key)
+    blocks_per_file = blocks_per_file or max(len(blocks), 1)
+    paths = []
+    for file_number, first in enumerate(range(0, max(len(blocks), 1), blocks_per_file)):
+        data = b''.join(magic + struct.pack('<I', len(raw)) + raw for raw in blocks[first:first + blocks_per_file])
+        if first + blocks_per_file >= len(blocks):
+            data += b'\0' * preallocate
+        path = os.path.join(blocks_dir, 'blk%05d.dat' % file_number)
+        with open(path, 'wb') as f_block:
+            f_block.write(obfuscate(data, xor_key, 0))
+        paths.append(path)
+    return paths
@@ -0,0 +1,369 @@
+'''
+Address encoding for bitcoin-style coins: base58check (P2PKH, P2SH) and bech32/bech32m (segwit), and offline
+validation of addresses like the coin daemons' validateaddress RPC.
+
+Each coin's version bytes and bech32 human readable part are configured in settings.coins.
+'''
+import functools
+import hashlib
+import operator
+
+# Custom libraries:
+from include import globals
+
+
+BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+BECH32_ALPHABET = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+BECH32_CONSTANT = 1
+BECH32M_CONSTANT = 0x2bc830a3
+BASE58_VALUES = {character: value for value, character in enumerate(BASE58_ALPHABET)}
+# Base58 characters to their values, other bytes to 255.
+BASE58_BYTES = bytes(BASE58_VALUES.get(chr(byte), 255) for byte in range(256))
+# Bech32 characters to their 5-bit values, other bytes to 255.
+BECH32_VALUES = bytes(BECH32_ALPHABET.index(chr(byte)) if chr(byte) in BECH32_ALPHABET else 255
+                      for byte in range(256))
+# Bech32 characters to base 32 digits, to convert the data part with int().
+BECH32_DIGITS = str.maketrans(BECH32_ALPHABET, '0123456789abcdefghijklmnopqrstuv')
+
+def get_address_settings(coin):
+    '''
+    Address version bytes and bech32 human readable part for a coin, from settings.coins.
+
+    :param coin: the coin type.
+    :return: dictionary with pubkey_address, script_address and bech32_hrp (None if the coin has no segwit).
+    '''
+    coin_settings = globals.settings.coins[coin]
+    return {
+        'pubkey_address': coin_settings.get('pubkey_address', 0x00),
+        'script_address': coin_settings.get('script_address', 0x05),
+        # Older version byte of P2SH addresses still accepted by the daemon, if the coin changed it.
+        'script_address2': coin_settings.get('script_address2'),
+        'bech32_hrp': coin_settings.get('bech32_hrp'),
+    }
+
+def sha256d(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+def ripemd160(data):
+    try:
+        return hashlib.new('ripemd160', data).digest()
+    except ValueError:
+        # OpenSSL 3 only provides ripemd160 through its legacy provider, which may not be loaded.
+        return ripemd160_fallback(data)
+
+# Pure python RIPEMD-160, only used if hashlib doesn't provide it.
+RIPEMD160_R1 = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 7, 4, 13, 1, 10, 6, 15, 3, 12, 0, 9, 5, 2, 14,
+                11, 8, 3, 10, 14, 4, 9, 15, 8, 1, 2, 7, 0, 6, 13, 11, 5, 12, 1, 9, 11, 10, 0, 8, 12, 4, 13, 3, 7, 15,
+                14, 5, 6, 2, 4, 0, 5, 9, 7, 12, 2, 10, 14, 1, 3, 8, 11, 6, 15, 13]
+RIPEMD160_R2 = [5, 14, 7, 0, 9, 2, 11, 4, 13, 6, 15, 8, 1, 10, 3, 12, 6, 11, 3, 7, 0, 13, 5, 10, 14, 15, 8, 12, 4, 9,
+                1, 2, 15, 5, 1, 3, 7, 14, 6, 9, 11, 8, 12, 2, 10, 0, 4, 13, 8, 6, 4, 1, 3, 11, 15, 0, 5, 12, 2, 13, 9,
+                7, 10, 14, 12, 15, 10, 4, 1, 5, 8, 7, 6, 2, 13, 14, 0, 3, 9, 11]
+RIPEMD160_S1 = [11, 14, 15, 12, 5, 8, 7, 9, 11, 13, 14, 15, 6, 7, 9, 8, 7, 6, 8, 13, 11, 9, 7, 15, 7, 12, 15, 9, 11, 7,
+                13, 12, 11, 13, 6, 7, 14, 9, 13, 15, 14, 8, 13, 6, 5, 12, 7, 5, 11, 12, 14, 15, 14, 15, 9, 8, 9, 14, 5,
+                6, 8, 6, 5, 12, 9, 15, 5, 11, 6, 8, 13, 12, 5, 12, 13, 14, 11, 8, 5, 6]
+RIPEMD160_S2 = [8, 9, 9, 11, 13, 15, 15, 5, 7, 7, 8, 11, 14, 14, 12, 6, 9, 13, 15, 7, 12, 8, 9, 11, 7, 7, 12, 7, 6, 15,
+                13, 11, 9, 7, 15, 11, 8, 6, 6, 14, 12, 13, 5, 14, 13, 13, 7, 5, 15, 5, 8, 11, 14, 14, 6, 14, 6, 9, 12,
+                9, 12, 5, 15, 8, 8, 5, 12, 9, 12, 5, 14, 6, 8, 13, 6, 5, 15, 13, 11, 11]
+RIPEMD160_K1 = [0x00000000, 0x5a827999, 0x6ed9eba1, 0x8f1bbcdc, 0xa953fd4e]
+RIPEMD160_K2 = [0x50a28be6, 0x5c4dd124, 0x6d703ef3, 0x7a6d76e9, 0x00000000]
+
+def ripemd160_f(j, x, y, z):
+    if j < 16:
+        return x ^ y ^ z
+    elif j < 32:
+        return (x & y) | (~x & z)
+    elif j < 48:
+        return (x | ~y) ^ z
+    elif j < 64:
+        return (x & z) | (y & ~z)
+    return x ^ (y | ~z)
+
+def ripemd160_fallback(data):
+    def rol(x, n):
+        x &= 0xffffffff
+        return ((x << n) | (x >> (32 - n))) & 0xffffffff
+
+    h = [0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476, 0xc3d2e1f0]
+    message = data + b'\x80' + b'\0' * ((55 - len(data)) % 64) + (len(data) * 8).to_bytes(8, 'little')
+    for block in range(0, len(message), 64):
+        x = [int.from_bytes(message[block + i * 4:block + i * 4 + 4], 'little') for i in range(16)]
+        al, bl, cl, dl, el = h
+        ar, br, cr, dr, er = h
+        for j in range(80):
+            t = rol(al + ripemd160_f(j, bl, cl, dl) + x[RIPEMD160_R1[j]] + RIPEMD160_K1[j // 16], RIPEMD160_S1[j])
+            t = (t + el) & 0xffffffff
+            al, el, dl, cl, bl = el, dl, rol(cl, 10), bl, t
+            t = rol(ar + ripemd160_f(79 - j, br, cr, dr) + x[RIPEMD160_R2[j]] + RIPEMD160_K2[j // 16], RIPEMD160_S2[j])
+            t = (t + er) & 0xffffffff
+            ar, er, dr, cr, br = er, dr, rol(cr, 10), br, t
+        t = (h[1] + cl + dr) & 0xffffffff
+        h[1] = (h[2] + dl + er) & 0xffffffff
+        h[2] = (h[3] + el + ar) & 0xffffffff
+        h[3] = (h[4] + al + br) & 0xffffffff
+        h[4] = (h[0] + bl + cr) & 0xffffffff
+        h[0] = t
+    return b''.join(value.to_bytes(4, 'little') for value in h)
+
+def hash160(data):
+    return ripemd160(hashlib.sha256(data).digest())
+
+def base58_encode(data):
+    number = int.from_bytes(data, 'big')
+    encoded = ''
+    while number:
+        number, remainder = divmod(number, 58)
+        encoded = BASE58_ALPHABET[remainder] + encoded
+    # Each leading zero byte is encoded as a leading '1'.
+    padding = len(data) - len(data.lstrip(b'\0'))
+    return BASE58_ALPHABET[0] * padding + encoded
+
+def base58check_encode(version, payload):
+    data = bytes([version]) + payload
+    return base58_encode(data + sha256d(data)[:4])
+
+def bech32_polymod(values, checksum=1):
+    generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+    for value in values:
+        top = checksum >> 25
+        checksum = (checksum & 0x1ffffff) << 5 ^ value
+        for i in range(5):
+            checksum ^= generator[i] if ((top >> i) & 1) else 0
+    return checksum
+
+def bech32_hrp_expand(hrp):
+    return [ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp]
+
+BECH32_MAX_LENGTH = 90
+# bech32_polymod() is linear: the checksum of an address is the xor of the contribution of each value, which only
+# depends on the value and its distance from the end of the address. Contributions of each distance, farthest first.
+BECH32_CONTRIBUTIONS = [list(range(32))]
+for _ in range(BECH32_MAX_LENGTH - 1):
+    BECH32_CONTRIBUTIONS.insert(0, [bech32_polymod([0], checksum) for checksum in BECH32_CONTRIBUTIONS[0]])
+# The same contributions for each byte of the data part read as a number, least significant byte first: 8 bits at a
+# time instead of 5.
+BECH32_BYTE_CONTRIBUTIONS = []
+for first_bit in range(0, BECH32_MAX_LENGTH * 5, 8):
+    bit_contributions = [BECH32_CONTRIBUTIONS[-1 - bit // 5][1 << bit % 5] if bit < BECH32_MAX_LENGTH * 5 else 0
+                         for bit in range(first_bit, first_bit + 8)]
+    BECH32_BYTE_CONTRIBUTIONS.append([functools.reduce(operator.xor, (contribution for i, contribution in
+                                                                      enumerate(bit_contributions) if byte >> i & 1), 0)
+                                      for byte in range(256)])
+
+@functools.lru_cache(maxsize=None)
+def bech32_hrp_checksum(hrp, length):
+    '''
+    bech32_polymod() of the human readable part followed by a data part of length zero values.
+    '''
+    return bech32_polymod(bech32_hrp_expand(hrp) + [0] * length)
+
+def bech32_checksum(hrp, values, number=None):
+    '''
+    bech32_polymod() of an address, from the precomputed contributions of its values.
+
+    :param values: the 5-bit values of the data part, including the checksum.
+    :param number: optional values read as a base 32 number, to add the contributions of its bytes instead.
+    '''
+    if number is not None:
+        return functools.reduce(operator.xor, map(operator.getitem, BECH32_BYTE_CONTRIBUTIONS,
+                                                  number.to_bytes((len(values) * 5 + 7) // 8, 'little')),
+                                bech32_hrp_checksum(hrp, len(values)))
+    return functools.reduce(operator.xor, map(operator.getitem, BECH32_CONTRIBUTIONS[-len(values):], values),
+                            bech32_hrp_checksum(hrp, len(values)))
+
+def convert_bits(data, from_bits, to_bits, pad=True):
+    accumulator = bits = 0
+    converted = []
+    max_value = (1 << to_bits) - 1
+    for value in data:
+        if value < 0 or (value >> from_bits):
+            return None
+        accumulator = (accumulator << from_bits) | value
+        bits += from_bits
+        while bits >= to_bits:
+            bits -= to_bits
+            converted.append((accumulator >> bits) & max_value)
+    if pad:
+        if bits:
+            converted.append((accumulator << (to_bits - bits)) & max_value)
+    elif bits >= from_bits or ((accumulator << (to_bits - bits)) & max_value):
+        return None
+    return converted
+
+def segwit_encode(hrp, witness_version, witness_program):
+    '''
+    Encode a segwit address: bech32 for version 0 witness programs, bech32m (BIP350) for version 1 and above.
+    '''
+    constant = BECH32_CONSTANT if witness_version == 0 else BECH32M_CONSTANT
+    data = [witness_version] + convert_bits(witness_program, 8, 5)
+    polymod = bech32_polymod(bech32_hrp_expand(hrp) + data + [0] * 6) ^ constant
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + '1' + ''.join([BECH32_ALPHABET[d] for d in data + checksum])
+
+def base58_decode(encoded):
+    '''
+    :return: the decoded bytes, or None if the string isn't base58.
+    '''
+    try:
+        values = encoded.encode('ascii').translate(BASE58_BYTES)
+    except UnicodeEncodeError:
+        return None
+    if 255 in values:
+        return None
+    number = 0
+    for value in values:
+        number = number * 58 + value
+    # Each leading '1' is a leading zero byte.
+    padding = len(encoded) - len(encoded.lstrip(BASE58_ALPHABET[0]))
+    return b'\0' * padding + number.to_bytes((number.bit_length() + 7) // 8, 'big')
+
+def base58check_decode(encoded):
+    '''
+    :return: the version byte and payload, or None if the string isn't base58 or its checksum doesn't match.
+    '''
+    data = base58_decode(encoded)
+    if data is None or len(data) < 5 or sha256d(data[:-4])[:4] != data[-4:]:
+        return None
+    return data[:-4]
+
+def segwit_decode(hrp, encoded):
+    '''
+    Decode a segwit address: bech32 for version 0 witness programs, bech32m (BIP350) for version 1 and above.
+
+    :return: tuple of (witness version, witness program), or None if the address is invalid.
+    '''
+    if len(encoded) > BECH32_MAX_LENGTH or (encoded != encoded.lower() and encoded != encoded.upper()):
+        return None
+    encoded = encoded.lower()
+    separator = encoded.rfind('1')
+    # The data part has at least the witness version and a 6 character checksum.
+    if encoded[:separator] != hrp or len(encoded) - separator < 8:
+        return None
+    try:
+        values = encoded[separator + 1:].encode('ascii').translate(BECH32_VALUES)
+    except UnicodeEncodeError:
+        return None
+    if 255 in values or values[0] > 16:
+        return None
+    witness_version = values[0]
+    number = int(encoded[separator + 1:].translate(BECH32_DIGITS), 32)
+    if bech32_checksum(hrp, values, number) != (BECH32_CONSTANT if witness_version == 0 else BECH32M_CONSTANT):
+        return None
+    length, padding = divmod((len(values) - 7) * 5, 8)
+    if padding > 4 or not 2 <= length <= 40 or (witness_version == 0 and length not in (20, 32)):
+        return None
+    # The witness program, without the witness version and the checksum.
+    program = (number >> 30) & ((1 << (len(values) - 7) * 5) - 1)
+    if program & ((1 << padding) - 1):
+        return None
+    return witness_version, (program >> padding).to_bytes(length, 'big')
+
+def validate_address(encoded, address_settings):
+    '''
+    Validate an address offline, returning the same fields as the coin daemon's validateaddress RPC.
+
+    :param encoded: the address.
+    :param address_settings: version bytes and bech32 human readable part, from get_address_settings().
+    :return: dictionary with isvalid, and for valid addresses the address, scriptPubKey (hex), isscript, iswitness,
+      and the witness_version and witness_program of segwit addresses.
+    '''
+    hrp = address_settings['bech32_hrp']
+    decoded = segwit_decode(hrp, encoded) if hrp and encoded[:len(hrp) + 1].lower() == hrp + '1' else None
+    if decoded is not None:
+        witness_version, witness_program = decoded
+        validated = {
+            'isvalid': True,
+            'address': encoded.lower(),
+            'scriptPubKey': (bytes([witness_version + 0x50 if witness_version else 0, len(witness_program)]) +
+                             witness_program).hex(),
+        }
+        # P2WSH and P2TR pay to scripts, other witness versions are unknown to the daemon.
+        if witness_version == 0:
+            validated['isscript'] = len(witness_program) == 32
+        elif witness_version == 1 and len(witness_program) == 32:
+            validated['isscript'] = True
+        validated['iswitness'] = True
+        validated['witness_version'] = witness_version
+        validated['witness_program'] = witness_program.hex()
+        return validated
+
+    data = base58check_decode(encoded)
+    if data is not None and len(data) == 21:
+        version, payload = data[0], data[1:]
+        if version == address_settings['pubkey_address']:
+            return {
+                'isvalid': True,
+                'address': encoded,
+                'scriptPubKey': '76a914' + payload.hex() + '88ac',
+                'isscript': False,
+                'iswitness': False,
+            }
+        if version in (address_settings['script_address'], address_settings['script_address2']):
+            return {
+                'isvalid': True,
+                # The daemon encodes addresses with the current version byte.
+                'address': encoded if version == address_settings['script_address'] else
+                           base58check_encode(address_settings['script_address'], payload),
+                'scriptPubKey': 'a914' + payload.hex() + '87',
+                'isscript': True,
+                'iswitness': False,
+            }
+        return {'isvalid': False, 'error': 'Invalid prefix for Base58-encoded address'}
+    return {'isvalid': False, 'error': 'Invalid address'}
+
+def is_valid_pubkey(pubkey):
+    if len(pubkey) == 33:
+        return pubkey[0] in (0x02, 0x03)
+    elif len(pubkey) == 65:
+        return pubkey[0] in (0x04, 0x06, 0x07)
+    return False
+
+def script_to_addresses(script, address_settings):
+    '''
+    Derive addresses from a scriptPubKey, following the same rules the coin daemons use to populate the
+    `addresses` list of a vout's scriptPubKey.
+
+    :param script: the scriptPubKey, as bytes.
+    :param address_settings: version bytes and bech32 human readable part, from get_address_settings().
+    :return: list of addresses, empty if none can be derived (for example nulldata or non-standard scripts).
+    '''
+    length = len(script)
+    # P2PKH: OP_DUP OP_HASH160 <20 bytes> OP_EQUALVERIFY OP_CHECKSIG
+    if length == 25 and script[0] == 0x76 and script[1] == 0xa9 and script[2] == 0x14 and script[23] == 0x88 \
+            and script[24] == 0xac:
+        return [base58check_encode(address_settings['pubkey_address'], script[3:23])]
+    # P2SH: OP_HASH160 <20 bytes> OP_EQUAL
+    if length == 23 and script[0] == 0xa9 and script[1] == 0x14 and script[22] == 0x87:
+        return [base58check_encode(address_settings['script_address'], script[2:22])]
+    # Segwit: OP_0..OP_16 <2 to 40 bytes>
+    if address_settings['bech32_hrp'] and 4 <= length <= 42 and (script[0] == 0 or 0x51 <= script[0] <= 0x60) \
+            and script[1] == length - 2:
+        witness_version = script[0] - 0x50 if script[0] else 0
+        witness_program = script[2:]
+        if witness_version != 0 or len(witness_program) in (20, 32):
+            return [segwit_encode(address_settings['bech32_hrp'], witness_version, witness_program)]
+        return []
+    # P2PK: <33 or 65 byte pubkey> OP_CHECKSIG
+    if length in (35, 67) and script[0] == length - 2 and script[-1] == 0xac:
+        pubkey = script[1:-1]
+        if is_valid_pubkey(pubkey):
+            return [base58check_encode(address_settings['pubkey_address'], hash160(pubkey))]
+        return []
+    # Bare multisig: OP_m <pubkey> ... <pubkey> OP_n OP_CHECKMULTISIG
+    if length >= 37 and script[-1] == 0xae and 0x51 <= script[0] <= 0x60 and 0x51 <= script[-2] <= 0x60:
+        addresses = []
+        pubkeys = 0
+        offset = 1
+        while offset < length - 2:
+            size = script[offset]
+            if size not in (33, 65) or offset + 1 + size > length - 2:
+                return []
+            pubkey = script[offset + 1:offset + 1 + size]
+            # Like the daemon, invalid pubkeys are skipped rather than invalidating the whole script.
+            if is_valid_pubkey(pubkey):
+                addresses.append(base58check_encode(address_settings['pubkey_address'], hash160(pubkey)))
+            pubkeys += 1
+            offset += 1 + size
+        if pubkeys != script[-2] - 0x50 or script[0] > script[-2]:
+            return []
+        return addresses
+    return []
@@ -0,0 +1,221 @@
+'''
+Read blocks directly from a coin daemon's blocks/blk*.dat files, without going through its REST server.
+
+Each blk*.dat file is a sequence of blocks, each prefixed by the network magic and the size of the block. Blocks are
+not stored in height order and the files also contain blocks that aren't part of the best chain, so we first index
+every block header, then follow the previous block hash links back from the tip with the most work to order the best
+chain by height.
+'''
+import glob
+import mmap
+import os
+import struct
+
+# Custom libraries:
+from include import address
+from include import blockparser
+from include import globals
+from include import utils
+
+
+def get_magic(coin):
+    '''
+    The network magic bytes prefixing each block in the coin's block files, from settings.coins.
+    '''
+    return bytes.fromhex(globals.settings.coins[coin]['magic'])
+
+def get_blocks_dir(coin):
+    '''
+    The directory containing the coin's blk*.dat files: --blocks-dir, or blocks_dir in settings.coins.
+    '''
+    try:
+        if globals.args.blocks_dir:
+            return globals.args.blocks_dir
+    except:
+        pass
+    return globals.settings.coins[coin]['blocks_dir']
+
+def read_xor_key(blocks_dir):
+    '''
+    Newer versions of bitcoin core obfuscate the block files with the key stored in blocks/xor.dat.
+
+    :return: the key, or None if the block files are not obfuscated.
+    '''
+    path = os.path.join(blocks_dir, 'xor.dat')
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f_xor:
+        key = f_xor.read()
+    if not key.strip(b'\0'):
+        return None
+    return key
+
+def deobfuscate(data, key, offset):
+    '''
+    XOR data read at the specified offset of a block file with the obfuscation key.
+    '''
+    if not key:
+        return data
+    stream = (key * (len(data) // len(key) + 2))[offset % len(key):offset % len(key) + len(data)]
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(stream, 'big')).to_bytes(len(data), 'big')
+
+def block_files(blocks_dir):
+    '''
+    All blk*.dat files in the blocks directory, in file number order.
+    '''
+    return sorted(glob.glob(os.path.join(blocks_dir, 'blk[0-9]*.dat')))
+
+def open_block_file(path):
+    with open(path, 'rb') as f_block:
+        if os.fstat(f_block.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f_block.fileno(), 0, access=mmap.ACCESS_READ)
+
+def header_work(bits):
+    '''
+    The expected number of hashes needed to find a block with the target encoded in the compact bits field.
+    '''
+    exponent = bits >> 24
+    mantissa = bits & 0x007fffff
+    if exponent <= 3:
+        target = mantissa >> (8 * (3 - exponent))
+    else:
+        target = mantissa << (8 * (exponent - 3))
+    if target <= 0:
+        return 0
+    return (1 << 256) // (target + 1)
+
+def index_block_files(blocks_dir, magic, xor_key=None):
+    '''
+    Walk the magic/size framing of all block files, indexing every block header.
+
+    :param blocks_dir: directory containing the blk*.dat files.
+    :param magic: the network magic bytes.
+    :param xor_key: optional obfuscation key.
+    :return: dictionary mapping each block hash (bytes) to (previous block hash, bits, file number, offset, size).
+    '''
+    index = {}
+    for file_number, path in enumerate(block_files(blocks_dir)):
+        data = open_block_file(path)
+        if data is None:
+            continue
+        try:
+            offset = 0
+            length = len(data)
+            while offset + 88 <= length:
+                frame = deobfuscate(data[offset:offset + 8], xor_key, offset)
+                if frame[:4] != magic:
+                    if not frame.strip(b'\0'):
+                        # The daemon preallocates block files: the rest of the file is unused.
+                        break
+                    utils.vprint("%s: unexpected data at offset %d, skipping" % (path, offset), level=2)
+                    offset += 1
+                    continue
+                size, = struct.unpack('<I', frame[4:])
+                if offset + 8 + size > length:
+                    # The daemon is still writing this block.
+                    break
+                header = deobfuscate(data[offset + 8:offset + 88], xor_key, offset + 8)
+                hash = address.sha256d(header)
+                bits, = struct.unpack_from('<I', header, 72)
+                index[hash] = (header[4:36], bits, file_number, offset + 8, size)
+                offset += 8 + size
+        finally:
+            data.close()
+        utils.vprint("indexed %s (%d blocks so far)" % (path, len(index)), level=2)
+    return index
+
+def best_chain(index):
+    '''
+    Order the blocks of the best chain by height.
+
+    :param index: block index, from index_block_files().
+    :return: list of block hashes (bytes), starting with the genesis block.
+    '''
+    genesis_prev = b'\0' * 32
+    chain_work = {}
+    best_hash = None
+    best_work = -1
+    for hash in index:
+        # Walk back to a block with known chain work (or the genesis block), then fill in the work going forward.
+        path = []
+        current = hash
+        while current not in chain_work:
+            if current not in index:
+                # The parent of this block isn't in the block files: it can't be part of the best chain.
+                break
+            path.append(current)
+            current = index[current][0]
+            if current == genesis_prev:
+                break
+        if current in chain_work:
+            work = chain_work[current]
+        elif current == genesis_prev:
+            work = 0
+        else:
+            for orphan in path:
+                chain_work[orphan] = -1
+            continue
+        for block in reversed(path):
+            work = work + header_work(index[block][1]) if work >= 0 else -1
+            chain_work[block] = work
+            if work > best_work:
+                best_work = work
+                best_hash = block
+
+    chain = []
+    current = best_hash
+    while current is not None and current != genesis_prev:
+        chain.append(current)
+        current = index[current][0]
+    chain.reverse()
+    return chain
+
+def load_chain(coin, blocks_dir=None):
+    '''
+    Index the coin's block files and order the best chain.
+
+    :param coin: the coin type.
+    :param blocks_dir: directory containing the blk*.dat files, defaults to get_blocks_dir().
+    :return: dictionary with the blocks directory, obfuscation key, block index and best chain.
+    '''
+    if not blocks_dir:
+        blocks_dir = get_blocks_dir(coin)
+    xor_key = read_xor_key(blocks_dir)
+    index = index_block_files(blocks_dir, get_magic(coin), xor_key)
+    chain = best_chain(index)
+    utils.vprint("found %d blocks in best chain of %d blocks in %s" % (len(chain), len(index), blocks_dir))
+    return {
+        'blocks_dir': blocks_dir,
+        'xor_key': xor_key,
+        'index': index,
+        'chain': chain,
+    }
+
+def read_blocks(coin, chain, start_height=0, end_height=None):
+    '''
+    Read and parse the blocks of the best chain from the block files, in height order.
+
+    :param coin: the coin type.
+    :param chain: the indexed block files, from load_chain().
+    :param start_height: first height to read.
+    :param end_height: last height to read (inclusive), defaults to the tip.
+    :return: generator of parsed blocks.
+    '''
+    if end_height is None or end_height >= len(chain['chain']):
+        end_height = len(chain['chain']) - 1
+
+    address_settings = address.get_address_settings(coin)
+    auxpow = globals.settings.coins[coin].get('auxpow', False)
+    paths = block_files(chain['blocks_dir'])
+    files = {}
+    try:
+        for height in range(start_height, end_height + 1):
+            _, _, file_number, offset, size = chain['index'][chain['chain'][height]]
+            if file_number not in files:
+                files[file_number] = open_block_file(paths[file_number])
+            raw = deobfuscate(files[file_number][offset:offset + size], chain['xor_key'], offset)
+            yield blockparser.parse_block(raw, height, address_settings, auxpow=auxpow)
+    finally:
+        for data in files.values():
+            data.close()
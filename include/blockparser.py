@@ -0,0 +1,163 @@
+'''
+Parser for serialized (raw) blocks, as returned by the daemon's /rest/block/<hash>.bin endpoint and as stored in the
+daemon's blk*.dat files.
+
+Parsed blocks have the same structure as the subset of the /rest/block/<hash>.json output that we extract, so they
+can be processed by the same code.
+
+Dogecoin AuxPoW (merged mining) headers are supported. Litecoin MWEB extension blocks are not.
+'''
+import struct
+
+# Custom libraries:
+from include import address
+
+
+COINBASE_PREVOUT = b'\0' * 32
+
+def read_varint(raw, offset):
+    '''
+    Read a variable length integer.
+
+    :return: tuple of (value, offset of the next byte).
+    '''
+    value = raw[offset]
+    if value < 0xfd:
+        return value, offset + 1
+    elif value == 0xfd:
+        return struct.unpack_from('<H', raw, offset + 1)[0], offset + 3
+    elif value == 0xfe:
+        return struct.unpack_from('<I', raw, offset + 1)[0], offset + 5
+    else:
+        return struct.unpack_from('<Q', raw, offset + 1)[0], offset + 9
+
+def block_hash(header):
+    return address.sha256d(header)[::-1].hex()
+
+def parse_header(raw, offset=0):
+    '''
+    Parse an 80 byte block header.
+
+    :return: dictionary with the block hash, version, previous block hash, time and bits.
+    '''
+    version, = struct.unpack_from('<i', raw, offset)
+    timestamp, bits = struct.unpack_from('<II', raw, offset + 68)
+    return {
+        'hash': block_hash(bytes(raw[offset:offset + 80])),
+        'version': version,
+        'previousblockhash': bytes(raw[offset + 4:offset + 36])[::-1].hex(),
+        'time': timestamp,
+        'bits': bits,
+    }
+
+def skip_auxpow(raw, offset):
+    '''
+    Skip over the AuxPoW data that follows the header of merged mined blocks.
+    '''
+    # Coinbase transaction of the parent block.
+    _, offset = parse_transaction(raw, offset, None)
+    # Parent block hash.
+    offset += 32
+    # Coinbase merkle branch, then chain merkle branch, each followed by an index.
+    for _ in range(2):
+        count, offset = read_varint(raw, offset)
+        offset += count * 32 + 4
+    # Parent block header.
+    return offset + 80
+
+def parse_transaction(raw, offset, address_settings):
+    '''
+    Parse a serialized transaction, with or without witness data.
+
+    :param raw: the serialized block.
+    :param offset: offset of the transaction in the block.
+    :param address_settings: version bytes and bech32 human readable part used to derive addresses, or None to not
+      derive addresses.
+    :return: tuple of (transaction, offset of the next byte).
+    '''
+    start = offset
+    offset += 4
+    segwit = raw[offset] == 0 and raw[offset + 1] != 0
+    if segwit:
+        if raw[offset + 1] != 1:
+            raise ValueError("unsupported transaction flag %d" % raw[offset + 1])
+        offset += 2
+    inputs_start = offset
+
+    vin = []
+    count, offset = read_varint(raw, offset)
+    for _ in range(count):
+        prevout = bytes(raw[offset:offset + 32])
+        n, = struct.unpack_from('<I', raw, offset + 32)
+        size, offset = read_varint(raw, offset + 36)
+        if prevout == COINBASE_PREVOUT and n == 0xffffffff:
+            vin.append({
+                'coinbase': bytes(raw[offset:offset + size]).hex(),
+            })
+        else:
+            vin.append({
+                'txid': prevout[::-1].hex(),
+                'vout': n,
+            })
+        offset += size + 4
+
+    vout = []
+    count, offset = read_varint(raw, offset)
+    for n in range(count):
+        value, = struct.unpack_from('<q', raw, offset)
+        size, offset = read_varint(raw, offset + 8)
+        script_pubkey = {}
+        if address_settings:
+            addresses = address.script_to_addresses(bytes(raw[offset:offset + size]), address_settings)
+            if addresses:
+                script_pubkey['addresses'] = addresses
+        vout.append({
+            # Same floating point value the daemon's JSON output is decoded to.
+            'value': value / 100000000,
+            'n': n,
+            'scriptPubKey': script_pubkey,
+        })
+        offset += size
+    inputs_end = offset
+
+    if segwit:
+        for _ in range(len(vin)):
+            items, offset = read_varint(raw, offset)
+            for _ in range(items):
+                size, offset = read_varint(raw, offset)
+                offset += size
+
+    # The txid is the hash of the transaction serialized without witness data.
+    if segwit:
+        serialized = bytes(raw[start:start + 4]) + bytes(raw[inputs_start:inputs_end]) + bytes(raw[offset:offset + 4])
+    else:
+        serialized = bytes(raw[start:offset + 4])
+    return {
+        'txid': address.sha256d(serialized)[::-1].hex(),
+        'vin': vin,
+        'vout': vout,
+    }, offset + 4
+
+def parse_block(raw, height, address_settings, auxpow=False):
+    '''
+    Parse a serialized block.
+
+    :param raw: the serialized block, as bytes or a memoryview.
+    :param height: the height of the block, which isn't part of the serialized block.
+    :param address_settings: version bytes and bech32 human readable part, from address.get_address_settings().
+    :param auxpow: True if the coin supports merged mining (AuxPoW).
+    :return: the parsed block.
+    '''
+    block = parse_header(raw)
+    block['height'] = height
+    offset = 80
+    # Merged mined blocks flag the presence of AuxPoW data with bit 8 of the version.
+    if auxpow and block['version'] & 0x100:
+        offset = skip_auxpow(raw, offset)
+
+    block['tx'] = []
+    count, offset = read_varint(raw, offset)
+    for _ in range(count):
+        tx, offset = parse_transaction(raw, offset, address_settings)
+        block['tx'].append(tx)
+    return block
@@ -0,0 +1,239 @@
+'''
+Chain tip of each coin: the height and hash of the daemon's best block, which the API uses to count confirmations
+without asking the daemon in each request.
+
+The tip is published in a file shared by the workers: by the extract script, with the daemon's tip it extracted from,
+and by a background thread of each API worker polling the daemon (getblockchaininfo). The threads take turns: the
+first to find the tip older than poll_interval polls the daemon, holding a lock so the others skip it and read the
+tip it publishes.
+
+Requests read the tip kept in memory, checking the file at most every check_interval seconds, and only wait for the
+daemon when no tip was published yet (on a fresh deploy): the first request reads it with one synchronous RPC call,
+and the requests waiting for the lock meanwhile read the tip it publishes. The age of the tip is reported in the
+debug block of responses, and the tip is flagged as stale once older than max_age (for example while the daemon is
+down).
+'''
+import contextlib
+import fcntl
+import json
+import os
+import threading
+import time
+
+# Custom libraries:
+from include import globals
+from include import rpc
+from include import utils
+
+
+def get_tip_settings(coin):
+    '''
+    Chain tip settings, optionally overridden by a `chain_tip` dictionary in settings.py.
+    '''
+    tip_settings = {
+        'path': 'blockchain_data/{coin}/',
+        'poll': True,
+        'poll_interval': 5,
+        'check_interval': 1,
+        'max_age': 60,
+    }
+    try:
+        tip_settings.update(globals.settings.chain_tip)
+    except:
+        pass
+    tip_settings['path'] = tip_settings['path'].replace('{coin}', coin)
+    return tip_settings
+
+def get_tip_file(coin):
+    return os.path.join(get_tip_settings(coin)['path'], 'chain_tip.json')
+
+def read_tip(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_tip(filename, tip):
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(tip, f)
+    os.replace(filename + '.tmp', filename)
+
+@contextlib.contextmanager
+def tip_lock(path, blocking=True):
+    '''
+    Serialize updates of the tip file.
+
+    :param blocking: wait for the lock, otherwise yield False if another process holds it.
+    '''
+    with open(os.path.join(path, 'chain_tip.lock'), 'w') as f_lock:
+        try:
+            fcntl.flock(f_lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f_lock, fcntl.LOCK_UN)
+
+def publish(coin, height, hash, source, updated=None):
+    '''
+    Publish the chain tip of a coin.
+
+    :param source: 'daemon' when polled from the daemon, which replaces any tip, or 'extract' when published by the
+      extract script, which doesn't replace a higher tip polled since it started.
+    :param updated: when the tip was read from the daemon, defaults to now.
+    :return: the tip in the file.
+    '''
+    filename = get_tip_file(coin)
+    path = os.path.dirname(filename) or '.'
+    os.makedirs(path, exist_ok=True)
+    with tip_lock(path):
+        tip = read_tip(filename)
+        if source == 'daemon' or tip is None or tip['height'] < height:
+            tip = {'height': height, 'hash': hash, 'source': source, 'updated': updated or time.time()}
+            write_tip(filename, tip)
+    utils.vprint("published %s chain tip: %s" % (coin, tip), level=2)
+    return tip
+
+def tip_age(filename):
+    '''
+    :return: seconds since the tip was read from the daemon, None if there is none.
+    '''
+    tip = read_tip(filename)
+    if tip is None:
+        return None
+    return time.time() - tip['updated']
+
+def daemon_tip(coin):
+    '''
+    Read the tip from the daemon (getblockchaininfo, for the hash along with the height).
+    '''
+    chaininfo = rpc.rpc_request(method='getblockchaininfo', coin=coin)
+    return {'height': chaininfo['blocks'], 'hash': chaininfo['bestblockhash'], 'source': 'daemon',
+            'updated': time.time()}
+
+def poll(coin):
+    '''
+    Poll the daemon for its tip, unless the published tip was read from the daemon less than poll_interval seconds ago
+    or another worker is already polling it.
+
+    :return: the polled tip, or None if it wasn't polled.
+    '''
+    tip_settings = get_tip_settings(coin)
+    filename = get_tip_file(coin)
+    age = tip_age(filename)
+    if age is not None and age < tip_settings['poll_interval']:
+        return None
+    path = os.path.dirname(filename) or '.'
+    os.makedirs(path, exist_ok=True)
+    with tip_lock(path, blocking=False) as locked:
+        if not locked:
+            return None
+        # Published by another worker while this one waited for its turn.
+        age = tip_age(filename)
+        if age is not None and age < tip_settings['poll_interval']:
+            return None
+        tip = daemon_tip(coin)
+        write_tip(filename, tip)
+        return tip
+
+def fetch(coin):
+    '''
+    Read the tip from the daemon and publish it, unless another worker published one while this one waited for the
+    lock.
+
+    :return: the published tip, or None if the daemon didn't respond.
+    '''
+    filename = get_tip_file(coin)
+    path = os.path.dirname(filename) or '.'
+    os.makedirs(path, exist_ok=True)
+    with tip_lock(path):
+        tip = read_tip(filename)
+        if tip is not None:
+            return tip
+        try:
+            tip = daemon_tip(coin)
+        # rpc_request() exits if the daemon doesn't respond.
+        except (Exception, SystemExit) as e:
+            utils.debug(message={'chain_tip_fetch': 'no response from daemon' if isinstance(e, SystemExit) else str(e)})
+            return None
+        write_tip(filename, tip)
+        return tip
+
+def poll_loop(coin):
+    '''
+    Background thread of each worker polling the daemon. Errors are kept in globals.chain_tip_poll and reported with
+    the tip.
+    '''
+    while True:
+        start = time.time()
+        try:
+            if poll(coin):
+                globals.chain_tip_poll[coin] = {'polled': start, 'elapsed': utils.elapsed(start, 5)}
+        # rpc_request() exits if the daemon doesn't respond.
+        except (Exception, SystemExit) as e:
+            error = 'no response from daemon' if isinstance(e, SystemExit) else str(e)
+            globals.chain_tip_poll[coin] = {'error': error, 'failed': start}
+        time.sleep(get_tip_settings(coin)['poll_interval'] / 2)
+
+def start_poll(coin):
+    '''
+    Start the background thread polling the daemon, once per worker process: threads don't survive a fork.
+    '''
+    try:
+        _ = globals.chain_tip_threads
+    except:
+        globals.chain_tip_threads = {}
+        globals.chain_tip_poll = {}
+    thread, pid = globals.chain_tip_threads.get(coin, (None, None))
+    if thread is not None and pid == os.getpid() and thread.is_alive():
+        return
+    thread = threading.Thread(target=poll_loop, args=(coin,), name='chain tip %s' % (coin,), daemon=True)
+    thread.start()
+    globals.chain_tip_threads[coin] = (thread, os.getpid())
+
+def get_tip(coin):
+    '''
+    The last published chain tip of a coin, read again from the tip file at most every check_interval seconds.
+
+    If no tip was published yet, it is read from the daemon once, synchronously (see fetch()).
+
+    :return: dictionary with the height, hash, source, age in seconds, whether it is stale, and the last poll of this
+      worker; or None if no tip was published and the daemon didn't respond.
+    '''
+    tip_settings = get_tip_settings(coin)
+    if tip_settings['poll']:
+        start_poll(coin)
+    try:
+        _ = globals.chain_tip
+    except:
+        globals.chain_tip = {}
+
+    now = time.time()
+    tip, checked, mtime = globals.chain_tip.get(coin, (None, 0, None))
+    if now - checked >= tip_settings['check_interval']:
+        filename = get_tip_file(coin)
+        try:
+            # The tip file is replaced, not written in place.
+            stat = os.stat(filename)
+            new_mtime = (stat.st_mtime_ns, stat.st_ino)
+        except OSError:
+            new_mtime = None
+        if new_mtime != mtime:
+            tip = read_tip(filename) if new_mtime is not None else None
+        if new_mtime is None:
+            tip = fetch(coin)
+        globals.chain_tip[coin] = (tip, now, new_mtime)
+    if tip is None:
+        return None
+
+    age = max(now - tip['updated'], 0)
+    current = dict(tip, age=round(age, 3), stale=age > tip_settings['max_age'])
+    try:
+        if coin in globals.chain_tip_poll:
+            current['poll'] = globals.chain_tip_poll[coin]
+    except:
+        pass
+    return current
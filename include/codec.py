@@ -0,0 +1,136 @@
+'''
+Codecs for the data column of every table.
+
+Rows are JSON documents by default. Binary codecs serialize rows with MessagePack instead of JSON, and/or compress
+them with zlib or zstd. Encoded rows start with a byte identifying their codec, while JSON documents always start with
+'{', so rows are decoded the same way whichever codec is configured, including tables that are partially converted.
+
+The codec is selected with the `codec` setting, optionally set per coin. MessagePack and zstd require the msgpack and
+zstandard libraries.
+'''
+import json
+import zlib
+
+# Optional libraries:
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Custom libraries:
+from include import globals
+
+
+# Codec name: (identifying byte, serializer, compressor)
+CODECS = {
+    'json': (None, 'json', None),
+    'msgpack': (0x01, 'msgpack', None),
+    'json+zlib': (0x02, 'json', 'zlib'),
+    'msgpack+zlib': (0x03, 'msgpack', 'zlib'),
+    'json+zstd': (0x04, 'json', 'zstd'),
+    'msgpack+zstd': (0x05, 'msgpack', 'zstd'),
+}
+CODEC_IDS = {codec_id: name for name, (codec_id, _, _) in CODECS.items() if codec_id}
+
+def get_codec(coin):
+    '''
+    The codec used to encode rows of a coin, from the `codec` setting in settings.coins or globally.
+    '''
+    try:
+        name = globals.settings.coins[coin]['codec']
+    except:
+        try:
+            name = globals.settings.codec
+        except:
+            name = 'json'
+    check_codec(name)
+    return name
+
+def check_codec(name):
+    '''
+    Exit if a codec is unknown or the libraries it requires are not installed.
+    '''
+    if name not in CODECS:
+        print("unknown codec %s, must be one of: %s" % (name, list(CODECS)))
+        exit(1)
+    _, serializer, compressor = CODECS[name]
+    if serializer == 'msgpack' and msgpack is None:
+        print("codec %s requires the msgpack library (pip install msgpack)" % name)
+        exit(1)
+    if compressor == 'zstd' and zstandard is None:
+        print("codec %s requires the zstandard library (pip install zstandard)" % name)
+        exit(1)
+
+def is_binary(name):
+    '''
+    Binary codecs require a longblob data column.
+    '''
+    return CODECS[name][0] is not None
+
+def serialize(value, serializer):
+    if serializer == 'msgpack':
+        return msgpack.packb(value, use_bin_type=True)
+    return json.dumps(value).encode()
+
+def encode_value(value, name):
+    '''
+    Encode a row with a codec.
+
+    :return: the JSON document, or bytes for binary codecs.
+    '''
+    codec_id, serializer, compressor = CODECS[name]
+    if codec_id is None:
+        return json.dumps(value)
+    data = serialize(value, serializer)
+    if compressor == 'zlib':
+        data = zlib.compress(data, 6)
+    elif compressor == 'zstd':
+        data = zstandard.ZstdCompressor(level=3).compress(data)
+    return bytes((codec_id,)) + data
+
+def encode(coin, value):
+    return encode_value(value, get_codec(coin))
+
+def decode(data):
+    '''
+    Decode a row encoded with any codec.
+    '''
+    if isinstance(data, str):
+        return json.loads(data)
+    if data[:1] == b'{':
+        return json.loads(data.decode())
+    _, serializer, compressor = CODECS[CODEC_IDS[data[0]]]
+    data = bytes(data[1:])
+    if compressor == 'zlib':
+        data = zlib.decompress(data)
+    elif compressor == 'zstd':
+        data = zstandard.ZstdDecompressor().decompress(data)
+    if serializer == 'msgpack':
+        return msgpack.unpackb(data, raw=False)
+    return json.loads(data.decode())
+
+def get_codec_id(data):
+    '''
+    The codec a row was encoded with.
+    '''
+    if isinstance(data, str) or data[:1] == b'{':
+        return 'json'
+    return CODEC_IDS[data[0]]
+
+def encode_tsv(coin, value):
+    '''
+    Encode a row for the tab separated files loaded with LOAD DATA INFILE: binary rows are written as hex.
+    '''
+    data = encode(coin, value)
+    if isinstance(data, bytes):
+        return data.hex()
+    return data
+
+def decode_tsv(data):
+    if data[:1] == '{':
+        return json.loads(data)
+    return decode(bytes.fromhex(data))
@@ -1,11 +1,18 @@
+import contextlib
+from decimal import Decimal
 import json
+import logging
 import os
 import time
 
 import mysql.connector
 
 # Custom libraries:
+from include import codec
 from include import globals
+from include import kvstore
+from include import lookup
+from include import rowcache
 from include import utils
 
 
@@ -17,8 +24,390 @@ def lines_in_file(file):
         return sum(1 for _ in f)
 
 def get_tables():
+    return ["vin_spent", "vin_txid", "coinbase", "vout", "address", "address_delta", "block"]
+
+def get_cached_tables():
+    '''
+    Tables whose rows the API memoizes per request. Rows are shared by the readers of a key, which must not modify
+    them.
+    '''
     return ["vin_spent", "vin_txid", "coinbase", "vout", "address", "block"]
 
+def get_binary_tables():
+    '''
+    Tables keyed by a txid or block hash, stored as binary(32) by the compact schema.
+    '''
+    return ["vin_spent", "vin_txid", "coinbase", "vout", "block"]
+
+def get_normalized_tables():
+    '''
+    Tables of the optional normalized schema: one row per output, and one row per spent output.
+    '''
+    return ["output", "spend"]
+
+def get_utxo_tables():
+    '''
+    Tables of the optional UTXO set: the unspent outputs, the balance of each address, and the staging tables the
+    outputs and spent outputs of new blocks are loaded into before being applied.
+    '''
+    return ["utxo", "address_balance", "utxo_add", "utxo_spend"]
+
+def get_row_layout(table):
+    '''
+    Tables with one row per output share the layout of the output table, and tables with one row per spent output
+    the layout of the spend table.
+    '''
+    if table in ("output", "utxo", "utxo_add"):
+        return 'output'
+    if table in ("spend", "utxo_spend"):
+        return 'spend'
+    return None
+
+def get_normalized_columns(table):
+    '''
+    Columns of the tables with one row per output or spent output, in the order of the tab separated files written
+    by the load phases.
+    '''
+    if get_row_layout(table) == 'output':
+        return ["txid", "n", "address", "value", "height", "timestamp"]
+    return ["spent", "vout", "txid", "vin_n", "height", "timestamp"]
+
+def get_coin_setting(coin, name, default=None):
+    '''
+    A setting that can be set per coin in settings.coins, or globally.
+    '''
+    try:
+        return globals.settings.coins[coin][name]
+    except:
+        try:
+            return getattr(globals.settings, name)
+        except:
+            return default
+
+def get_backend(coin):
+    '''
+    Storage backend of a coin, see the `backend` setting: 'mysql', or 'sqlite' for the embedded key-value store
+    (include/kvstore.py).
+    '''
+    backend = get_coin_setting(coin, 'backend', 'mysql')
+    if backend not in ('mysql', 'sqlite'):
+        print("unknown backend %s, must be one of: ['mysql', 'sqlite']" % (backend,))
+        exit(1)
+    return backend
+
+def use_normalized_tables(coin):
+    '''
+    Whether the load phases populate the normalized tables, see the `normalized_tables` setting. Requires the MySQL
+    backend.
+    '''
+    return get_backend(coin) == 'mysql' and get_coin_setting(coin, 'normalized_tables', False)
+
+def use_utxo_tables(coin):
+    '''
+    Whether the load phases maintain the UTXO set and the balance of each address, see the `utxo_tables` setting.
+    Requires the MySQL backend.
+    '''
+    return get_backend(coin) == 'mysql' and get_coin_setting(coin, 'utxo_tables', False)
+
+def has_tables(coin, tables):
+    '''
+    Whether all of the tables exist. Detected from the existing tables, so the API uses the optional tables when they
+    are present and falls back to the other tables otherwise.
+    '''
+    if get_backend(coin) != 'mysql':
+        return False
+    try:
+        _ = globals.existing_tables
+    except:
+        globals.existing_tables = {}
+
+    if coin not in globals.existing_tables:
+        cursor = database_cursor(coin)
+        cursor.execute("SELECT `TABLE_NAME` FROM information_schema.TABLES WHERE `TABLE_SCHEMA` = DATABASE()")
+        globals.existing_tables[coin] = set(decode_key(table) for table, in cursor.fetchall())
+    return set(tables) <= globals.existing_tables[coin]
+
+def has_normalized_tables(coin):
+    return has_tables(coin, get_normalized_tables())
+
+def has_utxo_tables(coin):
+    return has_tables(coin, get_utxo_tables())
+
+def has_complete_tables(coin, tables, status_tables):
+    '''
+    Whether the optional tables exist and were loaded from the genesis block, see get_table_status(): tables enabled
+    on an existing database only have the rows of the blocks loaded since, so the API doesn't use them until they are
+    loaded again by an --initial pass. The status is read again at most every second.
+
+    :param tables: the tables.
+    :param status_tables: the names their status is recorded with.
+    '''
+    if not has_tables(coin, tables + ['table_status']):
+        return False
+    try:
+        _ = globals.table_status
+    except:
+        globals.table_status = {}
+
+    now = time.time()
+    statuses, checked = globals.table_status.get(coin, ({}, 0))
+    if now - checked >= 1:
+        start = time.time()
+        query = "SELECT `name`, `complete` FROM `table_status`"
+        try:
+            cursor = database_cursor(coin)
+            cursor.execute(query)
+            statuses = {decode_key(name): bool(complete) for name, complete in cursor.fetchall()}
+            record_queries(start)
+        except Exception as e:
+            print("SELECT table status query failed: %s" % (e,))
+            exit(1)
+        globals.table_status[coin] = (statuses, now)
+    return all(statuses.get(name) for name in status_tables)
+
+def has_complete_utxo_tables(coin):
+    return has_complete_tables(coin, get_utxo_tables(), ['utxo'])
+
+def has_complete_normalized_tables(coin):
+    return has_complete_tables(coin, get_normalized_tables(), ['output', 'spend'])
+
+def get_table_status(coin, name, for_update=False):
+    '''
+    The status of optional tables the extract script loads, recorded in the table_status table.
+
+    :param name: 'utxo' for the UTXO set and the balance of each address, 'output' and 'spend' for the normalized
+      tables.
+    :param for_update: lock the status until the end of the transaction.
+    :return: dictionary with the height of the last block applied (None if unknown) and whether the tables were
+      loaded from the genesis block, or None if there is no status.
+    '''
+    if not has_tables(coin, ['table_status']):
+        return None
+    query = "SELECT `height`, `complete` FROM `table_status` WHERE `name` = %s"
+    if for_update:
+        query += " FOR UPDATE"
+    utils.vprint(query, level=3)
+    try:
+        cursor = database_cursor(coin)
+        cursor.execute(query, (name,))
+        row = cursor.fetchone()
+    except Exception as e:
+        print(query, name)
+        print("SELECT table status query failed (name=%s): %s" % (name, e))
+        exit(1)
+    if not row:
+        return None
+    height, complete = row
+    return {
+        'height': height,
+        'complete': bool(complete),
+    }
+
+def set_table_status(coin, name, height, complete):
+    '''
+    Record the status of optional tables, in the current transaction if one was started.
+    '''
+    query = "INSERT INTO `table_status` (`name`, `height`, `complete`) VALUES (%s, %s, %s) " \
+            "ON DUPLICATE KEY UPDATE `height` = VALUES(`height`), `complete` = VALUES(`complete`)"
+    utils.vprint(query, level=3)
+    try:
+        database_cursor(coin).execute(query, (name, height, int(complete)))
+    except Exception as e:
+        print(query, name)
+        print("INSERT table status query failed (name=%s): %s" % (name, e))
+        exit(1)
+
+def get_schema_settings():
+    '''
+    The table_schema and table_compression settings used when creating tables.
+    '''
+    schema_settings = {
+        'schema': 'legacy',
+        'compression': None,
+    }
+    try:
+        schema_settings['schema'] = globals.settings.table_schema
+    except:
+        pass
+    try:
+        schema_settings['compression'] = globals.settings.table_compression
+    except:
+        pass
+    return schema_settings
+
+def get_table_schema(coin):
+    '''
+    Schema of a coin's tables: 'legacy' (varchar keys with a prefix index, rows identified by an auto-increment id) or
+    'compact' (binary keys as the clustered primary key). Detected from the existing tables, so databases converted
+    with migrate.py keep working, or from the table_schema setting if they don't exist yet. Tables of the embedded
+    store are 'sqlite', keyed by their key like the compact schema.
+    '''
+    if get_backend(coin) == 'sqlite':
+        return 'sqlite'
+    try:
+        _ = globals.table_schema
+    except:
+        globals.table_schema = {}
+
+    if coin not in globals.table_schema:
+        cursor = database_cursor(coin)
+        cursor.execute("SELECT `COLUMN_NAME`, `DATA_TYPE` FROM information_schema.COLUMNS WHERE "
+                       "`TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = 'vout'")
+        columns = {decode_key(column): decode_key(data_type) for column, data_type in cursor.fetchall()}
+        if not columns:
+            # The tables don't exist yet.
+            return get_schema_settings()['schema']
+        if codec.is_binary(codec.get_codec(coin)) and columns['data'] != 'longblob':
+            print("the %s codec requires a longblob data column, convert the %s tables with recode.py" %
+                  (codec.get_codec(coin), coin))
+            exit(1)
+        globals.table_schema[coin] = 'compact' if columns['hash'] == 'binary' else 'legacy'
+    return globals.table_schema[coin]
+
+def has_id(coin, table):
+    '''
+    Rows of the legacy schema, and address deltas, are identified by an auto-increment id.
+    '''
+    return table == 'address_delta' or get_table_schema(coin) == 'legacy'
+
+def is_binary_key(coin, table):
+    return table in get_binary_tables() and get_table_schema(coin) == 'compact'
+
+def key_sql(coin, table):
+    '''
+    SQL expression converting a key (a quoted literal or a placeholder) to the type of the table's key column.
+    '''
+    if is_binary_key(coin, table):
+        return "UNHEX(%s)"
+    return "%s"
+
+def key_column(coin, table):
+    '''
+    SQL expression selecting the table's key as a string.
+    '''
+    if is_binary_key(coin, table):
+        return "LOWER(HEX(`hash`))"
+    return "`hash`"
+
+def id_column(coin, table):
+    return "`id`" if has_id(coin, table) else "NULL"
+
+def order_by_id(coin, table):
+    return " ORDER BY `id`" if has_id(coin, table) else ""
+
+def insert_suffix(coin, table):
+    '''
+    Keys are unique in the compact schema: like select() with the legacy schema, the first row of a key is kept.
+    '''
+    return "" if has_id(coin, table) else " ON DUPLICATE KEY UPDATE `hash` = `hash`"
+
+def decode_key(key):
+    # Binary columns are returned as bytes.
+    if isinstance(key, (bytes, bytearray)):
+        return key.decode()
+    return key
+
+def table_definition(table, schema, name=None, compression=None, data_type='longtext'):
+    '''
+    The CREATE TABLE query of a table.
+
+    :param table: the table.
+    :param schema: 'legacy' or 'compact'.
+    :param name: name of the created table, defaults to the table.
+    :param compression: optional InnoDB page compression algorithm of the compact schema ('zlib' or 'lz4').
+    :param data_type: type of the data column, binary codecs require longblob.
+    '''
+    if schema == 'legacy':
+        return """
+        CREATE TABLE IF NOT EXISTS `%s` (
+          `id` bigint(11) unsigned NOT NULL AUTO_INCREMENT,
+          `hash` varchar(128) NOT NULL DEFAULT '',
+          `data` %s NOT NULL,
+          PRIMARY KEY(`id`),
+          KEY `hash` (`hash`(10))
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+        """ % (name or table, data_type)
+
+    if table == 'address_delta':
+        # Deltas of an address are clustered together, in the order they were appended.
+        columns = """
+          `id` bigint(11) unsigned NOT NULL AUTO_INCREMENT,
+          `hash` varbinary(128) NOT NULL,
+          `data` %s NOT NULL,
+          PRIMARY KEY(`hash`, `id`),
+          KEY `id` (`id`)"""
+    elif table in get_binary_tables():
+        columns = """
+          `hash` binary(32) NOT NULL,
+          `data` %s NOT NULL,
+          PRIMARY KEY(`hash`)"""
+    else:
+        columns = """
+          `hash` varbinary(128) NOT NULL,
+          `data` %s NOT NULL,
+          PRIMARY KEY(`hash`)"""
+    return """
+        CREATE TABLE IF NOT EXISTS `%s` (%s
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8%s;
+        """ % (name or table, columns % (data_type,), " COMPRESSION='%s'" % compression if compression else "")
+
+def normalized_table_definition(table):
+    '''
+    The CREATE TABLE query of a table of the normalized schema or the UTXO set.
+
+    Outputs are keyed by txid, n and address (bare multisig outputs have several addresses), and indexed by address
+    and height. Spent outputs are keyed by the txid and n of the output, and indexed by the spending txid. Address
+    balances are keyed by address: the balance is received - sent, first_height and last_height are the heights of
+    the first and last outputs received. The status of these tables is keyed by name, see get_table_status().
+    '''
+    if table == 'table_status':
+        return """
+        CREATE TABLE IF NOT EXISTS `table_status` (
+          `name` varchar(32) NOT NULL,
+          `height` int DEFAULT NULL,
+          `complete` tinyint(1) NOT NULL DEFAULT 0,
+          PRIMARY KEY(`name`)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+        """
+    if table == 'address_balance':
+        return """
+        CREATE TABLE IF NOT EXISTS `address_balance` (
+          `address` varchar(128) NOT NULL,
+          `received` bigint NOT NULL,
+          `sent` bigint NOT NULL,
+          `vout` bigint NOT NULL,
+          `txids` bigint NOT NULL,
+          `first_height` int unsigned DEFAULT NULL,
+          `last_height` int unsigned DEFAULT NULL,
+          PRIMARY KEY(`address`)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+        """
+    if get_row_layout(table) == 'output':
+        return """
+        CREATE TABLE IF NOT EXISTS `%s` (
+          `txid` char(64) CHARACTER SET ascii NOT NULL,
+          `n` int unsigned NOT NULL,
+          `address` varchar(128) NOT NULL,
+          `value` bigint NOT NULL,
+          `height` int unsigned NOT NULL,
+          `timestamp` int unsigned NOT NULL,
+          PRIMARY KEY(`txid`, `n`, `address`),
+          KEY `address` (`address`, `height`)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+        """ % (table,)
+    return """
+        CREATE TABLE IF NOT EXISTS `%s` (
+          `spent` char(64) CHARACTER SET ascii NOT NULL,
+          `vout` int unsigned NOT NULL,
+          `txid` char(64) CHARACTER SET ascii NOT NULL,
+          `vin_n` int unsigned NOT NULL,
+          `height` int unsigned NOT NULL,
+          `timestamp` int unsigned NOT NULL,
+          PRIMARY KEY(`spent`, `vout`),
+          KEY `txid` (`txid`)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+        """ % (table,)
+
 def get_database_settings(coin):
     if coin in globals.settings.coins:
         if 'database' in globals.settings.coins[coin]:
@@ -77,6 +466,11 @@ def database_cursor(coin):
     return globals.db[coin]
 
 def close_database_connection(coin):
+    if get_write_buffer(coin)['queue']:
+        flush_writes(coin)
+    if not kvstore.is_read_only():
+        # The API keeps its read-only store open across requests, with the database memory-mapped.
+        kvstore.close(coin)
     try:
         _ = globals.db_connection
     except:
@@ -92,25 +486,48 @@ def close_database_connection(coin):
 
 def create_tables(coin):
     close_database_connection(coin)
+    if get_backend(coin) == 'sqlite':
+        kvstore.create_tables(coin, get_tables())
+        return
+    schema = get_table_schema(coin)
     for table in get_tables():
         utils.vprint("creating %s.%s table (if not exists)" % (coin, table))
-        query = """
-        CREATE TABLE IF NOT EXISTS `%s` (
-          `id` bigint(11) unsigned NOT NULL AUTO_INCREMENT,
-          `hash` varchar(128) NOT NULL DEFAULT '',
-          `data` longtext NOT NULL,
-          PRIMARY KEY(`id`),
-          KEY `hash` (`hash`(10))
-        ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
-        """ % table
+        query = table_definition(table, schema, compression=get_schema_settings()['compression'],
+                                 data_type='longblob' if codec.is_binary(codec.get_codec(coin)) else 'longtext')
         utils.vprint(query, level=3)
         database_cursor(coin).execute(query)
+    tables = []
+    if use_normalized_tables(coin):
+        tables += get_normalized_tables()
+    if use_utxo_tables(coin):
+        tables += get_utxo_tables()
+    if tables:
+        tables.append('table_status')
+    for table in tables:
+        utils.vprint("creating %s.%s table (if not exists)" % (coin, table))
+        query = normalized_table_definition(table)
+        utils.vprint(query, level=3)
+        database_cursor(coin).execute(query)
+    try:
+        globals.existing_tables.pop(coin, None)
+    except:
+        pass
 
 def truncate_tables(coin, tables=None):
+    flush_writes(coin)
     close_database_connection(coin)
     if not tables:
         tables = get_tables()
+        if has_normalized_tables(coin):
+            tables += get_normalized_tables()
+        if has_utxo_tables(coin):
+            tables += get_utxo_tables()
+        if has_tables(coin, ['table_status']):
+            tables.append('table_status')
     for table in tables:
+        if get_backend(coin) == 'sqlite':
+            kvstore.truncate(coin, table)
+            continue
         utils.vprint("truncating %s.%s table" % (coin, table))
         database_cursor(coin).execute(
             """
@@ -118,15 +535,37 @@ def truncate_tables(coin, tables=None):
             """ % (table,)
         )
 
+def load_data_columns(coin, table):
+    '''
+    Columns of the tab separated files: binary keys and rows encoded with a binary codec are written as hex.
+    '''
+    if get_row_layout(table):
+        return "(%s)" % (", ".join(get_normalized_columns(table)),)
+    columns = []
+    assignments = []
+    for column, binary in (('hash', is_binary_key(coin, table)), ('data', codec.is_binary(codec.get_codec(coin)))):
+        if binary:
+            columns.append('@' + column)
+            assignments.append("%s = UNHEX(@%s)" % (column, column))
+        else:
+            columns.append(column)
+    if assignments:
+        return "(%s) SET %s" % (", ".join(columns), ", ".join(assignments))
+    return "(%s)" % (", ".join(columns),)
+
 def load_data_infile(coin, table):
     start = time.time()
+    flush_writes(coin)
     close_database_connection(coin)
     os.sync()
     filename = globals.args.working_path + table + '.csv'
-    if os.path.isfile(filename):
+    if os.path.isfile(filename) and get_backend(coin) == 'sqlite':
+        print("--> bulk loading '%s' into %s" % (filename, table))
+        print(" [[ Rows loaded: %d ]] " % kvstore.load_file(coin, table, filename))
+    elif os.path.isfile(filename):
         print("--> LOAD DATA LOCAL INFILE '%s' INTO TABLE %s" % (filename, table))
         print(" [[ Lines in file: %d ]] " % lines_in_file(filename))
-        query = "LOAD DATA LOCAL INFILE '%s' INTO TABLE %s FIELDS TERMINATED BY '\t' OPTIONALLY ENCLOSED BY '' ESCAPED BY '\\\\' LINES TERMINATED BY '\n' (hash, data)" % (filename, table)
+        query = "LOAD DATA LOCAL INFILE '%s' INTO TABLE %s FIELDS TERMINATED BY '\t' OPTIONALLY ENCLOSED BY '' ESCAPED BY '\\\\' LINES TERMINATED BY '\n' %s" % (filename, table, load_data_columns(coin, table))
         utils.vprint(query, level=2)
         try:
             database_cursor(coin).execute(query)
@@ -143,11 +582,18 @@ def load_data_infile(coin, table):
         utils.vprint("'%s' does not exist, skipping" % filename, level=2)
 
 def insert(coin, table, key, value):
+    evict_rows(coin, table, [key])
+    if buffer_write(coin, 'insert', table, key, value):
+        return
+    if get_backend(coin) == 'sqlite':
+        kvstore.insert(coin, table, [(key, codec.encode(coin, value))])
+        return
     start = time.time()
-    query = "INSERT INTO %s (`hash`, `data`) VALUES('%s', '%s')" % (table, key, json.dumps(value))
+    query = "INSERT INTO %s (`hash`, `data`) VALUES(%s, %%s)%s" % (table, key_sql(coin, table) % ("'%s'" % key),
+                                                                   insert_suffix(coin, table))
     utils.vprint(query, level=3)
     try:
-        database_cursor(coin).execute(query)
+        database_cursor(coin).execute(query, (codec.encode(coin, value),))
         utils.debug({
             'activity': 'INSERT query',
             'query': query,
@@ -161,11 +607,17 @@ def insert(coin, table, key, value):
         exit(1)
 
 def update(coin, table, key, value):
+    evict_rows(coin, table, [key])
+    if buffer_write(coin, 'update', table, key, value):
+        return
+    if get_backend(coin) == 'sqlite':
+        kvstore.update(coin, table, [(key, codec.encode(coin, value))])
+        return
     start = time.time()
-    query = "UPDATE %s SET `data` = '%s' WHERE `hash` = '%s'" % (table, json.dumps(value), key)
+    query = "UPDATE %s SET `data` = %%s WHERE `hash` = %s" % (table, key_sql(coin, table) % ("'%s'" % key))
     utils.vprint(query, level=3)
     try:
-        database_cursor(coin).execute(query)
+        database_cursor(coin).execute(query, (codec.encode(coin, value),))
         utils.debug({
             'activity': 'UPDATE query',
             'query': query,
@@ -179,8 +631,14 @@ def update(coin, table, key, value):
         exit(1)
 
 def delete(coin, table, key):
+    evict_rows(coin, table, [key])
+    if buffer_write(coin, 'delete', table, key):
+        return
+    if get_backend(coin) == 'sqlite':
+        kvstore.delete(coin, table, [key])
+        return
     start = time.time()
-    query = "DELETE FROM %s WHERE `hash` = '%s'" % (table, key)
+    query = "DELETE FROM %s WHERE `hash` = %s" % (table, key_sql(coin, table) % ("'%s'" % key))
     utils.vprint(query, level=3)
     try:
         database_cursor(coin).execute(query)
@@ -197,12 +655,105 @@ def delete(coin, table, key):
         exit(1)
 
 
+def reset_query_stats():
+    globals.query_stats = {'queries': 0, 'elapsed': 0, 'cache_hits': 0, 'cache_misses': 0}
+
+def record_queries(start, queries=1):
+    '''
+    Count read queries and their latency, which the API reports per request.
+    '''
+    try:
+        _ = globals.query_stats
+    except:
+        reset_query_stats()
+    globals.query_stats['queries'] += queries
+    globals.query_stats['elapsed'] += time.time() - start
+
+def query_stats():
+    '''
+    :return: dictionary with the number of read queries since reset_query_stats(), and their total latency.
+    '''
+    try:
+        stats = globals.query_stats
+    except:
+        reset_query_stats()
+        stats = globals.query_stats
+    return {'queries': stats['queries'], 'elapsed': round(stats['elapsed'], 5), 'cache_hits': stats['cache_hits'],
+            'cache_misses': stats['cache_misses']}
+
+def start_row_cache():
+    '''
+    Memoize the rows selected from now on, including keys that aren't found, until stop_row_cache(). The API
+    memoizes the rows of each request.
+    '''
+    globals.row_cache = {}
+
+def stop_row_cache():
+    globals.row_cache = None
+
+def get_row_cache(table):
+    '''
+    :return: dictionary mapping (coin, table, key) to a tuple of (id, data), or None if the key wasn't found. None if
+      rows aren't memoized.
+    '''
+    if table not in get_cached_tables():
+        return None
+    try:
+        return globals.row_cache
+    except:
+        return None
+
+def record_cache(hits, misses):
+    try:
+        _ = globals.query_stats
+    except:
+        reset_query_stats()
+    globals.query_stats['cache_hits'] += hits
+    globals.query_stats['cache_misses'] += misses
+
+def evict_rows(coin, table, keys):
+    '''
+    Forget the memoized rows of keys that are written.
+    '''
+    cache = get_row_cache(table)
+    if cache:
+        for key in keys:
+            cache.pop((coin, table, key), None)
+
 def select(coin, table, key, check_if_exists=False):
+    '''
+    Select the row of a key, memoized with start_row_cache() and by the API's row cache (include/rowcache.py).
+
+    :return: the row, or None if the key isn't found. With check_if_exists, 1 instead of the row.
+    '''
+    if get_row_cache(table) is None and not rowcache.is_enabled(coin, table):
+        return select_uncached(coin, table, key, check_if_exists)
+    rows = select_many(coin, table, [key])
+    if key not in rows:
+        return None
+    return 1 if check_if_exists else rows[key][1]
+
+def select_uncached(coin, table, key, check_if_exists=False):
     start = time.time()
+    # Pending writes to this key must be visible.
+    if (table, key) in get_write_buffer(coin)['keys']:
+        flush_writes(coin)
+    # Keys written since the lookup index was built are read from the database.
+    index_table = lookup.get_table(coin, table)
+    if index_table is not None:
+        data = index_table.get(key)
+        if data is not None:
+            return 1 if check_if_exists else codec.decode(data)
+    if get_backend(coin) == 'sqlite':
+        data = kvstore.select(coin, table, key)
+        record_queries(start)
+        if data is None:
+            return None
+        return 1 if check_if_exists else codec.decode(data)
     if check_if_exists:
-        query = "SELECT 1 FROM %s WHERE `hash` = '%s'" % (table, key)
+        query = "SELECT 1 FROM %s WHERE `hash` = %s" % (table, key_sql(coin, table) % ("'%s'" % key))
     else:
-        query = "SELECT `data` FROM %s WHERE `hash` = '%s'" % (table, key)
+        query = "SELECT `data` FROM %s WHERE `hash` = %s" % (table, key_sql(coin, table) % ("'%s'" % key))
     utils.vprint(query, level=3)
     result = []
     result_count = 0
@@ -218,6 +769,7 @@ def select(coin, table, key, check_if_exists=False):
                 continue
             result, = data
             has_result = True
+        record_queries(start)
         utils.debug({
             'activity': 'SELECT query',
             'query': query,
@@ -228,7 +780,7 @@ def select(coin, table, key, check_if_exists=False):
             if check_if_exists:
                 return result
             else:
-                return json.loads(result)
+                return codec.decode(result)
     except Exception as e:
         print(query, table, key)
         if check_if_exists:
@@ -244,3 +796,1267 @@ def select(coin, table, key, check_if_exists=False):
             'elapsed': utils.elapsed(start, 5)
         })
         exit(1)
+
+def select_many(coin, table, keys, batch_size=1000):
+    '''
+    Select the rows of a batch of keys, with one query per batch_size keys, memoized with start_row_cache() and by
+    the API's row cache (include/rowcache.py).
+
+    :param coin: the coin type.
+    :param table: the table to select from.
+    :param keys: list of keys.
+    :param batch_size: maximum number of keys per query.
+    :return: dictionary mapping each key that was found to a tuple of (id, data), id is None with the compact
+      schema. Like select(), if a key is found more than once only the first row is used.
+    '''
+    cache = get_row_cache(table)
+    shared = rowcache.is_enabled(coin, table)
+    if cache is None and not shared:
+        return select_many_uncached(coin, table, keys, batch_size)
+    if shared:
+        version = rowcache.get_version(coin, table)
+    results = {}
+    missing = {}
+    for key in keys:
+        if cache is not None and (coin, table, key) in cache:
+            if cache[(coin, table, key)] is not None:
+                results[key] = cache[(coin, table, key)]
+            continue
+        if shared:
+            data = rowcache.get(coin, table, key, version)
+            if data is rowcache.NOT_FOUND:
+                if cache is not None:
+                    cache[(coin, table, key)] = None
+                continue
+            if data is not None:
+                results[key] = (None, data)
+                if cache is not None:
+                    cache[(coin, table, key)] = results[key]
+                continue
+        missing[key] = True
+    missing = list(missing)
+    record_cache(len(keys) - len(missing), len(missing))
+    sizes = {}
+    found = select_many_uncached(coin, table, missing, batch_size, sizes=sizes)
+    for key in missing:
+        if cache is not None:
+            cache[(coin, table, key)] = found.get(key)
+        if shared and key in found:
+            rowcache.put(coin, table, key, version, found[key][1], sizes[key])
+        elif shared:
+            rowcache.put(coin, table, key, version, rowcache.NOT_FOUND, 0)
+    results.update(found)
+    return results
+
+def select_many_uncached(coin, table, keys, batch_size=1000, sizes=None):
+    '''
+    :param sizes: optional dictionary, filled with the size of each encoded row that was found.
+    '''
+    start = time.time()
+    if sizes is None:
+        sizes = {}
+    if not keys:
+        return {}
+    pending_keys = get_write_buffer(coin)['keys']
+    if pending_keys and any((table, key) in pending_keys for key in keys):
+        flush_writes(coin)
+    results = {}
+    index_table = lookup.get_table(coin, table)
+    if index_table is not None:
+        for key in keys:
+            data = index_table.get(key)
+            if data is not None:
+                results[key] = (None, codec.decode(data))
+                sizes[key] = len(data)
+        keys = [key for key in keys if key not in results]
+        if not keys:
+            return results
+    keys = list(keys)
+    if get_backend(coin) == 'sqlite':
+        for key, (id, data) in kvstore.select_many(coin, table, keys).items():
+            results[key] = (id, codec.decode(data))
+            sizes[key] = len(data)
+        record_queries(start, -(-len(keys) // 500))
+        return results
+    result_count = 0
+    for n in range(0, len(keys), batch_size):
+        batch = keys[n:n + batch_size]
+        query = "SELECT %s, %s, `data` FROM %s WHERE `hash` IN (%s)%s" % \
+                (id_column(coin, table), key_column(coin, table), table,
+                 ", ".join([key_sql(coin, table) % "%s"] * len(batch)), order_by_id(coin, table))
+        utils.vprint(query, level=3)
+        try:
+            cursor = database_cursor(coin)
+            cursor.execute(query, batch)
+            for id, key, data in cursor:
+                result_count += 1
+                key = decode_key(key)
+                if key in results:
+                    print("WARNING: multiple results in %s for %s" % (table, key))
+                    # We use first matching for now
+                    continue
+                results[key] = (id, codec.decode(data))
+                sizes[key] = len(data)
+        except Exception as e:
+            print(query, table)
+            print("SELECT IN query failed (table=%s, keys=%d): %s" % (table, len(batch), e))
+            exit(1)
+    record_queries(start, -(-len(keys) // batch_size))
+    utils.debug({
+        'activity': 'SELECT IN queries',
+        'table': table,
+        'keys': len(keys),
+        'result_count': result_count,
+        'elapsed': utils.elapsed(start, 5)
+    }, level=2)
+    return results
+
+def upsert_many(coin, table, rows, max_statement_bytes=16 * 1024 * 1024):
+    '''
+    Insert or update a batch of rows with multi-row INSERT ... ON DUPLICATE KEY UPDATE queries, in a single
+    transaction.
+
+    :param coin: the coin type.
+    :param table: the table to write to.
+    :param rows: list of (id, key, value) tuples: id is the primary key of the existing row to update, or None to
+      insert a new row. With the compact schema, rows are identified by their key and id is ignored.
+    :param max_statement_bytes: rows are split into several queries so each stays below the server's packet size.
+    :return: None
+    '''
+    start = time.time()
+    if not rows:
+        return
+    evict_rows(coin, table, [key for _, key, _ in rows])
+    # Keep writes in order.
+    flush_writes(coin)
+    if get_backend(coin) == 'sqlite':
+        kvstore.upsert(coin, table, [(id, key, codec.encode(coin, value)) for id, key, value in rows])
+        return
+    statements = []
+    parameters = []
+    statement_bytes = 0
+    for id, key, value in rows:
+        data = codec.encode(coin, value)
+        if parameters and statement_bytes + len(data) > max_statement_bytes:
+            statements.append(parameters)
+            parameters = []
+            statement_bytes = 0
+        parameters.append((id, key, data) if has_id(coin, table) else (key, data))
+        statement_bytes += len(key) + len(data)
+    statements.append(parameters)
+    if has_id(coin, table):
+        columns = "`id`, `hash`, `data`"
+        placeholders = "(%s, %s, %s)"
+    else:
+        columns = "`hash`, `data`"
+        placeholders = "(%s, %%s)" % (key_sql(coin, table) % "%s",)
+
+    connection = database_connection(coin)
+    try:
+        connection.start_transaction()
+        for parameters in statements:
+            query = "INSERT INTO %s (%s) VALUES %s ON DUPLICATE KEY UPDATE `data` = VALUES(`data`)" % \
+                    (table, columns, ", ".join([placeholders] * len(parameters)))
+            utils.vprint(query, level=3)
+            database_cursor(coin).execute(query, [parameter for row in parameters for parameter in row])
+        connection.commit()
+        utils.debug({
+            'activity': 'INSERT ON DUPLICATE KEY UPDATE queries',
+            'table': table,
+            'rows': len(rows),
+            'queries': len(statements),
+            'elapsed': utils.elapsed(start, 5)
+        }, level=2)
+    except Exception as e:
+        try:
+            connection.rollback()
+        except:
+            pass
+        print("INSERT ON DUPLICATE KEY UPDATE failed (table=%s, rows=%d): %s" % (table, len(rows), e))
+        exit(1)
+
+def upsert_merged(coin, table, values, merge):
+    '''
+    Merge a batch of values into the existing rows of their keys: the existing rows are selected with a single query,
+    merged in Python, then written back in a single transaction.
+
+    :param coin: the coin type.
+    :param table: the table to update.
+    :param values: dictionary mapping each key to its new value.
+    :param merge: function merging a new value into an existing value, returning the merged value.
+    :return: None
+    '''
+    existing = select_many(coin, table, list(values.keys()))
+    rows = []
+    for key, value in values.items():
+        if key in existing:
+            id, data = existing[key]
+            rows.append((id, key, merge(data, value)))
+        else:
+            rows.append((None, key, value))
+    upsert_many(coin, table, rows)
+
+def select_all(coin, table, key):
+    '''
+    Select all rows of a key, in the order they were inserted.
+
+    :return: list of (id, data) tuples.
+    '''
+    start = time.time()
+    if (table, key) in get_write_buffer(coin)['keys']:
+        flush_writes(coin)
+    index_table = lookup.get_table(coin, table)
+    if index_table is not None:
+        data = index_table.get(key)
+        if data is not None:
+            return [(None, codec.decode(data))]
+    if get_backend(coin) == 'sqlite':
+        results = [(id, codec.decode(data)) for id, data in kvstore.select_all(coin, table, key)]
+        record_queries(start)
+        return results
+    query = "SELECT %s, `data` FROM %s WHERE `hash` = %s%s" % (id_column(coin, table), table,
+                                                              key_sql(coin, table) % "%s", order_by_id(coin, table))
+    utils.vprint(query, level=3)
+    try:
+        cursor = database_cursor(coin)
+        cursor.execute(query, (key,))
+        results = [(id, codec.decode(data)) for id, data in cursor]
+        record_queries(start)
+        utils.debug({
+            'activity': 'SELECT all query',
+            'query': query,
+            'result_count': len(results),
+            'elapsed': utils.elapsed(start, 5)
+        }, level=2)
+    except Exception as e:
+        print(query, table, key)
+        print("SELECT all query failed (table=%s, key=%s): %s" % (table, key, e))
+        exit(1)
+    return results
+
+def select_ordered(coin, table):
+    '''
+    Iterate over the rows of a table sorted by key, compared as bytes, to build the lookup index. Like select(), if a
+    key is found more than once only the first row is used.
+
+    :return: iterator of (key, encoded row) tuples.
+    '''
+    flush_writes(coin)
+    if get_backend(coin) == 'sqlite':
+        yield from kvstore.select_ordered(coin, table)
+        return
+    if has_id(coin, table):
+        # The legacy schema's keys are compared case-insensitively by their collation.
+        order_by = "ORDER BY BINARY `hash`, `id`"
+    else:
+        order_by = "ORDER BY `hash`"
+    query = "SELECT %s, `data` FROM %s %s" % (key_column(coin, table), table, order_by)
+    utils.vprint(query, level=3)
+    # A cursor of its own streams the rows, without reading the whole table in memory.
+    cursor = database_connection(coin).cursor()
+    try:
+        cursor.execute(query)
+        previous = None
+        for key, data in cursor:
+            key = decode_key(key)
+            if key == previous:
+                continue
+            previous = key
+            yield key, data
+    except Exception as e:
+        print(query, table)
+        print("SELECT ordered query failed (table=%s): %s" % (table, e))
+        exit(1)
+    finally:
+        cursor.close()
+
+def merge_address(address_json, new_address_json):
+    '''
+    Merge new vout into the existing row of an address.
+    '''
+    address, = new_address_json.keys()
+    for txid in new_address_json[address]:
+        if txid in address_json[address]:
+            # The vout of the existing row may be shared with other readers (see get_cached_tables()).
+            address_json[address][txid] = dict(address_json[address][txid], **new_address_json[address][txid])
+        else:
+            address_json[address][txid] = new_address_json[address][txid]
+    return address_json
+
+def append_address_deltas(coin, values):
+    '''
+    Append the vout of a batch of addresses to the address_delta table, without reading or rewriting their existing
+    rows: the cost of processing new blocks is proportional to their vout, not to the history of each address.
+    Readers merge the deltas with select_address(), and compact_address() folds them into the address table.
+
+    :param coin: the coin type.
+    :param values: dictionary mapping each address to its new vout, in the same format as the address table.
+    :return: None
+    '''
+    upsert_many(coin, 'address_delta', [(None, address, value) for address, value in values.items()])
+
+def get_address_segment_size():
+    '''
+    Maximum number of txids in an address row, larger addresses are split into segments.
+    '''
+    try:
+        return globals.settings.address_segment_size
+    except:
+        return 10000
+
+def address_segment_key(address, segment):
+    return "%s:%06d" % (address, segment)
+
+def summarize_address(address, address_json):
+    '''
+    Height boundaries and totals of an address row or segment.
+
+    :return: dictionary with first_height, last_height, txids, vout and received (in satoshis).
+    '''
+    heights = []
+    vout = received = 0
+    for txid in address_json[address]:
+        for output in address_json[address][txid].values():
+            heights.append(int(output['height']))
+            vout += 1
+            received += int(Decimal(output['value']) * 100000000)
+    return {
+        'first_height': min(heights) if heights else None,
+        'last_height': max(heights) if heights else None,
+        'txids': len(address_json[address]),
+        'vout': vout,
+        'received': received,
+    }
+
+def segment_address(address, address_json):
+    '''
+    Split the history of an address into segments of up to get_address_segment_size() txids, ordered by height.
+
+    :return: list of segments, in the same format as the address table.
+    '''
+    segment_size = get_address_segment_size()
+    txids = sorted(address_json[address],
+                   key=lambda txid: (int(next(iter(address_json[address][txid].values()))['height']), txid))
+    return [{address: {txid: address_json[address][txid] for txid in txids[n:n + segment_size]}}
+            for n in range(0, len(txids), segment_size)] or [{address: {}}]
+
+def address_directory(summaries, sent=None, sent_height=None):
+    '''
+    The directory row of a segmented address: the boundaries of each segment and the totals of the address.
+
+    Spending an output doesn't change the rows of its address, so the outputs that were spent are counted when the
+    address is segmented (see compact_address() and update_address_sent()), then updated by the extract script.
+    Directories built in memory from a single row have no sent total and balance (None).
+
+    :param sent: value of the spent outputs, in satoshis.
+    :param sent_height: height of the last block whose spends are counted in sent.
+    '''
+    received = sum(summary['received'] for summary in summaries)
+    return {
+        'segments': summaries,
+        'txids': sum(summary['txids'] for summary in summaries),
+        'vout': sum(summary['vout'] for summary in summaries),
+        'received': received,
+        'sent': sent,
+        'balance': received - sent if sent is not None else None,
+        'sent_height': sent_height,
+    }
+
+def is_address_directory(data):
+    return 'segments' in data
+
+def address_rows(address, address_json):
+    '''
+    The rows storing an address: a single row, or a directory row and a row per segment if the address has more
+    than get_address_segment_size() txids.
+
+    :return: list of (key, data) tuples.
+    '''
+    if len(address_json[address]) <= get_address_segment_size():
+        return [(address, address_json)]
+    segments = segment_address(address, address_json)
+    rows = [(address, address_directory([summarize_address(address, segment) for segment in segments]))]
+    for segment, segment_json in enumerate(segments):
+        rows.append((address_segment_key(address, segment), segment_json))
+    return rows
+
+def select_address_view(coin, address):
+    '''
+    Select the directory of an address, merging the deltas appended since it was last compacted into its last
+    segment. Addresses stored in a single row are split into segments in memory, so readers can handle both layouts
+    the same way and read one segment at a time with select_address_segment().
+
+    :return: dictionary with the directory and the segments that were already read, or None if the address is not
+      found.
+    '''
+    data = select(coin, 'address', address)
+    deltas = select_all(coin, 'address_delta', address)
+    if not data and not deltas:
+        return None
+
+    if data and is_address_directory(data):
+        directory = data
+        segments = {}
+        if deltas:
+            last = len(directory['segments']) - 1
+            segment_json = select(coin, 'address', address_segment_key(address, last)) or {address: {}}
+            segment_json = {address: dict(segment_json[address])}
+            for _, delta in deltas:
+                merge_address(segment_json, delta)
+            # Split the last segment if it grew too large, as compaction will.
+            for n, segment_json in enumerate(segment_address(address, segment_json)):
+                segments[last + n] = segment_json
+            directory = address_directory(directory['segments'][:last] +
+                                          [summarize_address(address, segments[segment]) for segment in
+                                           sorted(segments)], directory.get('sent'), directory.get('sent_height'))
+    else:
+        address_json = {address: dict(data[address])} if data else {address: {}}
+        for _, delta in deltas:
+            merge_address(address_json, delta)
+        segments = dict(enumerate(segment_address(address, address_json)))
+        directory = address_directory([summarize_address(address, segments[segment]) for segment in segments])
+    return {
+        'directory': directory,
+        'segments': segments,
+    }
+
+def select_address_segment(coin, address, view, segment):
+    '''
+    Select one segment of an address, counting from the end if negative.
+
+    :param view: the address, from select_address_view().
+    :return: the segment, in the same format as the address table.
+    '''
+    segment = range(len(view['directory']['segments']))[segment]
+    if segment not in view['segments']:
+        return select(coin, 'address', address_segment_key(address, segment)) or {address: {}}
+    return view['segments'][segment]
+
+def select_address(coin, address):
+    '''
+    Select the entire history of an address, merging all its segments and deltas.
+
+    :return: the address data, or None if the address is not found.
+    '''
+    view = select_address_view(coin, address)
+    if not view:
+        return None
+    segments = len(view['directory']['segments'])
+    if segments == 1:
+        return select_address_segment(coin, address, view, 0)
+    keys = [address_segment_key(address, segment) for segment in range(segments) if segment not in view['segments']]
+    rows = select_many(coin, 'address', keys)
+    address_json = {
+        address: {},
+    }
+    for segment in range(segments):
+        if segment in view['segments']:
+            merge_address(address_json, view['segments'][segment])
+        elif address_segment_key(address, segment) in rows:
+            merge_address(address_json, rows[address_segment_key(address, segment)][1])
+    return address_json
+
+def compact_address(coin, address):
+    '''
+    Fold the deltas of an address into its rows in the address table, in a single transaction. Deltas are merged
+    into the last segment, which is split if it grew too large; an address stored in a single row is split into
+    segments once it has more than get_address_segment_size() txids. Only the deltas that were read are deleted, so
+    deltas appended concurrently are kept for the next compaction.
+
+    :return: number of deltas folded.
+    '''
+    start = time.time()
+    flush_writes(coin)
+    if get_backend(coin) == 'sqlite':
+        connection = kvstore.connect(coin)
+    else:
+        connection = database_connection(coin)
+        cursor = database_cursor(coin)
+
+    def select_for_update(table, key):
+        if get_backend(coin) == 'sqlite':
+            # The transaction already holds the write lock of the store.
+            return select_all(coin, table, key)
+        cursor.execute("SELECT %s, `data` FROM %s WHERE `hash` = %%s%s FOR UPDATE" %
+                       (id_column(coin, table), table, order_by_id(coin, table)), (key,))
+        return [(id, codec.decode(data)) for id, data in cursor]
+
+    try:
+        connection.start_transaction()
+        deltas = select_for_update('address_delta', address)
+        if not deltas:
+            connection.commit()
+            return 0
+        # Like select(), if a key is found more than once only the first row is used.
+        id, data = (select_for_update('address', address) or [(None, {address: {}})])[0]
+        writes = []
+        if is_address_directory(data):
+            directory = data
+            last = len(directory['segments']) - 1
+            segment_id, segment_json = (select_for_update('address', address_segment_key(address, last)) or
+                                        [(None, {address: {}})])[0]
+            for _, delta in deltas:
+                merge_address(segment_json, delta)
+            segments = segment_address(address, segment_json)
+            for n, segment_json in enumerate(segments):
+                writes.append((segment_id if n == 0 else None, address_segment_key(address, last + n), segment_json))
+            directory = address_directory(directory['segments'][:last] +
+                                          [summarize_address(address, segment_json) for segment_json in segments],
+                                          directory.get('sent'), directory.get('sent_height'))
+            writes.append((id, address, directory))
+        else:
+            for _, delta in deltas:
+                merge_address(data, delta)
+            rows = address_rows(address, data)
+            if len(rows) > 1:
+                # The address is segmented: count its spent outputs once, the extract script adds the later ones.
+                _, directory = rows[0]
+                sent, sent_height = count_address_sent(coin, address, {
+                    'directory': directory,
+                    'segments': {segment: segment_json for segment, (_, segment_json) in enumerate(rows[1:])},
+                })
+                rows[0] = (address, address_directory(directory['segments'], sent, sent_height))
+            writes.extend((id if key == address else None, key, value) for key, value in rows)
+        if get_backend(coin) == 'sqlite':
+            kvstore.upsert(coin, 'address', [(None, key, codec.encode(coin, value)) for _, key, value in writes])
+            kvstore.delete_deltas(coin, address, deltas[-1][0])
+        else:
+            for row_id, key, value in writes:
+                if not has_id(coin, 'address'):
+                    cursor.execute("INSERT INTO address (`hash`, `data`) VALUES (%s, %s) "
+                                   "ON DUPLICATE KEY UPDATE `data` = VALUES(`data`)", (key, codec.encode(coin, value)))
+                elif row_id is None:
+                    cursor.execute("INSERT INTO address (`hash`, `data`) VALUES (%s, %s)",
+                                   (key, codec.encode(coin, value)))
+                else:
+                    cursor.execute("UPDATE address SET `data` = %s WHERE `id` = %s",
+                                   (codec.encode(coin, value), row_id))
+            cursor.execute("DELETE FROM address_delta WHERE `hash` = %s AND `id` <= %s", (address, deltas[-1][0]))
+        connection.commit()
+    except Exception as e:
+        try:
+            connection.rollback()
+        except:
+            pass
+        print("compacting address %s failed: %s" % (address, e))
+        exit(1)
+    utils.debug({
+        'activity': 'compact address',
+        'address': address,
+        'deltas': len(deltas),
+        'elapsed': utils.elapsed(start, 5)
+    }, level=2)
+    return len(deltas)
+
+def remove_address_output(coin, address, txid, n):
+    '''
+    Remove a vout from an address, when unwinding an orphaned block.
+
+    :return: True if the vout was found and removed.
+    '''
+    compact_address(coin, address)
+    data = select(coin, 'address', address)
+    if not data:
+        return False
+    if not is_address_directory(data):
+        if txid not in data[address] or n not in data[address][txid]:
+            return False
+        del(data[address][txid][n])
+        if not data[address][txid]:
+            del(data[address][txid])
+        if data[address]:
+            update(coin, 'address', address, data)
+        else:
+            delete(coin, 'address', address)
+        return True
+
+    directory = data
+    # Orphaned blocks are the most recent, so start searching from the last segment.
+    for segment in reversed(range(len(directory['segments']))):
+        key = address_segment_key(address, segment)
+        segment_json = select(coin, 'address', key)
+        if segment_json and txid in segment_json[address] and n in segment_json[address][txid]:
+            break
+    else:
+        return False
+    del(segment_json[address][txid][n])
+    if not segment_json[address][txid]:
+        del(segment_json[address][txid])
+    if not segment_json[address] and segment == len(directory['segments']) - 1:
+        delete(coin, 'address', key)
+        directory['segments'].pop()
+    else:
+        update(coin, 'address', key, segment_json)
+        directory['segments'][segment] = summarize_address(address, segment_json)
+    if directory['segments']:
+        update(coin, 'address', address, address_directory(directory['segments'], directory.get('sent'),
+                                                           directory.get('sent_height')))
+    else:
+        delete(coin, 'address', address)
+    return True
+
+def update_address_directory(coin, address, update):
+    '''
+    Update the directory row of a segmented address in a single transaction, holding its lock like compact_address()
+    so that concurrent compactions keep the update.
+
+    :param update: function returning the updated directory, or None to leave it unchanged.
+    :return: True if the directory was updated, False if it wasn't or the address isn't segmented.
+    '''
+    flush_writes(coin)
+    if get_backend(coin) == 'sqlite':
+        connection = kvstore.connect(coin)
+    else:
+        connection = database_connection(coin)
+        cursor = database_cursor(coin)
+
+    directory = None
+    try:
+        connection.start_transaction()
+        if get_backend(coin) == 'sqlite':
+            # The transaction already holds the write lock of the store.
+            rows = select_all(coin, 'address', address)
+        else:
+            cursor.execute("SELECT %s, `data` FROM address WHERE `hash` = %%s%s FOR UPDATE" %
+                           (id_column(coin, 'address'), order_by_id(coin, 'address')), (address,))
+            rows = [(id, codec.decode(data)) for id, data in cursor]
+        # Like select(), if a key is found more than once only the first row is used.
+        if rows and is_address_directory(rows[0][1]):
+            directory = update(rows[0][1])
+        if directory is None:
+            pass
+        elif get_backend(coin) == 'sqlite':
+            kvstore.upsert(coin, 'address', [(None, address, codec.encode(coin, directory))])
+        elif not has_id(coin, 'address'):
+            cursor.execute("INSERT INTO address (`hash`, `data`) VALUES (%s, %s) "
+                           "ON DUPLICATE KEY UPDATE `data` = VALUES(`data`)", (address, codec.encode(coin, directory)))
+        else:
+            cursor.execute("UPDATE address SET `data` = %s WHERE `id` = %s",
+                           (codec.encode(coin, directory), rows[0][0]))
+        connection.commit()
+    except Exception as e:
+        try:
+            connection.rollback()
+        except:
+            pass
+        print("updating the directory of address %s failed: %s" % (address, e))
+        exit(1)
+    return directory is not None
+
+def select_spent_addresses(coin, spends):
+    '''
+    The addresses of spent outputs, read from the vout rows of the transactions that created them.
+
+    :param spends: list of (spent txid, vout, height of the spending block) tuples.
+    :return: dictionary mapping each address to a list of (value in satoshis, height of the spending block) tuples.
+    '''
+    vout = select_many(coin, 'vout', list(set(spent for spent, _, _ in spends)))
+    addresses = {}
+    for spent, n, height in spends:
+        if spent not in vout:
+            continue
+        for address, outputs in vout[spent][1][spent]['addresses'].items():
+            if n in outputs:
+                addresses.setdefault(address, []).append((int(outputs[n]['value']), int(height)))
+    return addresses
+
+def count_address_sent(coin, address, view=None):
+    '''
+    Count the spent outputs of a segmented address from its entire history, one segment at a time.
+
+    :param view: the address, from select_address_view() by default.
+    :return: tuple of (value of the spent outputs in satoshis, height of the last spend, None if there is none).
+    '''
+    if view is None:
+        view = select_address_view(coin, address)
+    sent = 0
+    sent_height = None
+    for segment in range(len(view['directory']['segments'])):
+        address_json = select_address_segment(coin, address, view, segment)
+        vin_spent = select_many(coin, 'vin_spent', list(address_json[address]))
+        for txid in address_json[address]:
+            if txid not in vin_spent:
+                continue
+            spent_json = vin_spent[txid][1][txid]
+            for n, output in address_json[address][txid].items():
+                if n in spent_json:
+                    sent += int(Decimal(output['value']) * 100000000)
+                    sent_height = max(int(spent_json[n]['height']), sent_height or 0)
+    return sent, sent_height
+
+def update_address_sent(coin, spends):
+    '''
+    Add newly spent outputs to the sent total of segmented addresses, see address_directory().
+
+    Only the spends above the height of the last block counted in each directory are added, so the spends of a pass
+    can be applied again. Addresses whose spent outputs weren't counted yet (segmented by the --initial pass or by a
+    compaction) are counted from their history instead.
+
+    :param spends: dictionary mapping each address to a list of (value in satoshis, height) tuples of its newly spent
+      outputs, from select_spent_addresses(). Addresses that aren't segmented are skipped.
+    :return: number of directories updated.
+    '''
+    def add_spends(directory):
+        if directory.get('sent') is None:
+            sent, sent_height = count_address_sent(coin, address)
+            return address_directory(directory['segments'], sent, sent_height)
+        counted = directory['sent_height'] if directory['sent_height'] is not None else -1
+        new_spends = [(value, height) for value, height in spends[address] if height > counted]
+        if not new_spends:
+            return None
+        return address_directory(directory['segments'], directory['sent'] + sum(value for value, _ in new_spends),
+                                 max(height for _, height in new_spends))
+
+    updated = 0
+    for address in spends:
+        updated += update_address_directory(coin, address, add_spends)
+    return updated
+
+def unwind_address_sent(coin, spends, height):
+    '''
+    Take the spends of orphaned blocks out of the sent total of segmented addresses, once the blocks from height on
+    are unwound.
+
+    :param spends: dictionary mapping each address to a list of (value in satoshis, height) tuples of the outputs
+      spent by the orphaned blocks, from select_spent_addresses().
+    :param height: height of the first orphaned block.
+    :return: number of directories updated.
+    '''
+    def remove_spends(directory):
+        if directory.get('sent') is None or directory['sent_height'] is None:
+            return None
+        counted = [value for value, spend_height in spends[address] if spend_height <= directory['sent_height']]
+        return address_directory(directory['segments'], directory['sent'] - sum(counted),
+                                 min(directory['sent_height'], height - 1))
+
+    updated = 0
+    for address in spends:
+        updated += update_address_directory(coin, address, remove_spends)
+    return updated
+
+def get_address_deltas(coin, min_deltas=1, limit=None):
+    '''
+    Addresses with at least min_deltas deltas waiting to be compacted, those with the most deltas first.
+
+    :return: list of (address, number of deltas) tuples.
+    '''
+    if get_backend(coin) == 'sqlite':
+        return kvstore.get_address_deltas(coin, min_deltas, limit)
+    query = "SELECT `hash`, COUNT(*) AS deltas FROM address_delta GROUP BY `hash` HAVING deltas >= %s " \
+            "ORDER BY deltas DESC"
+    parameters = [min_deltas]
+    if limit:
+        query += " LIMIT %s"
+        parameters.append(limit)
+    utils.vprint(query, level=3)
+    try:
+        cursor = database_cursor(coin)
+        cursor.execute(query, parameters)
+        return [(decode_key(address), deltas) for address, deltas in cursor]
+    except Exception as e:
+        print("SELECT address deltas failed: %s" % (e,))
+        exit(1)
+
+def select_outputs(coin, column, keys, batch_size=1000):
+    '''
+    Select the outputs of addresses or txids from the normalized tables, with the transaction spending each of them.
+
+    :param coin: the coin type.
+    :param column: 'address' or 'txid'.
+    :param keys: list of addresses or txids.
+    :param batch_size: maximum number of keys per query.
+    :return: list of dictionaries with the txid, n, address, value (in satoshis), height and timestamp of each output,
+      and the spent_txid and spent_height of the transaction spending it (None if unspent), ordered by height.
+    '''
+    start = time.time()
+    keys = list(keys)
+    outputs = []
+    cursor = database_cursor(coin)
+    for n in range(0, len(keys), batch_size):
+        batch = keys[n:n + batch_size]
+        query = "SELECT o.`txid`, o.`n`, o.`address`, o.`value`, o.`height`, o.`timestamp`, s.`txid`, s.`height` " \
+                "FROM `output` o LEFT JOIN `spend` s ON s.`spent` = o.`txid` AND s.`vout` = o.`n` " \
+                "WHERE o.`%s` IN (%s)" % (column, ", ".join(["%s"] * len(batch)))
+        utils.vprint(query, level=3)
+        try:
+            cursor.execute(query, batch)
+            for txid, vout, address, value, height, timestamp, spent_txid, spent_height in cursor:
+                outputs.append({
+                    'txid': decode_key(txid),
+                    'n': vout,
+                    'address': decode_key(address),
+                    'value': value,
+                    'height': height,
+                    'timestamp': timestamp,
+                    'spent_txid': decode_key(spent_txid),
+                    'spent_height': spent_height,
+                })
+        except Exception as e:
+            print(query)
+            print("SELECT outputs failed (%s, keys=%d): %s" % (column, len(batch), e))
+            exit(1)
+    outputs.sort(key=lambda output: (output['height'], output['txid'], output['n']))
+    record_queries(start, -(-len(keys) // batch_size))
+    utils.debug({
+        'activity': 'SELECT outputs queries',
+        'column': column,
+        'keys': len(keys),
+        'result_count': len(outputs),
+        'elapsed': utils.elapsed(start, 5)
+    }, level=2)
+    return outputs
+
+def select_inputs(coin, txids, batch_size=1000):
+    '''
+    Select the inputs of transactions from the normalized tables, with the address and value of the output each of
+    them spends.
+
+    :param coin: the coin type.
+    :param txids: list of txids.
+    :param batch_size: maximum number of txids per query.
+    :return: list of dictionaries with the txid, vin_n, spent txid and vout of each input, and the address and value
+      of the output it spends (None if the output is not found), ordered by txid and vin_n. Inputs spending an
+      output with several addresses are returned once per address.
+    '''
+    start = time.time()
+    txids = list(txids)
+    inputs = []
+    cursor = database_cursor(coin)
+    for n in range(0, len(txids), batch_size):
+        batch = txids[n:n + batch_size]
+        query = "SELECT s.`txid`, s.`vin_n`, s.`spent`, s.`vout`, o.`address`, o.`value` " \
+                "FROM `spend` s LEFT JOIN `output` o ON o.`txid` = s.`spent` AND o.`n` = s.`vout` " \
+                "WHERE s.`txid` IN (%s)" % (", ".join(["%s"] * len(batch)),)
+        utils.vprint(query, level=3)
+        try:
+            cursor.execute(query, batch)
+            for txid, vin_n, spent, vout, address, value in cursor:
+                inputs.append({
+                    'txid': decode_key(txid),
+                    'vin_n': vin_n,
+                    'spent': decode_key(spent),
+                    'vout': vout,
+                    'address': decode_key(address),
+                    'value': value,
+                })
+        except Exception as e:
+            print(query)
+            print("SELECT inputs failed (txids=%d): %s" % (len(batch), e))
+            exit(1)
+    inputs.sort(key=lambda vin: (vin['txid'], vin['vin_n']))
+    record_queries(start, -(-len(txids) // batch_size))
+    utils.debug({
+        'activity': 'SELECT inputs queries',
+        'txids': len(txids),
+        'result_count': len(inputs),
+        'elapsed': utils.elapsed(start, 5)
+    }, level=2)
+    return inputs
+
+def remove_normalized_transaction(coin, txid):
+    '''
+    Remove the outputs of a transaction from the normalized tables, and its inputs so the outputs it spent are
+    unspent again, when unwinding an orphaned block.
+    '''
+    flush_writes(coin)
+    cursor = database_cursor(coin)
+    for query in ("DELETE FROM `output` WHERE `txid` = %s", "DELETE FROM `spend` WHERE `txid` = %s"):
+        utils.vprint(query, level=3)
+        try:
+            cursor.execute(query, (txid,))
+        except Exception as e:
+            print(query, txid)
+            print("DELETE query failed (txid=%s): %s" % (txid, e))
+            exit(1)
+
+def apply_utxo(coin, transaction=True, complete=None):
+    '''
+    Apply the outputs and spent outputs loaded into the utxo_add and utxo_spend staging tables to the UTXO set and to
+    the balance of each address: new outputs are added, then the outputs spent are subtracted from the balance of
+    their address and removed. Outputs created and spent by the same blocks are added and removed again.
+
+    The height of the last block applied is recorded with the changes (see get_table_status()), and rows of blocks
+    at or below it are skipped: the blocks of a pass are applied again if the extract script stops before recording
+    their completion in its metadata. Every block has at least a coinbase output, so the last block applied is the
+    highest of the outputs added.
+
+    :param coin: the coin type.
+    :param transaction: apply all changes in a single transaction.
+    :param complete: whether the tables were loaded from the genesis block, defaults to keeping their status.
+    :return: the new status of the tables.
+    '''
+    start = time.time()
+    flush_writes(coin)
+    queries = [
+        "INSERT IGNORE INTO `utxo` SELECT `txid`, `n`, `address`, `value`, `height`, `timestamp` FROM `utxo_add`",
+        # Outputs without an address are in the UTXO set, but have no balance.
+        "INSERT INTO `address_balance` (`address`, `received`, `sent`, `vout`, `txids`, `first_height`, "
+        "`last_height`) SELECT `address`, SUM(`value`), 0, COUNT(*), 0, MIN(`height`), MAX(`height`) FROM `utxo_add` "
+        "WHERE `address` != 'unknown' GROUP BY `address` ON DUPLICATE KEY UPDATE "
+        "`received` = `received` + VALUES(`received`), `vout` = `vout` + VALUES(`vout`), "
+        "`first_height` = LEAST(`first_height`, VALUES(`first_height`)), "
+        "`last_height` = GREATEST(`last_height`, VALUES(`last_height`))",
+        "INSERT INTO `address_balance` (`address`, `received`, `sent`, `vout`, `txids`, `first_height`, "
+        "`last_height`) SELECT u.`address`, 0, SUM(u.`value`), 0, 0, MIN(u.`height`), MAX(u.`height`) "
+        "FROM `utxo_spend` s JOIN `utxo` u ON u.`txid` = s.`spent` AND u.`n` = s.`vout` "
+        "WHERE u.`address` != 'unknown' GROUP BY u.`address` ON DUPLICATE KEY UPDATE "
+        "`sent` = `sent` + VALUES(`sent`)",
+        # A transaction both receiving and spending from an address is counted once.
+        "INSERT INTO `address_balance` (`address`, `received`, `sent`, `vout`, `txids`, `first_height`, "
+        "`last_height`) SELECT `address`, 0, 0, 0, COUNT(DISTINCT `txid`), NULL, NULL FROM ("
+        "SELECT `address`, `txid` FROM `utxo_add` WHERE `address` != 'unknown' UNION "
+        "SELECT u.`address`, s.`txid` FROM `utxo_spend` s JOIN `utxo` u ON u.`txid` = s.`spent` AND u.`n` = s.`vout` "
+        "WHERE u.`address` != 'unknown') t GROUP BY `address` ON DUPLICATE KEY UPDATE "
+        "`txids` = `txids` + VALUES(`txids`)",
+        "DELETE u FROM `utxo` u JOIN `utxo_spend` s ON u.`txid` = s.`spent` AND u.`n` = s.`vout`",
+    ]
+    connection = database_connection(coin)
+    cursor = database_cursor(coin)
+    try:
+        if transaction:
+            connection.start_transaction()
+        status = get_table_status(coin, 'utxo', for_update=transaction) or {'height': None, 'complete': False}
+        if status['height'] is not None:
+            for table in ('utxo_add', 'utxo_spend'):
+                cursor.execute("DELETE FROM `%s` WHERE `height` <= %%s" % (table,), (status['height'],))
+                if cursor.rowcount:
+                    utils.vprint(" > skipped %d %s rows already applied (height <= %d)" %
+                                 (cursor.rowcount, table, status['height']))
+                    logging.warning("skipped %d %s rows already applied (height <= %d)" %
+                                    (cursor.rowcount, table, status['height']))
+        for query in queries:
+            utils.vprint(query, level=3)
+            cursor.execute(query)
+            utils.vprint(" > %d rows affected" % cursor.rowcount, level=2)
+        cursor.execute("SELECT MAX(`height`) FROM `utxo_add`")
+        height, = cursor.fetchone()
+        status = {
+            'height': status['height'] if height is None else height,
+            'complete': status['complete'] if complete is None else complete,
+        }
+        set_table_status(coin, 'utxo', status['height'], status['complete'])
+        if transaction:
+            connection.commit()
+    except Exception as e:
+        if transaction:
+            try:
+                connection.rollback()
+            except:
+                pass
+        print("applying the UTXO staging tables failed: %s" % (e,))
+        exit(1)
+    utils.vprint("applied UTXO staging tables in %s seconds: %s" % (utils.elapsed(start), status))
+    logging.info("applied UTXO staging tables in %s seconds: %s" % (utils.elapsed(start), status))
+    return status
+
+def select_utxo(coin, address):
+    '''
+    Select the unspent outputs of an address from the UTXO set.
+
+    :return: list of dictionaries with the txid, n, value (in satoshis) and height of each output, ordered by height.
+    '''
+    start = time.time()
+    query = "SELECT `txid`, `n`, `value`, `height` FROM `utxo` WHERE `address` = %s ORDER BY `height`, `txid`, `n`"
+    utils.vprint(query, level=3)
+    try:
+        cursor = database_cursor(coin)
+        cursor.execute(query, (address,))
+        outputs = [{
+            'txid': decode_key(txid),
+            'n': n,
+            'value': value,
+            'height': height,
+        } for txid, n, value, height in cursor]
+        record_queries(start)
+        utils.debug({
+            'activity': 'SELECT utxo query',
+            'query': query,
+            'result_count': len(outputs),
+            'elapsed': utils.elapsed(start, 5)
+        }, level=2)
+    except Exception as e:
+        print(query, address)
+        print("SELECT utxo query failed (address=%s): %s" % (address, e))
+        exit(1)
+    return outputs
+
+def select_address_balance(coin, address):
+    '''
+    Select the balance and totals of an address, maintained by the extract script.
+
+    :return: dictionary with the balance, received and sent (in satoshis), the number of vout and txids and the
+      first and last height the address received outputs at, or None if the address is not found.
+    '''
+    start = time.time()
+    query = "SELECT `received`, `sent`, `vout`, `txids`, `first_height`, `last_height` FROM `address_balance` " \
+            "WHERE `address` = %s"
+    utils.vprint(query, level=3)
+    try:
+        cursor = database_cursor(coin)
+        cursor.execute(query, (address,))
+        row = cursor.fetchone()
+        record_queries(start)
+        utils.debug({
+            'activity': 'SELECT address balance query',
+            'query': query,
+            'elapsed': utils.elapsed(start, 5)
+        }, level=2)
+    except Exception as e:
+        print(query, address)
+        print("SELECT address balance query failed (address=%s): %s" % (address, e))
+        exit(1)
+    if not row:
+        return None
+    received, sent, vout, txids, first_height, last_height = row
+    return {
+        'balance': received - sent,
+        'received': received,
+        'sent': sent,
+        'vout': vout,
+        'txids': txids,
+        'first_height': first_height,
+        'last_height': last_height,
+    }
+
+def unwind_utxo_transaction(coin, txid, spent_outputs):
+    '''
+    Revert the changes a transaction made to the UTXO set and to the balance of each address, when unwinding an
+    orphaned block: its outputs are removed, and the outputs it spent are unspent again, read from the vout table.
+
+    The transactions of a block must be reverted in reverse order, so the outputs spent in the same block are
+    restored before the transaction creating them is reverted.
+
+    :param coin: the coin type.
+    :param txid: the transaction.
+    :param spent_outputs: list of (txid, n) tuples, the outputs spent by the transaction.
+    :return: set of the addresses affected.
+    '''
+    flush_writes(coin)
+    connection = database_connection(coin)
+    cursor = database_cursor(coin)
+    try:
+        connection.start_transaction()
+        # Totals to subtract from each address: [received, sent, vout].
+        totals = {}
+        cursor.execute("SELECT `address`, `value` FROM `utxo` WHERE `txid` = %s FOR UPDATE", (txid,))
+        for address, value in cursor.fetchall():
+            address = decode_key(address)
+            totals.setdefault(address, [0, 0, 0])
+            totals[address][0] += value
+            totals[address][2] += 1
+        cursor.execute("DELETE FROM `utxo` WHERE `txid` = %s", (txid,))
+
+        restored = []
+        for spent, n in spent_outputs:
+            vout_json = select(coin, 'vout', spent)
+            if not vout_json:
+                logging.warning("--- spent txid %s not found in vout" % (spent,))
+                continue
+            for address, outputs in vout_json[spent]['addresses'].items():
+                if str(n) in outputs:
+                    restored.append((spent, n, address, outputs[str(n)]['value'], vout_json[spent]['height'],
+                                     outputs[str(n)]['timestamp']))
+                    totals.setdefault(address, [0, 0, 0])
+                    totals[address][1] += outputs[str(n)]['value']
+        if restored:
+            cursor.executemany("INSERT IGNORE INTO `utxo` (`txid`, `n`, `address`, `value`, `height`, `timestamp`) "
+                               "VALUES (%s, %s, %s, %s, %s, %s)", restored)
+
+        totals.pop('unknown', None)
+        if totals:
+            cursor.executemany("UPDATE `address_balance` SET `received` = `received` - %s, `sent` = `sent` - %s, "
+                               "`vout` = `vout` - %s, `txids` = `txids` - 1 WHERE `address` = %s",
+                               [(received, sent, vout, address) for address, (received, sent, vout) in totals.items()])
+            cursor.execute("DELETE FROM `address_balance` WHERE `txids` <= 0 AND `address` IN (%s)" %
+                           (", ".join(["%s"] * len(totals)),), list(totals))
+        connection.commit()
+    except Exception as e:
+        try:
+            connection.rollback()
+        except:
+            pass
+        print("unwinding the UTXO set of txid %s failed: %s" % (txid, e))
+        exit(1)
+    return set(totals)
+
+def unwind_address_heights(coin, addresses, height):
+    '''
+    The first and last heights an address received outputs at can't be reverted incrementally: after unwinding an
+    orphaned block, they are read again from the address table for the addresses that received outputs at or above
+    its height.
+
+    :param coin: the coin type.
+    :param addresses: the addresses affected by the orphaned block.
+    :param height: the height of the orphaned block.
+    :return: None
+    '''
+    if not addresses:
+        return
+    flush_writes(coin)
+    cursor = database_cursor(coin)
+    addresses = list(addresses)
+    cursor.execute("SELECT `address` FROM `address_balance` WHERE `last_height` >= %%s AND `address` IN (%s)" %
+                   (", ".join(["%s"] * len(addresses)),), [height] + addresses)
+    for address, in cursor.fetchall():
+        address = decode_key(address)
+        view = select_address_view(coin, address)
+        if view:
+            segments = view['directory']['segments']
+            first_height, last_height = segments[0]['first_height'], segments[-1]['last_height']
+        else:
+            first_height = last_height = None
+        cursor.execute("UPDATE `address_balance` SET `first_height` = %s, `last_height` = %s WHERE `address` = %s",
+                       (first_height, last_height, address))
+
+def get_write_buffer(coin):
+    try:
+        _ = globals.write_buffer
+    except:
+        globals.write_buffer = {}
+
+    if coin not in globals.write_buffer:
+        globals.write_buffer[coin] = {
+            'depth': 0,
+            'batch_size': 0,
+            'queue': [],
+            'keys': set(),
+            'stats': {
+                'flushes': 0,
+                'rows': 0,
+                'transactions': 0,
+                'commit_elapsed': 0.0,
+                'max_commit_elapsed': 0.0,
+            },
+        }
+    return globals.write_buffer[coin]
+
+def buffer_write(coin, operation, table, key, value=None):
+    '''
+    Queue an insert, update or delete if a write-behind buffer is active.
+
+    :return: True if the write was queued, False if it must be executed immediately.
+    '''
+    write_buffer = get_write_buffer(coin)
+    if not write_buffer['depth']:
+        return False
+    write_buffer['queue'].append((operation, table, key, value))
+    write_buffer['keys'].add((table, key))
+    if len(write_buffer['queue']) >= write_buffer['batch_size']:
+        flush_writes(coin)
+    return True
+
+def flush_writes(coin):
+    '''
+    Execute all queued writes, in order, committing a transaction per batch. Consecutive writes of the same kind to
+    the same table are executed together with executemany().
+
+    :param coin: the coin type.
+    :return: None
+    '''
+    write_buffer = get_write_buffer(coin)
+    queue = write_buffer['queue']
+    if not queue:
+        return
+    start = time.time()
+    write_buffer['queue'] = []
+    write_buffer['keys'] = set()
+    batch_size = max(1, write_buffer['batch_size'])
+    stats = write_buffer['stats']
+    if get_backend(coin) == 'sqlite':
+        connection = kvstore.connect(coin)
+    else:
+        connection = database_connection(coin)
+    for offset in range(0, len(queue), batch_size):
+        batch = queue[offset:offset + batch_size]
+        try:
+            connection.start_transaction()
+            index = 0
+            while index < len(batch):
+                operation, table, _, _ = batch[index]
+                end = index
+                while end < len(batch) and batch[end][:2] == (operation, table):
+                    end += 1
+                if get_backend(coin) == 'sqlite':
+                    if operation == 'insert':
+                        kvstore.insert(coin, table, [(key, codec.encode(coin, value))
+                                                     for _, _, key, value in batch[index:end]])
+                    elif operation == 'update':
+                        kvstore.update(coin, table, [(key, codec.encode(coin, value))
+                                                     for _, _, key, value in batch[index:end]])
+                    else:
+                        kvstore.delete(coin, table, [key for _, _, key, _ in batch[index:end]])
+                    index = end
+                    continue
+                if operation == 'insert':
+                    query = "INSERT INTO %s (`hash`, `data`) VALUES (%s, %%s)%s" % (table, key_sql(coin, table) % "%s",
+                                                                                    insert_suffix(coin, table))
+                    parameters = [(key, codec.encode(coin, value)) for _, _, key, value in batch[index:end]]
+                elif operation == 'update':
+                    query = "UPDATE %s SET `data` = %%s WHERE `hash` = %s" % (table, key_sql(coin, table) % "%s")
+                    parameters = [(codec.encode(coin, value), key) for _, _, key, value in batch[index:end]]
+                else:
+                    query = "DELETE FROM %s WHERE `hash` = %s" % (table, key_sql(coin, table) % "%s")
+                    parameters = [(key,) for _, _, key, _ in batch[index:end]]
+                utils.vprint("%s (%d rows)" % (query, len(parameters)), level=3)
+                database_cursor(coin).executemany(query, parameters)
+                index = end
+            commit_start = time.time()
+            connection.commit()
+            commit_elapsed = time.time() - commit_start
+        except Exception as e:
+            try:
+                connection.rollback()
+            except:
+                pass
+            print("write-behind flush failed (%d queued writes): %s" % (len(queue), e))
+            exit(1)
+        stats['transactions'] += 1
+        stats['commit_elapsed'] += commit_elapsed
+        stats['max_commit_elapsed'] = max(stats['max_commit_elapsed'], commit_elapsed)
+    stats['flushes'] += 1
+    stats['rows'] += len(queue)
+    utils.debug({
+        'activity': 'write-behind flush',
+        'rows': len(queue),
+        'transactions': (len(queue) + batch_size - 1) // batch_size,
+        'elapsed': utils.elapsed(start, 5)
+    }, level=2)
+
+def write_behind_stats(coin):
+    '''
+    Counters of the write-behind buffer: flushes, rows written, transactions committed and commit latency.
+    '''
+    stats = get_write_buffer(coin)['stats'].copy()
+    stats['average_commit_elapsed'] = stats['commit_elapsed'] / stats['transactions'] if stats['transactions'] else 0
+    return stats
+
+@contextlib.contextmanager
+def write_behind(coin, batch_size=1000):
+    '''
+    Queue inserts, updates and deletes instead of executing each of them as its own autocommitted statement. Queued
+    writes are flushed with executemany() in transactions of up to batch_size rows: when the queue is full, before
+    selecting a key with pending writes, and when leaving the context, so all writes are durable once it exits.
+
+    If the context exits with an exception, queued writes are discarded.
+
+    :param coin: the coin type.
+    :param batch_size: maximum number of writes per transaction.
+    '''
+    write_buffer = get_write_buffer(coin)
+    if write_buffer['depth']:
+        # Already buffering.
+        yield write_buffer
+        return
+    write_buffer['depth'] = 1
+    write_buffer['batch_size'] = batch_size
+    try:
+        yield write_buffer
+    except BaseException:
+        utils.vprint("discarding %d queued writes" % (len(write_buffer['queue']),))
+        logging.warning("discarding %d queued writes" % (len(write_buffer['queue']),))
+        write_buffer['queue'] = []
+        write_buffer['keys'] = set()
+        raise
+    finally:
+        write_buffer['depth'] = 0
+    flush_writes(coin)
@@ -0,0 +1,316 @@
+'''
+Embedded storage backend: an ordered key-value store in a local SQLite database, for single-node deployments without a
+MySQL server. Selected per coin with the `backend` setting, dbutils dispatches its reads and writes here.
+
+Each table is a B-tree ordered by key (a WITHOUT ROWID table with the key as primary key), holding the rows encoded by
+the codec. Like the compact MySQL schema, a key is stored once and the first row of a key is kept. Address deltas are
+appended with an auto-increment id, and indexed by address and id.
+
+The database is written in WAL mode, so the API can read it while the extract script writes it: the API opens it
+read-only and memory-mapped (set globals.args.read_only).
+'''
+import contextlib
+import csv
+import os
+import sqlite3
+import time
+
+# Custom libraries:
+from include import codec
+from include import globals
+from include import utils
+
+
+class Connection(sqlite3.Connection):
+    '''
+    SQLite connection in autocommit mode, with explicit transactions like mysql.connector connections.
+    '''
+    def start_transaction(self):
+        # Take the write lock immediately, so concurrent writers wait instead of failing when committing.
+        self.execute("BEGIN IMMEDIATE")
+
+def get_store_settings():
+    '''
+    Embedded store settings, optionally overridden by an `sqlite` dictionary in settings.py.
+    '''
+    store_settings = {
+        'path': 'blockchain_data/{coin}/',
+        'mmap_size': 2 * 1024 ** 3,
+        'cache_size': 256 * 1024 ** 2,
+        'synchronous': 'NORMAL',
+        'timeout': 3600,
+        'batch_size': 100000,
+    }
+    try:
+        store_settings.update(globals.settings.sqlite)
+    except:
+        pass
+    return store_settings
+
+def get_store_path(coin):
+    '''
+    The database file of a coin, in the directory set with the `path` setting or the --db option.
+    '''
+    try:
+        path = globals.args.db
+    except:
+        path = None
+    if not path:
+        path = get_store_settings()['path'].replace('{coin}', coin)
+    return os.path.join(path, coin + '.sqlite')
+
+def is_read_only():
+    try:
+        return bool(globals.args.read_only)
+    except:
+        return False
+
+def connect(coin):
+    start = time.time()
+    try:
+        _ = globals.kvstore
+    except:
+        globals.kvstore = {}
+
+    if coin not in globals.kvstore:
+        store_settings = get_store_settings()
+        path = get_store_path(coin)
+        read_only = is_read_only()
+        utils.vprint('opening %s store %s' % (coin, path))
+        if read_only:
+            connection = sqlite3.connect('file:%s?mode=ro' % (path,), uri=True, factory=Connection,
+                                         isolation_level=None, timeout=store_settings['timeout'],
+                                         check_same_thread=False)
+        else:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            connection = sqlite3.connect(path, factory=Connection, isolation_level=None,
+                                         timeout=store_settings['timeout'])
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = %s" % (store_settings['synchronous'],))
+        connection.execute("PRAGMA mmap_size = %d" % (store_settings['mmap_size'],))
+        # A negative cache size is in KiB.
+        connection.execute("PRAGMA cache_size = %d" % (-(store_settings['cache_size'] // 1024),))
+        globals.kvstore[coin] = connection
+        utils.debug(message={
+            'activity': 'opened %s store %s (read_only=%s)' % (coin, path, read_only),
+            'elapsed': utils.elapsed(start, 5),
+        }, level=2)
+    return globals.kvstore[coin]
+
+def close(coin):
+    try:
+        _ = globals.kvstore
+    except:
+        # No store to close
+        return
+
+    if coin in globals.kvstore:
+        utils.vprint('closing %s store' % (coin,))
+        globals.kvstore[coin].close()
+        del globals.kvstore[coin]
+
+def execute(coin, query, parameters=(), many=False):
+    '''
+    Execute a query, exiting if it fails.
+
+    :return: the cursor.
+    '''
+    utils.vprint(query, level=3)
+    try:
+        cursor = connect(coin).cursor()
+        if many:
+            cursor.executemany(query, parameters)
+        else:
+            cursor.execute(query, parameters)
+        return cursor
+    except sqlite3.Error as e:
+        print(query)
+        print("%s query failed: %s" % (get_store_path(coin), e))
+        exit(1)
+
+@contextlib.contextmanager
+def transaction(coin):
+    '''
+    Execute the enclosed writes in a single transaction, unless already in one.
+    '''
+    connection = connect(coin)
+    if connection.in_transaction:
+        yield connection
+        return
+    connection.start_transaction()
+    try:
+        yield connection
+    except BaseException:
+        connection.rollback()
+        raise
+    connection.commit()
+
+def has_id(table):
+    '''
+    Address deltas are identified by an auto-increment id, all other tables by their key.
+    '''
+    return table == 'address_delta'
+
+def table_definition(table):
+    '''
+    The queries creating a table.
+    '''
+    if has_id(table):
+        return [
+            'CREATE TABLE IF NOT EXISTS "%s" ("id" INTEGER PRIMARY KEY AUTOINCREMENT, "hash" TEXT NOT NULL, '
+            '"data" BLOB NOT NULL)' % (table,),
+            'CREATE INDEX IF NOT EXISTS "%s_hash" ON "%s" ("hash", "id")' % (table, table),
+        ]
+    return ['CREATE TABLE IF NOT EXISTS "%s" ("hash" TEXT NOT NULL PRIMARY KEY, "data" BLOB NOT NULL) WITHOUT ROWID' %
+            (table,)]
+
+def create_tables(coin, tables):
+    for table in tables:
+        utils.vprint("creating %s.%s table (if not exists)" % (coin, table))
+        for query in table_definition(table):
+            execute(coin, query)
+
+def truncate(coin, table):
+    '''
+    Empty a table: dropping and creating it again is much faster than deleting every row.
+    '''
+    utils.vprint("truncating %s.%s table" % (coin, table))
+    execute(coin, 'DROP TABLE IF EXISTS "%s"' % (table,))
+    for query in table_definition(table):
+        execute(coin, query)
+
+def insert_query(table):
+    if has_id(table):
+        return 'INSERT INTO "%s" ("hash", "data") VALUES (?, ?)' % (table,)
+    # Like select() with the legacy MySQL schema, the first row of a key is kept.
+    return 'INSERT OR IGNORE INTO "%s" ("hash", "data") VALUES (?, ?)' % (table,)
+
+def load_file(coin, table, filename):
+    '''
+    Bulk load the grouped rows of a tab separated file written by a load phase, streaming them into the table in
+    transactions of batch_size rows.
+
+    :return: number of rows read.
+    '''
+    start = time.time()
+    batch_size = get_store_settings()['batch_size']
+    binary = codec.is_binary(codec.get_codec(coin))
+    query = insert_query(table)
+    rows = []
+    count = 0
+    with open(filename, newline='') as f_tsv:
+        for key, data in csv.reader(f_tsv, delimiter='\t', quoting=csv.QUOTE_NONE, escapechar='\\'):
+            # Binary rows are written as hex.
+            rows.append((key, bytes.fromhex(data) if binary else data))
+            if len(rows) >= batch_size:
+                with transaction(coin):
+                    execute(coin, query, rows, many=True)
+                count += len(rows)
+                rows = []
+    if rows:
+        with transaction(coin):
+            execute(coin, query, rows, many=True)
+        count += len(rows)
+    utils.debug({
+        'activity': 'bulk load',
+        'table': table,
+        'rows': count,
+        'elapsed': utils.elapsed(start, 5)
+    }, level=2)
+    return count
+
+def select(coin, table, key):
+    '''
+    :return: the encoded row of a key, or None.
+    '''
+    for data, in execute(coin, 'SELECT "data" FROM "%s" WHERE "hash" = ?%s LIMIT 1' %
+                         (table, ' ORDER BY "id"' if has_id(table) else ''), (key,)):
+        return data
+    return None
+
+def select_many(coin, table, keys, batch_size=500):
+    '''
+    :return: dictionary mapping each key that was found to a tuple of (id, encoded row), id is None except for
+      address deltas. If a key is found more than once only the first row is used.
+    '''
+    results = {}
+    keys = list(keys)
+    for n in range(0, len(keys), batch_size):
+        batch = keys[n:n + batch_size]
+        query = 'SELECT %s, "hash", "data" FROM "%s" WHERE "hash" IN (%s)%s' % \
+                ('"id"' if has_id(table) else 'NULL', table, ", ".join(["?"] * len(batch)),
+                 ' ORDER BY "id"' if has_id(table) else '')
+        for id, key, data in execute(coin, query, batch):
+            if key not in results:
+                results[key] = (id, data)
+    return results
+
+def select_all(coin, table, key):
+    '''
+    :return: list of (id, encoded row) tuples of a key, in the order they were inserted.
+    '''
+    if has_id(table):
+        query = 'SELECT "id", "data" FROM "%s" WHERE "hash" = ? ORDER BY "id"' % (table,)
+    else:
+        query = 'SELECT NULL, "data" FROM "%s" WHERE "hash" = ?' % (table,)
+    return execute(coin, query, (key,)).fetchall()
+
+def insert(coin, table, rows):
+    '''
+    :param rows: list of (key, encoded row) tuples.
+    '''
+    with transaction(coin):
+        execute(coin, insert_query(table), rows, many=True)
+
+def update(coin, table, rows):
+    '''
+    :param rows: list of (key, encoded row) tuples.
+    '''
+    with transaction(coin):
+        execute(coin, 'UPDATE "%s" SET "data" = ? WHERE "hash" = ?' % (table,),
+                [(data, key) for key, data in rows], many=True)
+
+def delete(coin, table, keys):
+    with transaction(coin):
+        execute(coin, 'DELETE FROM "%s" WHERE "hash" = ?' % (table,), [(key,) for key in keys], many=True)
+
+def upsert(coin, table, rows):
+    '''
+    Insert or update rows.
+
+    :param rows: list of (id, key, encoded row) tuples: id is the id of the existing address delta to update, or
+      None to insert a new one. Rows of other tables are identified by their key and id is ignored.
+    '''
+    with transaction(coin):
+        if has_id(table):
+            execute(coin, insert_query(table), [(key, data) for id, key, data in rows if id is None], many=True)
+            execute(coin, 'UPDATE "%s" SET "data" = ? WHERE "id" = ?' % (table,),
+                    [(data, id) for id, key, data in rows if id is not None], many=True)
+        else:
+            execute(coin, 'INSERT INTO "%s" ("hash", "data") VALUES (?, ?) ON CONFLICT ("hash") DO UPDATE SET '
+                          '"data" = excluded."data"' % (table,), [(key, data) for id, key, data in rows], many=True)
+
+def delete_deltas(coin, address, max_id):
+    '''
+    Delete the address deltas of an address up to an id, once they are compacted.
+    '''
+    with transaction(coin):
+        execute(coin, 'DELETE FROM "address_delta" WHERE "hash" = ? AND "id" <= ?', (address, max_id))
+
+def get_address_deltas(coin, min_deltas=1, limit=None):
+    '''
+    :return: list of (address, number of deltas) tuples, those with the most deltas first.
+    '''
+    query = 'SELECT "hash", COUNT(*) AS deltas FROM "address_delta" GROUP BY "hash" HAVING deltas >= ? ' \
+            'ORDER BY deltas DESC'
+    parameters = [min_deltas]
+    if limit:
+        query += ' LIMIT ?'
+        parameters.append(limit)
+    return execute(coin, query, parameters).fetchall()
+
+def select_ordered(coin, table):
+    '''
+    :return: iterator of the (key, encoded row) tuples of a table, sorted by key.
+    '''
+    return execute(coin, 'SELECT "hash", "data" FROM "%s" ORDER BY "hash"' % (table,))
@@ -0,0 +1,281 @@
+'''
+Read-only lookup index: an immutable snapshot of a coin's tables on local disk, which the API memory-maps and searches
+instead of querying the database.
+
+Each table is written as three files, sorted by key:
+ - <table>.keys: the keys, concatenated
+ - <table>.offsets: an offset table of (key offset, data offset) pairs of little-endian uint64, one per key plus a
+   final pair marking the end of the last key and row
+ - <table>.data: the encoded rows, concatenated (as stored in the database, decoded by the codec)
+
+Keys are found with a binary search of the offset table. The files are opened read-only with mmap, so gunicorn workers
+share the pages in the page cache.
+
+extract.py builds a new index in its own directory after each run, then atomically replaces the `current` symlink
+with a symlink to it. Readers check where the symlink points at most every check_interval seconds, and switch to the
+new index without restarting: files of older indexes stay readable until they are unmapped, even once removed.
+
+Rows of the address and vin_spent tables change as blocks are loaded, and rows of any table are removed when an orphaned
+block is unwound. Each table records the row cache state (see include/rowcache.py) it was built at: readers only use the
+versioned tables while that version is current, and no table once a new epoch is published, reading the database
+until the next index is swapped in.
+'''
+import contextlib
+import fcntl
+import json
+import mmap
+import os
+import shutil
+import struct
+import time
+
+# Custom libraries:
+from include import globals
+from include import kvstore
+from include import rowcache
+from include import utils
+
+
+OFFSET = struct.Struct('<QQ')
+
+def get_index_settings(coin):
+    '''
+    Lookup index settings, optionally overridden by a `lookup_index` dictionary in settings.py.
+    '''
+    index_settings = {
+        'enabled': False,
+        'path': 'blockchain_data/{coin}/index/',
+        'tables': ['vout', 'vin_spent', 'vin_txid', 'coinbase', 'address', 'block'],
+        'keep': 2,
+        'check_interval': 1,
+    }
+    try:
+        index_settings.update(globals.settings.lookup_index)
+    except:
+        pass
+    index_settings['path'] = index_settings['path'].replace('{coin}', coin)
+    return index_settings
+
+def is_enabled(coin):
+    return get_index_settings(coin)['enabled']
+
+class Table:
+    '''
+    A memory-mapped table of an index.
+
+    :param state: the row cache state the table was built at.
+    '''
+    def __init__(self, path, table, state=None):
+        self.state = state
+        self.maps = [self.map(os.path.join(path, table + extension)) for extension in ('.keys', '.offsets', '.data')]
+        self.keys, self.offsets, self.data = self.maps
+        self.count = len(self.offsets) // OFFSET.size - 1
+
+    @staticmethod
+    def map(filename):
+        with open(filename, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                # Empty files can't be mapped.
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get(self, key):
+        '''
+        :return: the encoded row of a key, or None.
+        '''
+        key = key.encode()
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            key_start, data_start = OFFSET.unpack_from(self.offsets, middle * OFFSET.size)
+            key_end, data_end = OFFSET.unpack_from(self.offsets, (middle + 1) * OFFSET.size)
+            current = self.keys[key_start:key_end]
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                return self.data[data_start:data_end]
+        return None
+
+class Index:
+    '''
+    The tables of an index build.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'index.json')) as f:
+            self.metadata = json.load(f)
+        states = self.metadata.get('states', {})
+        self.tables = {table: Table(path, table, states.get(table)) for table in self.metadata['tables']}
+
+def open_index(coin):
+    '''
+    The current index of a coin, or None if there is none. Only readers (globals.args.read_only) use the index: the
+    extract script writes the database the index is built from.
+
+    :return: the Index.
+    '''
+    if not kvstore.is_read_only():
+        return None
+    try:
+        _ = globals.lookup_index
+    except:
+        globals.lookup_index = {}
+
+    index_settings = get_index_settings(coin)
+    now = time.time()
+    index, checked = globals.lookup_index.get(coin, (None, 0))
+    if now - checked < index_settings['check_interval']:
+        return index
+
+    try:
+        path = os.path.join(index_settings['path'], os.readlink(os.path.join(index_settings['path'], 'current')))
+    except OSError:
+        path = None
+    if path is None:
+        index = None
+    elif index is None or index.path != path:
+        start = time.time()
+        try:
+            index = Index(path)
+        except OSError as e:
+            # Removed before it was opened, a newer index is swapped in.
+            utils.debug({'activity': 'failed to open lookup index %s' % (path,), 'error': str(e)})
+            index = None
+        else:
+            utils.debug(message={
+                'activity': 'opened %s lookup index %s' % (coin, path),
+                'elapsed': utils.elapsed(start, 5),
+            }, level=2)
+    globals.lookup_index[coin] = (index, now)
+    return index
+
+def is_current(coin, table, state):
+    '''
+    Whether the indexed rows of a table are still those in the database: no orphaned block was unwound since the table
+    was built, and for the versioned tables no blocks were loaded either.
+
+    :param state: the row cache state the table was built at.
+    '''
+    current = rowcache.get_state(coin)
+    if state is None or current is None:
+        return False
+    if current['epoch'] != state['epoch']:
+        return False
+    return table not in rowcache.get_versioned_tables() or current['version'] == state['version']
+
+def get_table(coin, table):
+    '''
+    :return: the Table of the current index, or None if it isn't indexed or its rows may have changed since it was
+      built.
+    '''
+    index = open_index(coin)
+    if index is None:
+        return None
+    index_table = index.tables.get(table)
+    if index_table is None or not is_current(coin, table, index_table.state):
+        return None
+    return index_table
+
+def write_table(path, table, rows):
+    '''
+    Write the files of a table.
+
+    :param rows: iterator of (key, encoded row) tuples, sorted by key.
+    :return: number of rows written.
+    '''
+    count = 0
+    key_offset = data_offset = 0
+    previous = None
+    with open(os.path.join(path, table + '.keys'), 'wb') as f_keys, \
+            open(os.path.join(path, table + '.offsets'), 'wb') as f_offsets, \
+            open(os.path.join(path, table + '.data'), 'wb') as f_data:
+        for key, data in rows:
+            key = key.encode()
+            if isinstance(data, str):
+                data = data.encode()
+            if previous is not None and key <= previous:
+                print("%s keys are not sorted: %r after %r" % (table, key, previous))
+                exit(1)
+            previous = key
+            f_offsets.write(OFFSET.pack(key_offset, data_offset))
+            f_keys.write(key)
+            f_data.write(data)
+            key_offset += len(key)
+            data_offset += len(data)
+            count += 1
+        f_offsets.write(OFFSET.pack(key_offset, data_offset))
+        for f in (f_keys, f_offsets, f_data):
+            f.flush()
+            os.fsync(f.fileno())
+    return count
+
+@contextlib.contextmanager
+def build_lock(path):
+    '''
+    Serialize builds, for example extract.py and compact.py.
+    '''
+    with open(os.path.join(path, 'build.lock'), 'w') as f_lock:
+        fcntl.flock(f_lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f_lock, fcntl.LOCK_UN)
+
+def build(coin, select_ordered, tables=None, state=None):
+    '''
+    Build a new index and swap it in. Tables that aren't rebuilt are linked from the current index.
+
+    :param select_ordered: function of (coin, table) returning an iterator of (key, encoded row) tuples, sorted by key.
+    :param tables: the tables to rebuild, defaults to all indexed tables.
+    :param state: the row cache state published once the rows were written, from rowcache.publish(). Readers don't
+      use tables built without one.
+    :return: path of the new index.
+    '''
+    start = time.time()
+    index_settings = get_index_settings(coin)
+    path = index_settings['path']
+    os.makedirs(path, exist_ok=True)
+    with build_lock(path):
+        current = os.path.join(path, 'current')
+        try:
+            current_path = os.path.join(path, os.readlink(current))
+            with open(os.path.join(current_path, 'index.json')) as f:
+                current_metadata = json.load(f)
+        except OSError:
+            current_path = None
+            current_metadata = {'tables': {}, 'states': {}}
+
+        name = 'build-%d' % (time.time() * 1000,)
+        build_path = os.path.join(path, name)
+        os.makedirs(build_path)
+        metadata = {'coin': coin, 'created': time.time(), 'tables': {}, 'states': {}}
+        for table in index_settings['tables']:
+            if tables is not None and table not in tables and table in current_metadata['tables']:
+                for extension in ('.keys', '.offsets', '.data'):
+                    os.link(os.path.join(current_path, table + extension), os.path.join(build_path, table + extension))
+                metadata['tables'][table] = current_metadata['tables'][table]
+                metadata['states'][table] = current_metadata.get('states', {}).get(table)
+                continue
+            table_start = time.time()
+            utils.vprint("building %s lookup index of %s" % (table, coin))
+            metadata['tables'][table] = write_table(build_path, table, select_ordered(coin, table))
+            metadata['states'][table] = state
+            utils.vprint(" > %s: %d keys in %s seconds" % (table, metadata['tables'][table],
+                                                           utils.elapsed(table_start)), level=2)
+        with open(os.path.join(build_path, 'index.json'), 'w') as f:
+            json.dump(metadata, f)
+
+        # Atomically point the current symlink at the new index.
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(current + '.tmp')
+        os.symlink(name, current + '.tmp')
+        os.replace(current + '.tmp', current)
+
+        # Remove older indexes, readers that still have them mapped keep reading them.
+        builds = sorted(entry for entry in os.listdir(path) if entry.startswith('build-'))
+        for old in builds[:-max(index_settings['keep'], 1)]:
+            shutil.rmtree(os.path.join(path, old), ignore_errors=True)
+    utils.vprint("built %s lookup index %s in %s seconds" % (coin, build_path, utils.elapsed(start)))
+    return build_path
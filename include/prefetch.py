@@ -0,0 +1,85 @@
+'''
+Concurrent block prefetcher used when extracting the blockchain.
+
+Blocks are requested from the coin daemon's REST server on a pool of threads, keeping a bounded window of requests
+in flight, and are handed back strictly in height order so the caller can process them exactly as if they had been
+requested one at a time.
+'''
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+# Custom libraries:
+from include import globals
+from include import rpc
+from include import utils
+
+
+def resolve_block_hashes(start_height, end_height):
+    '''
+    Resolve a range of block heights to block hashes with a single batch of RPC requests.
+
+    :param start_height: first height to resolve.
+    :param end_height: last height to resolve (inclusive).
+    :return: list of block hashes in height order, truncated at the first height the daemon doesn't know about.
+    '''
+    hashes = []
+    calls = [('getblockhash', [height]) for height in range(start_height, end_height + 1)]
+    for height, response in zip(range(start_height, end_height + 1), rpc.rpc_batch(calls)):
+        if response['error'] or not response['result']:
+            utils.vprint("no block hash for height %d, end of blockchain: %s" % (height, response['error']), level=2)
+            break
+        hashes.append(response['result'])
+    return hashes
+
+def prefetch_blocks(start_height, end_height, concurrency=4, window=16, raw=False):
+    '''
+    Fetch blocks concurrently, yielding them strictly in height order.
+
+    Heights are resolved to hashes one RPC batch at a time, then each block is requested on a thread pool. At most
+    `window` blocks are requested but not yet consumed at any time, bounding memory use.
+
+    :param start_height: first height to fetch.
+    :param end_height: last height to fetch (inclusive).
+    :param concurrency: number of threads requesting blocks from the daemon.
+    :param window: maximum number of blocks requested ahead of the block being processed.
+    :param raw: request raw blocks and parse them locally, instead of requesting JSON blocks.
+    :return: generator of (block, queue depth) tuples, where block is None if the request failed.
+    '''
+    concurrency = max(1, concurrency)
+    window = max(concurrency, window)
+    utils.vprint("prefetching blocks %d-%d (concurrency=%d window=%d)" % (start_height, end_height, concurrency,
+                                                                         window), level=2)
+    pending = collections.deque()
+    hashes = collections.deque()
+    height = start_height
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        try:
+            while True:
+                # Top up the window of in-flight requests.
+                while height <= end_height and len(pending) < window:
+                    if not hashes:
+                        hashes.extend(resolve_block_hashes(height, min(end_height, height + rpc.get_batch_size() - 1)))
+                        if not hashes:
+                            # The daemon doesn't know about any more blocks.
+                            end_height = height - 1
+                            break
+                    hash = hashes.popleft()
+                    if raw:
+                        future = executor.submit(utils.request_raw_block, hash, height, globals.settings)
+                    else:
+                        future = executor.submit(utils.request_block, hash, globals.settings)
+                    pending.append((height, hash, future))
+                    height += 1
+
+                if not pending:
+                    return
+
+                block_height, hash, future = pending.popleft()
+                block = future.result()
+                if block is not None:
+                    assert block['hash'] == hash
+                yield block, len(pending)
+        finally:
+            # The consumer may stop early (for example when reaching --limit): don't wait on unwanted blocks.
+            for _, _, future in pending:
+                future.cancel()
@@ -0,0 +1,249 @@
+'''
+Row cache of the API: decoded rows kept across requests by each worker, in a least recently used cache bounded by the
+size of the rows.
+
+Rows of the vout, vin_txid, coinbase and block tables don't change once loaded, and are kept until they are evicted.
+Rows of the address and vin_spent tables change as blocks are loaded, and are only used while the version they were
+cached at is current. Keys of these tables that aren't found are cached too: most outputs are unspent.
+
+The extract script publishes a new version in a state file after each run (and compact.py after compacting
+addresses), and a new epoch when it unwinds an orphaned block: rows of any table may have been removed, so the rows of
+the coin are dropped. Workers check the state file at most every check_interval seconds, and only cache rows while
+they can read it.
+'''
+import collections
+import contextlib
+import fcntl
+import json
+import os
+import threading
+import time
+
+# Custom libraries:
+from include import globals
+from include import kvstore
+from include import utils
+
+
+def get_immutable_tables():
+    return ["vout", "vin_txid", "coinbase", "block"]
+
+def get_versioned_tables():
+    return ["address", "vin_spent"]
+
+# Cached for keys of the versioned tables that aren't found.
+NOT_FOUND = 'not found'
+
+def get_cache_settings(coin):
+    '''
+    Row cache settings, optionally overridden by a `row_cache` dictionary in settings.py.
+    '''
+    cache_settings = {
+        'size': 256 * 1024 ** 2,
+        'state_path': 'blockchain_data/{coin}/',
+        'check_interval': 1,
+    }
+    try:
+        cache_settings.update(globals.settings.row_cache)
+    except:
+        pass
+    cache_settings['state_path'] = cache_settings['state_path'].replace('{coin}', coin)
+    return cache_settings
+
+def get_state_file(coin):
+    return os.path.join(get_cache_settings(coin)['state_path'], 'state.json')
+
+class LRU:
+    '''
+    Least recently used cache of rows, bounded by their total size in bytes.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # (coin, table, key): (version, size, row), least recently used first.
+        self.rows = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = self.expired = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        '''
+        :param version: the current version of the row's table, None if its rows don't change.
+        :return: the row, or None if it isn't cached or is outdated.
+        '''
+        with self.lock:
+            entry = self.rows.get(key)
+            if entry is not None and entry[0] != version:
+                self.remove(key)
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.rows.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, version, size, row):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.rows:
+                self.remove(key)
+            self.rows[key] = (version, size, row)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self.rows.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def remove(self, key):
+        _, size, _ = self.rows.pop(key)
+        self.bytes -= size
+
+    def clear(self, coin):
+        with self.lock:
+            for key in [key for key in self.rows if key[0] == coin]:
+                self.remove(key)
+
+def get_lru():
+    try:
+        return globals.lru_cache
+    except:
+        # The size isn't set per coin: all coins share the worker's cache.
+        globals.lru_cache = LRU(get_cache_settings('')['size'])
+        return globals.lru_cache
+
+def read_state(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def get_state(coin):
+    '''
+    The state published by the extract script, read again at most every check_interval seconds. Rows of the coin are
+    dropped when its epoch changes.
+
+    :return: dictionary with the version and epoch, or None if the state file can't be read.
+    '''
+    try:
+        _ = globals.cache_state
+    except:
+        globals.cache_state = {}
+
+    now = time.time()
+    state, checked, mtime = globals.cache_state.get(coin, (None, 0, None))
+    if now - checked < get_cache_settings(coin)['check_interval']:
+        return state
+
+    filename = get_state_file(coin)
+    try:
+        # The state file is replaced, not written in place.
+        stat = os.stat(filename)
+        new_mtime = (stat.st_mtime_ns, stat.st_ino)
+    except OSError:
+        new_mtime = None
+    if new_mtime is None:
+        new_state = None
+    elif new_mtime == mtime:
+        new_state = state
+    else:
+        new_state = read_state(filename)
+    if state is not None and (new_state is None or new_state['epoch'] != state['epoch']):
+        get_lru().clear(coin)
+    if new_state is not None and (state is None or new_state['version'] != state['version']):
+        utils.debug(message={'row cache state': new_state}, level=2)
+    globals.cache_state[coin] = (new_state, now, new_mtime)
+    return new_state
+
+def is_enabled(coin, table):
+    '''
+    Whether rows of a table are cached: only by readers (globals.args.read_only), while the state file is readable.
+    '''
+    if table not in get_immutable_tables() and table not in get_versioned_tables():
+        return False
+    if not kvstore.is_read_only() or not get_cache_settings(coin)['size']:
+        return False
+    return get_state(coin) is not None
+
+def get_version(coin, table):
+    '''
+    The current version of a table's rows, read before selecting rows: rows selected while a new version is
+    published are cached at the previous version.
+
+    :return: the version, None if the rows of the table don't change.
+    '''
+    if table in get_immutable_tables():
+        return None
+    return get_state(coin)['version']
+
+def get(coin, table, key, version):
+    '''
+    :return: the decoded row, NOT_FOUND if the key wasn't found, or None if it isn't cached.
+    '''
+    return get_lru().get((coin, table, key), version)
+
+def put(coin, table, key, version, row, size):
+    '''
+    :param row: the decoded row, or NOT_FOUND if the key wasn't found (only cached for the versioned tables).
+    :param size: size of the encoded row, approximating the memory used by the decoded row.
+    '''
+    if row is NOT_FOUND and version is None:
+        # The key may be loaded with the next blocks.
+        return
+    get_lru().put((coin, table, key), version, size + len(key), row)
+
+def stats():
+    lru = get_lru()
+    lookups = lru.hits + lru.misses
+    return {
+        'hit_ratio': round(lru.hits / lookups, 3) if lookups else None,
+        'hits': lru.hits,
+        'misses': lru.misses,
+        'expired': lru.expired,
+        'evictions': lru.evictions,
+        'rows': len(lru.rows),
+        'resident_bytes': lru.bytes,
+        'max_bytes': lru.max_bytes,
+    }
+
+@contextlib.contextmanager
+def state_lock(path):
+    '''
+    Serialize updates of the state file, for example by extract.py and compact.py.
+    '''
+    with open(os.path.join(path, 'state.lock'), 'w') as f_lock:
+        fcntl.flock(f_lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f_lock, fcntl.LOCK_UN)
+
+def publish(coin, event, tip=None):
+    '''
+    Publish a new version of the coin's rows once they are written, so workers stop using the cached rows of the
+    versioned tables.
+
+    :param event: 'tip' when new blocks were loaded, 'compact' when addresses were compacted, or 'orphan' when blocks
+      were unwound, starting a new epoch.
+    :param tip: hash of the last block loaded.
+    :return: the new state.
+    '''
+    filename = get_state_file(coin)
+    path = os.path.dirname(filename)
+    os.makedirs(path or '.', exist_ok=True)
+    with state_lock(path or '.'):
+        state = read_state(filename) or {'version': 0, 'epoch': 0, 'tip': None}
+        state['version'] += 1
+        if event == 'orphan':
+            state['epoch'] += 1
+        if tip:
+            state['tip'] = tip
+        state['event'] = event
+        state['published'] = time.time()
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(filename + '.tmp', filename)
+    utils.vprint("published %s row cache state: %s" % (coin, state), level=2)
+    return state
@@ -3,44 +3,61 @@ Simple JSON-RPC 1.0 "client" implementation for invoking bitcoind and similar se
 '''
 import json
 
-# Libraries that must be installed:
-import requests
-
 # Custom libraries:
 from include import globals
+from include import transport
 from include import utils
 
 
-def rpc_request(method, parameters = []):
+def rpc_url(coin=None):
+    if coin is None:
+        coin = globals.args.type
+    try:
+        rpcauth = globals.settings.coins[coin]['rpcauth']
+    except:
+        print("%s rpcauth not defined in settings.py" % (coin,))
+    try:
+        server = globals.settings.coins[coin]['server']
+    except:
+        print("%s server not defined in settings.py" % (coin,))
+
+    return "http://" + rpcauth + "@" + server
+
+def rpc_next_id():
+    # Set a unique ID for each RPC request. The ID is returned in the response. For single requests it shouldn't be
+    # relevant, but we assert that we always get the same ID back as otherwise something has gone wrong. For batch
+    # requests the ID is how we match responses to requests.
+    try:
+        globals.rpc_id += 1
+    except:
+        globals.rpc_id = 1
+    return globals.rpc_id
+
+def get_batch_size():
+    try:
+        return int(globals.settings.rpc_batch_size)
+    except:
+        # By default we send up to 500 requests per batch.
+        return 500
+
+def rpc_request(method, parameters = [], coin=None):
     '''
     Helper function used by all RPC methods to actually make the request.
 
     :param method: the RPC method to invoke.
     :param parameters: optional parameters for the RPC method.
+    :param coin: the coin daemon to query, defaults to globals.args.type.
     :return: the result of making the query.
     '''
+    if coin is None:
+        coin = globals.args.type
 
-    try:
-        rpcauth = globals.settings.coins[globals.args.type]['rpcauth']
-    except:
-        print("%s rpcauth not defined in settings.py" % (globals.args.type,))
-    try:
-        server = globals.settings.coins[globals.args.type]['server']
-    except:
-        print("%s server not defined in settings.py" % (globals.args.type,))
-
-    url = "http://" + rpcauth + "@" + server
+    url = rpc_url(coin)
     utils.vprint("url: %s" % (url,))
     headers = {'content-type': 'application/json'}
     utils.vprint("headers: %s" % (headers,), level=2)
 
-    # Set a unique ID for each RPC request. The ID is returned in the response. For our needs it shouldn't be
-    # relevant, but we assert that we always get the same ID back as otherwise something has gone wrong.
-    try:
-        globals.rpc_id += 1
-    except:
-        globals.rpc_id = 1
-    id = globals.rpc_id
+    id = rpc_next_id()
 
     # Build a basic RPC 1.0 request payload.
     payload = {
@@ -50,7 +67,7 @@ def rpc_request(method, parameters = []):
     }
     utils.vprint("payload: %s" % (payload,))
     # Post the request payload and collect the response.
-    response = requests.post(url, data=json.dumps(payload), headers=headers)
+    response = transport.request(coin, 'POST', url, data=json.dumps(payload), headers=headers)
 
     if not response:
         print("RPC fatal error: no response, verify dameon is running and rpcauth credentials")
@@ -66,6 +83,64 @@ def rpc_request(method, parameters = []):
 
     return response["result"]
 
+def rpc_batch(calls, batch_size=None):
+    '''
+    Invoke many RPC methods, sending them to the daemon as JSON-RPC batches (a JSON array of requests per POST).
+
+    An error in one call doesn't abort the batch: each call gets its own result and error.
+
+    :param calls: list of (method, parameters) tuples.
+    :param batch_size: maximum number of calls sent per request (defaults to rpc_batch_size in settings.py).
+    :return: list of dictionaries with 'result' and 'error' keys, in the same order as calls.
+    '''
+    if not batch_size:
+        batch_size = get_batch_size()
+
+    url = rpc_url()
+    headers = {'content-type': 'application/json'}
+
+    responses = []
+    for offset in range(0, len(calls), batch_size):
+        payload = []
+        for method, parameters in calls[offset:offset + batch_size]:
+            payload.append({
+                "method": method,
+                "params": parameters,
+                "id": rpc_next_id(),
+            })
+        utils.vprint("batch payload: %d calls (%s ... %s)" % (len(payload), payload[0], payload[-1]), level=2)
+        response = transport.request(globals.args.type, 'POST', url, data=json.dumps(payload), headers=headers)
+
+        if response is None:
+            print("RPC fatal error: no response, verify dameon is running and rpcauth credentials")
+            exit(1)
+
+        try:
+            results = {}
+            for result in response.json():
+                results[result["id"]] = result
+        except Exception as e:
+            # The whole batch failed, for example because the daemon doesn't support batches.
+            print("RPC batch failed with status code %d: %s" % (response.status_code, e))
+            results = {}
+
+        for call in payload:
+            if call["id"] in results:
+                responses.append({
+                    "result": results[call["id"]].get("result"),
+                    "error": results[call["id"]].get("error"),
+                })
+            else:
+                responses.append({
+                    "result": None,
+                    "error": {
+                        "code": None,
+                        "message": "no response for %s in batch" % (call["method"],),
+                    },
+                })
+
+    return responses
+
 def invoke_method(method, parameters):
     # @TODO: validate method and parameters
     return rpc_request(method=method, parameters=parameters)
@@ -0,0 +1,220 @@
+'''
+External merge sort for the gzipped CSV files written while extracting the blockchain.
+
+Each file is read in chunks that fit in the memory budget. Chunks are sorted and de-duplicated in a pool of processes,
+each written to a temporary run file, then the runs are merged into the sorted file, removing duplicate lines. Lines
+are compared as bytes, giving the same order as `LANG=C sort -u`.
+
+Multiple files can be sorted concurrently, sharing the same pool of processes and the same memory budget.
+'''
+import concurrent.futures
+import contextlib
+import gzip
+import heapq
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# Libraries that must be installed:
+from tqdm import tqdm
+
+# Custom libraries:
+from include import globals
+from include import utils
+
+
+class SortAborted(Exception):
+    '''
+    Sorting a file was stopped because sorting another file failed.
+    '''
+    pass
+
+# Number of lines buffered before writing them to the compressed output.
+WRITE_BATCH = 10000
+
+def get_sort_settings():
+    '''
+    Sort settings, optionally overridden by a `sort` dictionary in settings.py.
+    '''
+    sort_settings = {
+        'memory': 2 * 1024 ** 3,
+        'workers': None,
+        'temporary_path': '/tmp/{coin}',
+        'concurrent_files': True,
+        'merge_width': 64,
+        'run_compress_level': 1,
+    }
+    try:
+        sort_settings.update(globals.settings.sort)
+    except:
+        pass
+    sort_settings['temporary_path'] = sort_settings['temporary_path'].replace('{coin}', globals.args.type)
+    return sort_settings
+
+def write_lines(lines, f_destination):
+    '''
+    Write sorted lines, skipping duplicates.
+
+    :return: number of lines written.
+    '''
+    written = 0
+    previous = None
+    batch = []
+    for line in lines:
+        if line != previous:
+            batch.append(line)
+            previous = line
+            if len(batch) >= WRITE_BATCH:
+                f_destination.writelines(batch)
+                written += len(batch)
+                batch = []
+    f_destination.writelines(batch)
+    return written + len(batch)
+
+def sort_run(lines, path, compress_level):
+    '''
+    Sort and de-duplicate a chunk of lines, writing them to a compressed run file. Runs in a worker process.
+
+    :return: tuple of (path of the run file, number of lines written).
+    '''
+    with gzip.open(path, 'wb', compresslevel=compress_level) as f_run:
+        written = write_lines(sorted(lines), f_run)
+    return path, written
+
+def merge_runs(paths, destination_file, compress_level):
+    '''
+    Merge sorted run files into a single sorted file, removing duplicates. Runs in a worker process.
+
+    The destination is written to a temporary file and renamed once complete, then the run files are removed.
+
+    :return: tuple of (destination file, number of lines written).
+    '''
+    temporary_file = destination_file + '.tmp'
+    with contextlib.ExitStack() as stack:
+        runs = [stack.enter_context(gzip.open(path, 'rb')) for path in paths]
+        with gzip.open(temporary_file, 'wb', compresslevel=compress_level) as f_destination:
+            written = write_lines(heapq.merge(*runs), f_destination)
+    os.replace(temporary_file, destination_file)
+    for path in paths:
+        os.unlink(path)
+    return destination_file, written
+
+def sort_file(source_file, destination_file, lines, executor, slots, chunk_bytes, failed, compress_level,
+              sort_settings, position=0):
+    '''
+    Sort a gzipped file with the external merge sort.
+
+    :param source_file: the gzipped file to sort.
+    :param destination_file: the gzipped sorted file to create.
+    :param lines: number of lines in the source file, to display progress.
+    :param executor: process pool sorting and merging runs.
+    :param slots: semaphore limiting how many chunks are held in memory, shared by all files being sorted.
+    :param chunk_bytes: approximate size of each chunk.
+    :param failed: event set when sorting any file fails, to stop sorting the other files.
+    :param compress_level: compression level of the sorted file.
+    :param sort_settings: settings from get_sort_settings().
+    :param position: position of the progress bar.
+    :return: number of lines in the sorted file.
+    '''
+    sort_start = time.time()
+    name = os.path.basename(source_file)
+    utils.vprint("sorting %s" % (source_file,))
+    os.makedirs(sort_settings['temporary_path'], exist_ok=True)
+    temporary_path = tempfile.mkdtemp(prefix=name + '.', dir=sort_settings['temporary_path'])
+    futures = []
+    try:
+        # Generate sorted runs in parallel.
+        with gzip.open(source_file, 'rb') as f_source, \
+                tqdm(total=lines, desc="sort %s" % name, unit='line', unit_scale=True, dynamic_ncols=True,
+                     smoothing=0, miniters=1, mininterval=1.0, position=position) as pbar:
+            while True:
+                slots.acquire()
+                if failed.is_set():
+                    slots.release()
+                    raise SortAborted("sorting %s aborted" % (source_file,))
+                chunk = f_source.readlines(chunk_bytes)
+                if not chunk:
+                    slots.release()
+                    break
+                if not chunk[-1].endswith(b'\n'):
+                    chunk[-1] += b'\n'
+                path = os.path.join(temporary_path, "run-%06d.gz" % len(futures))
+                future = executor.submit(sort_run, chunk, path, sort_settings['run_compress_level'])
+                future.add_done_callback(lambda _: slots.release())
+                futures.append(future)
+                pbar.update(len(chunk))
+                del chunk
+        runs = [future.result()[0] for future in futures]
+        utils.vprint("%s: generated %d sorted runs in %s seconds" % (name, len(runs), utils.elapsed(sort_start)),
+                     level=2)
+
+        # Merge the runs, in several passes if there are too many to open at once.
+        merge_pass = 0
+        while len(runs) > sort_settings['merge_width']:
+            width = sort_settings['merge_width']
+            futures = []
+            for n in range(0, len(runs), width):
+                path = os.path.join(temporary_path, "merge-%d-%06d.gz" % (merge_pass, n // width))
+                futures.append(executor.submit(merge_runs, runs[n:n + width], path,
+                                               sort_settings['run_compress_level']))
+            runs = [future.result()[0] for future in futures]
+            merge_pass += 1
+        _, written = executor.submit(merge_runs, runs, destination_file, compress_level).result()
+    except:
+        failed.set()
+        raise
+    finally:
+        for future in futures:
+            future.cancel()
+        shutil.rmtree(temporary_path, ignore_errors=True)
+
+    utils.vprint("sorted %s in %s seconds: %d lines, %d duplicates removed" % (source_file, utils.elapsed(sort_start),
+                                                                                written, lines - written))
+    logging.info("sorted %s in %s seconds: %d lines, %d duplicates removed" % (source_file,
+                                                                                utils.elapsed(sort_start), written,
+                                                                                lines - written))
+    return written
+
+def sort_files(files, compress_level=6):
+    '''
+    Sort gzipped files with the external merge sort, optionally all at the same time.
+
+    Memory is bounded by the `memory` sort setting, which is shared by all files being sorted: roughly twice as many
+    chunks as there are workers are held in memory at once, and each chunk takes about four times its size between
+    the lines read, the copy sent to the worker and the sorted copy.
+
+    :param files: list of (source file, destination file, number of lines) tuples.
+    :param compress_level: compression level of the sorted files.
+    :return: list with the number of lines in each sorted file.
+    '''
+    sort_settings = get_sort_settings()
+    workers = max(1, sort_settings['workers'] or os.cpu_count() or 1)
+    slots = threading.BoundedSemaphore(workers * 2)
+    chunk_bytes = max(1024 ** 2, sort_settings['memory'] // (workers * 2 * 4))
+    failed = threading.Event()
+    utils.vprint("sorting %d files with %d workers (memory=%s chunk=%s)" %
+                 (len(files), workers, utils.human_readable(sort_settings['memory']),
+                  utils.human_readable(chunk_bytes)), level=2)
+
+    # Runs are sorted and merged in worker processes; the files are read and runs are scheduled from threads. Worker
+    # processes are spawned rather than forked, as forking a process with threads isn't safe.
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                mp_context=multiprocessing.get_context('spawn')) as executor:
+        if not sort_settings['concurrent_files']:
+            return [sort_file(source_file, destination_file, lines, executor, slots, chunk_bytes, failed,
+                              compress_level, sort_settings) for source_file, destination_file, lines in files]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(files)) as threads:
+            futures = [threads.submit(sort_file, source_file, destination_file, lines, executor, slots, chunk_bytes,
+                                      failed, compress_level, sort_settings, position)
+                       for position, (source_file, destination_file, lines) in enumerate(files)]
+            concurrent.futures.wait(futures)
+            # Report the error that caused the other files to be aborted.
+            for future in sorted(futures, key=lambda f: isinstance(f.exception(), SortAborted)):
+                if future.exception():
+                    raise future.exception()
+            return [future.result() for future in futures]
@@ -0,0 +1,168 @@
+'''
+Pooled keep-alive HTTP transport shared by the REST and RPC clients.
+
+Each pool (generally a coin name) gets its own requests Session, so repeated requests to the same daemon reuse
+connections instead of opening a new TCP connection every time. Sessions are created lazily per process: after a fork
+(for example in a gunicorn worker) the sessions inherited from the parent are discarded and new ones are opened.
+'''
+import os
+import random
+import threading
+import time
+
+# Libraries that must be installed:
+import requests
+from requests.adapters import HTTPAdapter
+
+# Custom libraries:
+from include import globals
+from include import utils
+
+
+# Protects session creation and statistics, as blocks are requested from multiple threads.
+lock = threading.Lock()
+
+def get_transport_settings():
+    '''
+    Transport settings, optionally overridden by a `transport` dictionary in settings.py.
+    '''
+    transport_settings = {
+        'pool_connections': 4,
+        'pool_maxsize': 16,
+        'timeout': 300,
+        'retry_limit': 10,
+        'retry_statuses': [502, 503, 504],
+        'backoff': 0.5,
+        'backoff_max': 30,
+    }
+    try:
+        transport_settings.update(globals.settings.transport)
+    except:
+        pass
+    return transport_settings
+
+def reset():
+    '''
+    Discard all sessions and statistics owned by this process.
+    '''
+    with lock:
+        globals.http_pid = os.getpid()
+        globals.http_sessions = {}
+        globals.http_stats = {}
+
+def check_pid():
+    try:
+        pid = globals.http_pid
+    except:
+        pid = None
+    if pid != os.getpid():
+        # We were forked (or this is the first request): sessions can't be shared with the parent process.
+        reset()
+
+def session(pool):
+    '''
+    Return the pooled session for the specified pool, creating it if necessary.
+
+    :param pool: name of the connection pool, generally the coin type.
+    :return: a requests Session.
+    '''
+    check_pid()
+    with lock:
+        if pool not in globals.http_sessions:
+            transport_settings = get_transport_settings()
+            utils.vprint("opening %s http session (pool_maxsize=%d)" % (pool, transport_settings['pool_maxsize']),
+                         level=2)
+            http_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=transport_settings['pool_connections'],
+                                  pool_maxsize=transport_settings['pool_maxsize'])
+            http_session.mount('http://', adapter)
+            http_session.mount('https://', adapter)
+            globals.http_sessions[pool] = http_session
+        return globals.http_sessions[pool]
+
+def record(pool, elapsed, retries, failed):
+    with lock:
+        if pool not in globals.http_stats:
+            globals.http_stats[pool] = {
+                'requests': 0,
+                'failures': 0,
+                'retries': 0,
+                'elapsed': 0.0,
+                'max_elapsed': 0.0,
+            }
+        pool_stats = globals.http_stats[pool]
+        pool_stats['requests'] += 1
+        pool_stats['retries'] += retries
+        pool_stats['elapsed'] += elapsed
+        pool_stats['max_elapsed'] = max(pool_stats['max_elapsed'], elapsed)
+        if failed:
+            pool_stats['failures'] += 1
+
+def stats(pool=None):
+    '''
+    Per-pool request counters and latencies for this process.
+
+    :param pool: optionally only return statistics for this pool.
+    :return: dictionary of statistics, with average latency in seconds.
+    '''
+    check_pid()
+    with lock:
+        pools = {}
+        for name, pool_stats in globals.http_stats.items():
+            if pool and name != pool:
+                continue
+            pools[name] = dict(pool_stats)
+            pools[name]['average_elapsed'] = round(pool_stats['elapsed'] / max(pool_stats['requests'], 1), 5)
+            pools[name]['elapsed'] = round(pool_stats['elapsed'], 5)
+            pools[name]['max_elapsed'] = round(pool_stats['max_elapsed'], 5)
+    if pool:
+        return pools.get(pool, {})
+    return pools
+
+def request(pool, method, url, retry_limit=None, **kwargs):
+    '''
+    Make an HTTP request on a pooled session, retrying with exponential backoff on connection failures and on
+    temporary server errors (for example while the daemon is still starting).
+
+    :param pool: name of the connection pool, generally the coin type.
+    :param method: HTTP method, such as 'GET' or 'POST'.
+    :param url: URL to request.
+    :param retry_limit: optionally override how many times the request is attempted.
+    :param kwargs: passed through to requests.
+    :return: the response, or None if no response was received.
+    '''
+    transport_settings = get_transport_settings()
+    if retry_limit is None:
+        retry_limit = transport_settings['retry_limit']
+    kwargs.setdefault('timeout', transport_settings['timeout'])
+
+    start = time.time()
+    response = None
+    for attempt in range(retry_limit):
+        try:
+            response = session(pool).request(method, url, **kwargs)
+            if response.status_code not in transport_settings['retry_statuses']:
+                break
+            reason = "status code %d" % response.status_code
+        except requests.exceptions.RequestException as e:
+            reason = e
+        if attempt < (retry_limit - 1):
+            # Add a random delay to avoid lock-stepping when running with concurrency.
+            sleep_for = min(transport_settings['backoff_max'], transport_settings['backoff'] * 2 ** attempt) * \
+                random.uniform(0.5, 1.5)
+            utils.vprint("%s request [%d] to %s pool failed (retrying in %.1f seconds): %s" % (method, attempt, pool,
+                                                                                              sleep_for, reason))
+            time.sleep(sleep_for)
+        else:
+            utils.vprint("%s request [%d] to %s pool failed, too many failures, giving up: %s" % (method, attempt,
+                                                                                                 pool, reason))
+
+    record(pool, time.time() - start, attempt, response is None)
+    utils.debug({
+        'activity': 'HTTP %s' % method,
+        'pool': pool,
+        'status_code': response.status_code if response is not None else None,
+        'retries': attempt,
+        'elapsed': utils.elapsed(start, 5),
+    }, level=3)
+    return response
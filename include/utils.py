@@ -1,15 +1,15 @@
 import time
-import random
 import os
 import psutil
 import logging
+import subprocess
 import sys
 
-# Libraries that must be installed:
-import requests
-
 # Custom libraries:
+from include import address
+from include import blockparser
 from include import globals
+from include import transport
 
 def elapsed(timestamp, precision=1):
     ''' Return how many seconds have elapsed since provided timestamp, with optional decimal precision. '''
@@ -31,66 +31,46 @@ def vprint(message, level=1):
 def supported_coins(settings):
     return [type for type in settings.coins.keys()]
 
+def rest_url(path, settings):
+    if globals.args.host:
+        return "http://%s/rest/%s" % (globals.args.host, path)
+    else:
+        return "http://%s/rest/%s" % (settings.coins[globals.args.type]['server'], path)
+
+def rest_request(path, settings, raw=False):
+    ''' Request a JSON document (or raw bytes) from the coin daemon's REST server, returning None on failure. '''
+    url = rest_url(path, settings)
+    vprint("requesting %s" % (url,), level=4)
+    response = transport.request(globals.args.type, 'GET', url)
+    if response is None:
+        vprint("REST request for %s failed, no response" % (path,))
+        return None
+    elif response.status_code == 200:
+        vprint("success (200)", level=4)
+        if raw:
+            return response.content
+        return response.json()
+    else:
+        vprint("REST request for %s failed with status code %d" % (path, response.status_code))
+        if response.status_code == 404:
+            vprint("path not found (404): be sure daemon was started with -rest flag")
+        elif response.status_code == 503:
+            vprint("server error (503): daemon may still be starting, try again shortly")
+        return None
+
 def request_chaininfo(settings):
-    retry_limit = 10
-    for loop_counter in range(retry_limit):
-        try:
-            if globals.args.host:
-                url = "http://%s/rest/chaininfo.json" % (globals.args.host,)
-            else:
-                url = "http://%s/rest/chaininfo.json" % (settings.coins[globals.args.type]['server'],)
-            vprint("requesting %s" % (url,), level=4)
-            response = requests.get(url)
-            if response.status_code == 200:
-                vprint("success (200)", level=4)
-                return response.json()
-            else:
-                vprint("REST request failed with status code %d" % (response.status_code,))
-                if response.status_code == 404:
-                    vprint("path not found (404): be sure daemon was started with -rest flag")
-                elif response.status_code == 503:
-                    vprint("server error (404): daemon may still be starting, try again shortly")
-        except Exception as e:
-            if loop_counter < (retry_limit - 1):
-                # Add a random delay to avoid lock-stepping when running with concurrency.
-                sleep_for = 10 * loop_counter * random.randint(1, 3)
-                vprint("REST request [%d] for block %s failed (retrying in %.1f seconds): %s" % (loop_counter, hash, sleep_for, e))
-                time.sleep(sleep_for)
-            else:
-                vprint("REST request [%d] for block %s failed, too many failures, giving up: %s" % (loop_counter, hash, e))
-                print(response)
-                return None
+    return rest_request("chaininfo.json", settings)
 
 def request_block(hash, settings):
-    retry_limit = 10
-    for loop_counter in range(retry_limit):
-        try:
-            if globals.args.host:
-                url = "http://%s/rest/block/%s.json" % (globals.args.host, hash)
-            else:
-                url = "http://%s/rest/block/%s.json" % (settings.coins[globals.args.type]['server'], hash)
-            vprint("requesting %s" % (url,), level=4)
-            response = requests.get(url)
-            if response.status_code == 200:
-                vprint("success (200)", level=4)
-                return response.json()
-            else:
-                vprint("REST request failed with status code %d" % (response.status_code,))
-                if response.status_code == 404:
-                    vprint("path not found (404): be sure daemon was started with -rest flag")
-                elif response.status_code == 503:
-                    vprint("server error (404): daemon may still be starting, try again shortly")
-                return None
-        except Exception as e:
-            if loop_counter < (retry_limit - 1):
-                # Add a random delay to avoid lock-stepping when running with concurrency.
-                sleep_for = 10 * loop_counter * random.randint(1, 3)
-                vprint("REST request [%d] for block %s failed (retrying in %.1f seconds): %s" % (loop_counter, hash, sleep_for, e))
-                time.sleep(sleep_for)
-            else:
-                vprint("REST request [%d] for block %s failed, too many failures, giving up: %s" % (loop_counter, hash, e))
-                print(response)
-                return None
+    return rest_request("block/%s.json" % (hash,), settings)
+
+def request_raw_block(hash, height, settings):
+    ''' Request a raw block from the coin daemon's REST server and parse it. '''
+    raw = rest_request("block/%s.bin" % (hash,), settings, raw=True)
+    if raw is None:
+        return None
+    return blockparser.parse_block(raw, height, address.get_address_settings(globals.args.type),
+                                   auxpow=settings.coins[globals.args.type].get('auxpow', False))
 
 def working_path():
     if globals.args.working:
@@ -99,20 +79,24 @@ def working_path():
         return os.getcwd() + "/blockchain_data/" + globals.args.type + "/"
 
 def gzipped_sort(source_file, destination_file, lines):
+    '''
+    Sort a gzipped file with the system_sort_command defined in settings.
+
+    By default files are sorted in-process by include/sort.py, this is only used if a custom sort command is configured.
+    '''
     sort_start = time.time()
     vprint("sorting %s" % (source_file,))
 
-    # Allow overriding sort command in settings file (primary to adjust memory usage or sort destination)
-    try:
-        system_sort_command = globals.settings.system_sort_command.replace('{coin}', globals.args.type)
-        vprint("loaded sort command from settings: '%s'" % system_sort_command)
-    except:
-        system_sort_command = \
-            "gzip -dc %s | LANG=C sort -u -S 8G -T /tmp/%s --compress-program=gzip | pv -l -s %d | gzip > %s" \
-            % globals.args.type
-        vprint("using default sort command: '%s'" % system_sort_command)
+    system_sort_command = globals.settings.system_sort_command.replace('{coin}', globals.args.type)
+    vprint("loaded sort command from settings: '%s'" % system_sort_command)
 
-    os.system(system_sort_command % (source_file, lines, destination_file))
+    # Use pipefail so the failure of any command in the pipeline is detected.
+    result = subprocess.run(['bash', '-o', 'pipefail', '-c',
+                             system_sort_command % (source_file, lines, destination_file)])
+    if result.returncode != 0:
+        print("sort command failed with exit code %d: '%s'" % (result.returncode, system_sort_command))
+        logging.critical("sort command failed with exit code %d: '%s'" % (result.returncode, system_sort_command))
+        exit(1)
     vprint("sort completed in %s seconds" % (elapsed(sort_start, )))
 
 # From https://stackoverflow.com/questions/1094841/reusable-library-to-get-human-readable-version-of-file-size
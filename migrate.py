@@ -0,0 +1,203 @@
+'''
+Convert an existing coin database to another table schema in place, reporting the size of each table and the latency
+of key lookups before and after.
+
+Each table is copied into a new table with the target schema, then swapped in with an atomic RENAME TABLE. Stop the
+extract script and the API before migrating.
+'''
+import argparse
+import logging
+import os
+import random
+import time
+
+# Custom libraries:
+from include import address
+from include import dbutils
+from include import utils
+from include import globals
+import settings
+
+
+def table_size(coin, table):
+    '''
+    :return: tuple of (approximate number of rows, data size, index size), in bytes.
+    '''
+    cursor = dbutils.database_cursor(coin)
+    # Refresh the statistics.
+    cursor.execute("ANALYZE TABLE `%s`" % (table,))
+    cursor.fetchall()
+    cursor.execute("SELECT `TABLE_ROWS`, `DATA_LENGTH`, `INDEX_LENGTH` FROM information_schema.TABLES WHERE "
+                   "`TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = %s", (table,))
+    rows = cursor.fetchall()
+    if not rows:
+        return 0, 0, 0
+    return rows[0]
+
+def sample_keys(coin, table, samples):
+    '''
+    A random sample of the keys of a table, to measure lookup latency.
+    '''
+    cursor = dbutils.database_cursor(coin)
+    keys = set()
+    if dbutils.has_id(coin, table):
+        cursor.execute("SELECT MAX(`id`) FROM `%s`" % (table,))
+        max_id, = cursor.fetchone()
+        if not max_id:
+            return []
+        ids = random.sample(range(1, max_id + 1), min(samples, max_id))
+        cursor.execute("SELECT %s FROM `%s` WHERE `id` IN (%s)" % (dbutils.key_column(coin, table), table,
+                                                                  ", ".join(["%s"] * len(ids))), ids)
+        keys.update(dbutils.decode_key(key) for key, in cursor)
+    else:
+        for _ in range(samples):
+            # Keys are the primary key, start from a random position in the index.
+            start = os.urandom(32) if dbutils.is_binary_key(coin, table) else random.choice(address.BASE58_ALPHABET)
+            cursor.execute("SELECT %s FROM `%s` WHERE `hash` >= %%s ORDER BY `hash` LIMIT 1" %
+                           (dbutils.key_column(coin, table), table), (start,))
+            keys.update(dbutils.decode_key(key) for key, in cursor)
+    return list(keys)
+
+def lookup_latency(coin, table, keys):
+    '''
+    :return: tuple of (average, 99th percentile) lookup latency in milliseconds.
+    '''
+    if not keys:
+        return 0, 0
+    latencies = []
+    for key in keys:
+        start = time.time()
+        if table == 'address_delta':
+            dbutils.select_all(coin, table, key)
+        else:
+            dbutils.select(coin, table, key)
+        latencies.append((time.time() - start) * 1000)
+    latencies.sort()
+    return round(sum(latencies) / len(latencies), 3), round(latencies[int(len(latencies) * 0.99)], 3)
+
+def measure(coin, tables, keys):
+    results = {}
+    for table in tables:
+        rows, data_length, index_length = table_size(coin, table)
+        average, p99 = lookup_latency(coin, table, keys[table])
+        results[table] = {
+            'rows': rows,
+            'data': data_length,
+            'index': index_length,
+            'average': average,
+            'p99': p99,
+        }
+    return results
+
+def convert_table(coin, table, schema, compression, batch_size, keep):
+    '''
+    Copy a table into a new table with the target schema, then swap them.
+    '''
+    start = time.time()
+    cursor = dbutils.database_cursor(coin)
+    new_table = table + '_migrate'
+    old_table = table + '_' + dbutils.get_table_schema(coin)
+    cursor.execute("SELECT `DATA_TYPE` FROM information_schema.COLUMNS WHERE `TABLE_SCHEMA` = DATABASE() AND "
+                   "`TABLE_NAME` = %s AND `COLUMN_NAME` = 'data'", (table,))
+    data_type, = cursor.fetchone()
+    cursor.execute("DROP TABLE IF EXISTS `%s`" % (new_table,))
+    cursor.execute(dbutils.table_definition(table, schema, name=new_table, compression=compression,
+                                            data_type=dbutils.decode_key(data_type)))
+
+    binary_source = dbutils.is_binary_key(coin, table)
+    binary_destination = schema == 'compact' and table in dbutils.get_binary_tables()
+    if binary_destination and not binary_source:
+        cursor.execute("SELECT COUNT(*) FROM `%s` WHERE `hash` NOT REGEXP '^[0-9a-f]{64}$'" % (table,))
+        invalid, = cursor.fetchone()
+        if invalid:
+            print("%s has %d keys that are not a txid or block hash, not converting" % (table, invalid))
+            cursor.execute("DROP TABLE `%s`" % (new_table,))
+            exit(1)
+    if binary_destination and not binary_source:
+        key = "UNHEX(`hash`)"
+    elif binary_source and not binary_destination:
+        key = "LOWER(HEX(`hash`))"
+    else:
+        key = "`hash`"
+
+    if schema == 'compact' and table != 'address_delta':
+        # Keys are unique: like select(), keep the first row of a key.
+        query = "INSERT INTO `%s` (`hash`, `data`) SELECT %s, `data` FROM `%s`%%s ON DUPLICATE KEY UPDATE " \
+                "`%s`.`hash` = `%s`.`hash`" % (new_table, key, table, new_table, new_table)
+    elif dbutils.has_id(coin, table):
+        query = "INSERT INTO `%s` (`id`, `hash`, `data`) SELECT `id`, %s, `data` FROM `%s`%%s" % (new_table, key, table)
+    else:
+        query = "INSERT INTO `%s` (`hash`, `data`) SELECT %s, `data` FROM `%s`%%s" % (new_table, key, table)
+
+    if dbutils.has_id(coin, table):
+        # Copy in batches of ids, so each transaction stays small.
+        cursor.execute("SELECT MAX(`id`) FROM `%s`" % (table,))
+        max_id, = cursor.fetchone()
+        for first_id in range(0, (max_id or 0) + 1, batch_size):
+            utils.vprint(" > %s: copying ids %d-%d of %d" % (table, first_id, first_id + batch_size, max_id), level=2)
+            cursor.execute(query % (" WHERE `id` >= %d AND `id` < %d ORDER BY `id`" % (first_id,
+                                                                                      first_id + batch_size),))
+    else:
+        cursor.execute(query % ("",))
+
+    cursor.execute("RENAME TABLE `%s` TO `%s`, `%s` TO `%s`" % (table, old_table, new_table, table))
+    if not keep:
+        cursor.execute("DROP TABLE `%s`" % (old_table,))
+    utils.vprint("converted %s to the %s schema in %s seconds" % (table, schema, utils.elapsed(start)))
+    logging.info("converted %s to the %s schema in %s seconds" % (table, schema, utils.elapsed(start)))
+
+def main(args):
+    coin = args.type
+    if dbutils.get_backend(coin) != 'mysql':
+        print("migrate.py requires the mysql backend")
+        exit(1)
+    tables = dbutils.get_tables()
+    dbutils.create_tables(coin)
+    source_schema = dbutils.get_table_schema(coin)
+    keys = {table: sample_keys(coin, table, args.samples) for table in tables}
+    before = measure(coin, tables, keys)
+
+    if args.report_only:
+        after = before
+    elif source_schema == args.schema:
+        print("%s tables already use the %s schema" % (coin, args.schema))
+        after = before
+    else:
+        for table in tables:
+            convert_table(coin, table, args.schema, args.compression, args.batch_size, args.keep)
+        # The schema is detected again from the converted tables.
+        globals.table_schema.pop(coin, None)
+        after = measure(coin, tables, keys)
+
+    print("%-14s %12s %12s %12s %12s %12s %12s %12s" % ('table', 'rows', 'data', 'index', 'data after',
+                                                         'index after', 'lookup ms', 'lookup after'))
+    for table in tables:
+        print("%-14s %12s %12s %12s %12s %12s %12s %12s" % (
+            table, after[table]['rows'], utils.human_readable(before[table]['data']),
+            utils.human_readable(before[table]['index']), utils.human_readable(after[table]['data']),
+            utils.human_readable(after[table]['index']),
+            "%s/%s" % (before[table]['average'], before[table]['p99']),
+            "%s/%s" % (after[table]['average'], after[table]['p99'])))
+    print("lookup latency: average/99th percentile, over %d sampled keys per table" % args.samples)
+    dbutils.close_database_connection(coin)
+
+if __name__ == '__main__':
+    globals.init()
+    globals.settings = settings
+    parser = argparse.ArgumentParser(description="Convert a coin database to another table schema.")
+    parser.add_argument('-t', '--type', help="coin type", type=str, choices=utils.supported_coins(settings),
+                        required=True)
+    parser.add_argument('--schema', help="table schema to convert to (defaults to compact)", type=str,
+                        choices=['legacy', 'compact'], default='compact')
+    parser.add_argument('--compression', help="InnoDB page compression of the compact schema (defaults to the "
+                                              "table_compression setting)", type=str, choices=['zlib', 'lz4'],
+                        default=dbutils.get_schema_settings()['compression'])
+    parser.add_argument('--samples', help="number of keys looked up per table to measure latency", type=int,
+                        default=1000)
+    parser.add_argument('--batch-size', help="number of rows copied per query", type=int, default=100000)
+    parser.add_argument('--keep', help="keep the original tables, renamed with the old schema as suffix",
+                        action='store_true')
+    parser.add_argument('--report-only', help="only report table sizes and lookup latency", action='store_true')
+    parser.add_argument('-v', dest='verbose', action='count', help="verbose output")
+    globals.args = parser.parse_args()
+    main(globals.args)
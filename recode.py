@@ -0,0 +1,115 @@
+'''
+Re-encode the data column of a coin's tables with another codec, see the codec setting.
+
+Rows are decoded whichever codec they were encoded with, so the API and the extract script keep working while tables
+are converted. Set the codec in settings once the conversion completes.
+'''
+import argparse
+import logging
+import time
+
+# Libraries that must be installed:
+from tqdm import tqdm
+
+# Custom libraries:
+from include import codec
+from include import dbutils
+from include import utils
+from include import globals
+import settings
+
+
+def get_data_type(coin, table):
+    cursor = dbutils.database_cursor(coin)
+    cursor.execute("SELECT `DATA_TYPE` FROM information_schema.COLUMNS WHERE `TABLE_SCHEMA` = DATABASE() AND "
+                   "`TABLE_NAME` = %s AND `COLUMN_NAME` = 'data'", (table,))
+    data_type, = cursor.fetchone()
+    return dbutils.decode_key(data_type)
+
+def alter_data_type(coin, table, data_type):
+    start = time.time()
+    utils.vprint("converting %s.%s data column to %s" % (coin, table, data_type))
+    dbutils.database_cursor(coin).execute("ALTER TABLE `%s` MODIFY `data` %s NOT NULL" % (table, data_type))
+    logging.info("converted %s.%s data column to %s in %s seconds" % (coin, table, data_type, utils.elapsed(start)))
+
+def recode_table(coin, table, name, batch_size):
+    '''
+    Re-encode the rows of a table that aren't encoded with the codec yet, in batches.
+
+    :return: tuple of (rows read, rows re-encoded).
+    '''
+    connection = dbutils.database_connection(coin)
+    cursor = dbutils.database_cursor(coin)
+    # Rows are read in order of their primary key.
+    column = "`id`" if dbutils.has_id(coin, table) else "`hash`"
+    last = 0 if dbutils.has_id(coin, table) else b''
+    read = recoded = 0
+    with tqdm(desc="recode %s" % table, unit='row', unit_scale=True, dynamic_ncols=True, smoothing=0) as pbar:
+        while True:
+            cursor.execute("SELECT %s, `data` FROM `%s` WHERE %s > %%s ORDER BY %s LIMIT %d" %
+                           (column, table, column, column, batch_size), (last,))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last = rows[-1][0]
+            updates = [(codec.encode_value(codec.decode(data), name), key) for key, data in rows
+                       if codec.get_codec_id(data) != name]
+            if updates:
+                try:
+                    connection.start_transaction()
+                    cursor.executemany("UPDATE `%s` SET `data` = %%s WHERE %s = %%s" % (table, column), updates)
+                    connection.commit()
+                except Exception as e:
+                    connection.rollback()
+                    print("re-encoding %s failed: %s" % (table, e))
+                    exit(1)
+            read += len(rows)
+            recoded += len(updates)
+            pbar.update(len(rows))
+    return read, recoded
+
+def main(args):
+    start = time.time()
+    coin = args.type
+    if dbutils.get_backend(coin) != 'mysql':
+        # The embedded store holds rows of any codec as they are.
+        print("recode.py requires the mysql backend")
+        exit(1)
+    name = args.codec or codec.get_codec(coin)
+    codec.check_codec(name)
+    binary = codec.is_binary(name)
+    tables = dbutils.get_tables()
+
+    # Binary codecs require a longblob column, convert them before anything else reads the tables.
+    for table in tables:
+        if binary and get_data_type(coin, table) != 'longblob':
+            alter_data_type(coin, table, 'longblob')
+
+    for table in tables:
+        table_start = time.time()
+        read, recoded = recode_table(coin, table, name, args.batch_size)
+        utils.vprint("%s: re-encoded %d of %d rows with %s in %s seconds" % (table, recoded, read, name,
+                                                                             utils.elapsed(table_start)))
+        logging.info("%s: re-encoded %d of %d rows with %s in %s seconds" % (table, recoded, read, name,
+                                                                             utils.elapsed(table_start)))
+
+    # JSON documents are plain ASCII, so they can be stored in a longtext column again.
+    for table in tables:
+        if not binary and get_data_type(coin, table) != 'longtext':
+            alter_data_type(coin, table, 'longtext')
+
+    dbutils.close_database_connection(coin)
+    utils.vprint("re-encoded %s tables with %s in %s seconds" % (coin, name, utils.elapsed(start)))
+
+if __name__ == '__main__':
+    globals.init()
+    globals.settings = settings
+    parser = argparse.ArgumentParser(description="Re-encode a coin database with another codec.")
+    parser.add_argument('-t', '--type', help="coin type", type=str, choices=utils.supported_coins(settings),
+                        required=True)
+    parser.add_argument('--codec', help="codec to convert to (defaults to the codec setting)", type=str,
+                        choices=list(codec.CODECS))
+    parser.add_argument('--batch-size', help="number of rows re-encoded per transaction", type=int, default=10000)
+    parser.add_argument('-v', dest='verbose', action='count', help="verbose output")
+    globals.args = parser.parse_args()
+    main(globals.args)
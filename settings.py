@@ -3,21 +3,41 @@
 coins = {
     # Support for a bitcoin-style coin is added by defining the genesis_hash (first block in the blockchain) and the
     # server hostname and port of the daemon's rest server.
+    #
+    # Parsing raw blocks (--raw-blocks) also requires the address version bytes and, for coins with segwit, the bech32
+    # human readable part. Coins that support merged mining must set auxpow. Reading the daemon's block files
+    # (--blocks-dir) requires the network magic bytes that prefix each block.
     'bitcoin': {
         # REST/RPC server and port of blockchain daemon.
         'server': 'bitcoin:8332',
         'rpcauth': 'AFwy9VfUcNWouMG1ufW3EgtavyFJhUJhCRxVnBEBr4t4DeBHCu:qcWFdSLXGPZdzReV3ee7miEXqizoPCVmhDZvgX1oLSZ49WVoyx',
         'symbol': 'BTC',
+        'magic': 'f9beb4d9',
+        # https://github.com/bitcoin/bitcoin/blob/master/src/chainparams.cpp
+        'pubkey_address': 0x00,
+        'script_address': 0x05,
+        'bech32_hrp': 'bc',
     },
     'bitcoin_testnet3': {
         'server': 'bitcoin-testnet3:18332',
         'rpcauth': 'bitcointest:testbitcoin',
         'symbol': 'XTN',
+        'magic': '0b110907',
+        'pubkey_address': 0x6f,
+        'script_address': 0xc4,
+        'bech32_hrp': 'tb',
     },
     'litecoin': {
         'server': 'litecoin:9332',
         'rpcauth': '4MYPO8lKknVfS3RCDNJ3apoUCR7MYRaJHjBZsNYMvbhMTfPMud:lHS9MTG6SM7ayDaSJtQ4o6odaTfZSdHyNrZWUHgvDSBlqlbsVO',
         'symbol': 'LTC',
+        'magic': 'fbc0b6db',
+        # https://github.com/litecoin-project/litecoin/blob/master/src/chainparams.cpp
+        'pubkey_address': 0x30,
+        'script_address': 0x32,
+        # P2SH addresses with the bitcoin version byte are still valid.
+        'script_address2': 0x05,
+        'bech32_hrp': 'ltc',
     },
     'litecoin_testnet4': {
         # https://github.com/litecoin-project/litecoin/blob/0.13/src/chainparams.cpp#L214
@@ -26,17 +46,31 @@ coins = {
         'server': 'litecoin-testnet4:19332',
         'rpcauth': 'litecointest:litecointest',
         'symbol': 'XLT',
+        'magic': 'fdd2c8f1',
+        'pubkey_address': 0x6f,
+        'script_address': 0x3a,
+        'script_address2': 0xc4,
+        'bech32_hrp': 'tltc',
     },
     'dogecoin': {
         'server': 'dogecoin:22555',
         'rpcauth': 'rpcuser:rpcpassword',
         'symbol': 'DOGE',
+        'magic': 'c0c0c0c0',
+        # https://github.com/dogecoin/dogecoin/blob/master/src/chainparams.cpp
+        'pubkey_address': 0x1e,
+        'script_address': 0x16,
+        'auxpow': True,
     },
     'dogecoin_testnet3': {
         # https://github.com/dogecoin/dogecoin/blob/master/src/chainparams.cpp#L243
         'server': 'dogecoin-testnet3:44555',
         'rpcauth': 'dogecointest:testdogecoin',
         'symbol': 'XDT',
+        'magic': 'fcc1b7dc',
+        'pubkey_address': 0x71,
+        'script_address': 0xc4,
+        'auxpow': True,
     }
 }
 
@@ -48,18 +82,166 @@ database = {
     'db':     '{coin}',
 }
 
-# Optionally modify the sort command for your local environment.
+# HTTP transport used for all requests to the coin daemons' REST and RPC servers. Connections are pooled and kept
+# alive per coin, and failed requests are retried with exponential backoff.
+#  pool_connections: number of distinct hosts to cache connection pools for
+#  pool_maxsize: maximum number of connections kept alive per host (should be at least --fetch-concurrency)
+#  timeout: seconds to wait for the daemon to respond
+#  retry_limit: how many times a request is attempted before giving up
+#  retry_statuses: HTTP status codes that are retried (for example while the daemon is still starting)
+#  backoff: seconds to wait before the first retry, doubling with each subsequent retry
+#  backoff_max: maximum number of seconds to wait between retries
+transport = {
+    'pool_connections': 4,
+    'pool_maxsize': 16,
+    'timeout': 300,
+    'retry_limit': 10,
+    'retry_statuses': [502, 503, 504],
+    'backoff': 0.5,
+    'backoff_max': 30,
+}
+
+# Storage backend, can also be set per-coin in the coins dictionary:
+#  mysql: a MySQL database, see the database settings
+#  sqlite: an embedded key-value store in a local SQLite database, for single-node deployments (the normalized and
+#   UTXO tables, migrate.py and recode.py require MySQL)
+backend = 'mysql'
+
+# Embedded store settings, used by the sqlite backend:
+#  path: directory of the database file ({coin} will be replaced with the coin name), trace.py --db overrides it
+#  mmap_size: maximum number of bytes of the database memory-mapped by readers and writers
+#  cache_size: page cache size in bytes, per connection
+#  synchronous: SQLite synchronous setting, NORMAL is durable in WAL mode except on power loss
+#  timeout: seconds a writer waits for the write lock held by another writer
+#  batch_size: number of rows bulk-loaded per transaction
+sqlite = {
+    'path': 'blockchain_data/{coin}/',
+    'mmap_size': 2 * 1024 ** 3,
+    'cache_size': 256 * 1024 ** 2,
+    'synchronous': 'NORMAL',
+    'timeout': 3600,
+    'batch_size': 100000,
+}
+
+# Table schema used when creating a coin's tables:
+#  legacy: keys stored as varchar(128) with a 10 character prefix index, rows identified by an auto-increment id
+#  compact: txids and block hashes stored as binary(32), and addresses as varbinary, as the clustered primary key
+# The schema of existing tables is detected automatically, use migrate.py to convert an existing database.
+table_schema = 'legacy'
+# Optional InnoDB page compression of the compact schema: None, 'zlib' or 'lz4' (requires innodb_file_per_table and
+# a filesystem supporting hole punching).
+table_compression = None
+
+# How the API validates addresses, can also be set per-coin in the coins dictionary:
+#  local: decode base58check and bech32/bech32m addresses in-process, with the coin's version bytes and bech32 human
+#   readable part (see the coins dictionary)
+#  fallback: validate addresses in-process, and ask the coin daemon (validateaddress RPC) about those found invalid
+#  rpc: always ask the coin daemon
+# The throughput of local validation is measured with `benchmark.py -t <coin> addresses`. On one core it validated about
+# 114k addresses/s overall: 109-114k/s for base58 addresses, 81-91k/s for bech32/bech32m addresses, and 143k/s for
+# invalid addresses.
+address_validation = 'local'
+
+# Maximum number of RPC requests sent to the coin daemon in a single JSON-RPC batch.
+rpc_batch_size = 500
+
+# Codec of the data column of every table, can also be set per-coin in the coins dictionary:
+#  json: JSON documents (default)
+#  msgpack: MessagePack, requires the msgpack library
+#  json+zlib, msgpack+zlib, json+zstd, msgpack+zstd: compressed with zlib, or zstd (requires the zstandard library)
+# Binary codecs require a longblob data column: convert existing tables with recode.py before changing the codec.
+codec = 'json'
+
+# Addresses with more txids than this are stored in segments of this many txids, ordered by height, so readers can
+# fetch only the segments they need. /api/address lists the transactions of the most recent segment unless another
+# one is requested with ?segment=N, including for addresses stored in a single row by older versions, which are split
+# the same way; the totals are for the entire address.
+address_segment_size = 10000
+
+# Also load the outputs and spent outputs into normalized tables (one row per output, indexed by address), which the
+# API uses to answer address queries with a few indexed queries once they were loaded by an --initial pass. Can also be
+# set per-coin in the coins dictionary. Enable before the initial extraction, or run it again with --regenerate.
+normalized_tables = False
+
+# Also maintain the UTXO set and the balance of each address as blocks are loaded (and unwound), which the API uses
+# to list unspent outputs and balances without reading the history of the address. Can also be set per-coin in the
+# coins dictionary. Enable before the initial extraction, or run it again with --regenerate: the API only uses the
+# tables once they were loaded from the genesis block, as recorded in the table_status table.
+utxo_tables = False
+
+# Optional read-only lookup index of the tables, which the API memory-maps and searches instead of querying the
+# database. Built by extract.py after each run (and compact.py rebuilds the address table), then swapped in without
+# restarting the API. Rows are read as of the last build: keys written since then are read from the database, and so
+# are the address and vin_spent tables once extract.py (or compact.py) publishes a new row cache version, and all
+# tables once it unwinds an orphaned block, until the next index is swapped in.
+#  enabled: build the index
+#  path: directory of the index ({coin} will be replaced with the coin name), on a local disk readable by the API
+#  tables: the indexed tables (address deltas are always read from the database)
+#  keep: number of indexes kept, including the current one
+#  check_interval: how often (in seconds) the API checks whether a new index was swapped in
+lookup_index = {
+    'enabled': False,
+    'path': 'blockchain_data/{coin}/index/',
+    'tables': ['vout', 'vin_spent', 'vin_txid', 'coinbase', 'address', 'block'],
+    'keep': 2,
+    'check_interval': 1,
+}
+
+# Rows decoded by the API are cached across requests by each worker, in a least recently used cache. Cached rows of the
+# address and vin_spent tables are used until extract.py (or compact.py) publishes a new version of the tables in a
+# state file, and all rows until it unwinds an orphaned block. Rows are only cached while the state file is readable.
+#  size: maximum size in bytes of the cached rows per worker (encoded size), 0 disables the cache
+#  state_path: directory of the state file ({coin} will be replaced with the coin name), shared by the extract script
+#   and the API
+#  check_interval: how often (in seconds) the API checks the state file
+row_cache = {
+    'size': 256 * 1024 ** 2,
+    'state_path': 'blockchain_data/{coin}/',
+    'check_interval': 1,
+}
+
+# The API counts confirmations from the chain tip of each coin, published in a file shared by its workers instead of
+# asking the daemon in each request: by extract.py, with the daemon's tip it extracted from, and by a background thread
+# of the workers polling the daemon. The tip and its age are reported in the debug block of responses. Until a tip is
+# published (on a fresh deploy), the first request reads it from the daemon synchronously.
+#  path: directory of the tip file ({coin} will be replaced with the coin name), shared by the extract script and the
+#    API
+#  poll: poll the daemon (getblockchaininfo) from the API workers, otherwise the tip is only published by extract.py
+#  poll_interval: how often (in seconds) the daemon is polled, by whichever worker finds the tip older than this
+#  check_interval: how often (in seconds) each worker checks the tip file
+#  max_age: age (in seconds) after which the tip is reported as stale
+chain_tip = {
+    'path': 'blockchain_data/{coin}/',
+    'poll': True,
+    'poll_interval': 5,
+    'check_interval': 1,
+    'max_age': 60,
+}
+
+# Extracted CSV files are sorted in-process with an external merge sort.
+#  memory: approximate memory budget in bytes, shared by all files being sorted
+#  workers: number of processes sorting and merging runs (None uses all CPUs)
+#  temporary_path: where sorted runs are written ({coin} will be replaced with the coin name)
+#  concurrent_files: sort all files at the same time instead of one after another
+#  merge_width: maximum number of runs merged at once, more runs are merged in several passes
+#  run_compress_level: compression level of the temporary runs (1 is fastest)
+sort = {
+    'memory': 2 * 1024 ** 3,
+    'workers': None,
+    'temporary_path': '/tmp/{coin}',
+    'concurrent_files': True,
+    'merge_width': 64,
+    'run_compress_level': 1,
+}
+
+# Optionally sort with a system sort command instead, by defining system_sort_command in local_settings.py.
 # Requires three variables: %s, %d, %s
 #  - The first %s is the name of the compressed file to be sorted.
 #  - The %d is the number of lines (uncompressed) to be sorted.
 #  - The second %s is the name of the sorted and compressed file that will be generated.
-# Things you may need to customize:
-#  - Provide full path to gzip or different flags
-#  - Adjust the amount of memory that sort uses (defaults to 12G)
-#  - Write temporary files to a different path (defaults to /tmp)
-#  - Remove pv if unavailable on your OS (it provides progress information)
-system_sort_command = \
-    "gzip -dc %s | LANG=C sort -u -S 12G -T /tmp/{coin} --compress-program=gzip | pv -l -s %d | gzip -9 > %s"
+# For example:
+# system_sort_command = \
+#     "gzip -dc %s | LANG=C sort -u -S 12G -T /tmp/{coin} --compress-program=gzip | pv -l -s %d | gzip -9 > %s"
 
 # Colpo API REST API endpoint where we send blockchain notifications
 #  - new_block_notification: each time a block is extracted we push details to this API endpoint
@@ -13,7 +13,7 @@ start = time.time()
 def main(args):
     database = "address"
     utils.vprint(" > querying database '%s'" % database)
-    address_json = dbutils.select(globals.args.type, database, args.address)
+    address_json = dbutils.select_address(globals.args.type, args.address)
     if not address_json:
         print("address %s not found" % args.address)
         quit()
@@ -68,10 +68,10 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Trace address activity.")
     parser.add_argument('-t', '--type', help="coin type to extract", type=str, choices=utils.supported_coins(settings), required=True)
     parser.add_argument('-a', '--address', help="address to trace", type=str, required=True)
-    parser.add_argument('-d', '--db', help="full path to rocksdb directory (defaults to current directory; files can get very large)", type=int)
+    parser.add_argument('-d', '--db', help="full path to the directory of the embedded store, with the sqlite backend (defaults to the sqlite path setting)", type=str)
     parser.add_argument('-v', dest='verbose', action='count', help="verbose output")
     globals.args = parser.parse_args()
-    globals.dbs = {}
+    globals.args.read_only = True
     utils.vprint("starting ...", level=1)
     main(globals.args)
     utils.vprint("done!", level=1)